@@ -0,0 +1,702 @@
+"""
+asyncio client of "mqks" - Message Queue Kept Simple - for Python 3 services.
+Same protocol and semantics as gevent-based "mqks.client.mqks", but each "Client" instance owns its connections:
+
+    client = Client(workers=['10.0.0.1:24000:25000', '10.0.0.2:24000:25000'])
+    consumer = await client.consume('q1', ['e1'], manual_ack=True)
+    async for msg in consumer:
+        await msg.ack()
+    await client.publish('e1', 'd1', confirm=True)
+"""
+
+### import
+
+import asyncio
+from collections import deque
+import logging
+from uqid import dtid
+
+from mqks.escape import unescape
+from mqks.sharding import Ring, parse_placement
+
+### config
+
+default_config = dict(
+    workers=[                               # Should be exactly the same as mqks.server.config['workers']
+        '127.0.0.1:24000:25000',
+        '127.0.0.1:24001:25001',
+    ],
+    ring_vnodes=0,                          # Should be exactly the same as mqks.server.config['ring_vnodes']
+    ring_hash='crc32',                      # Should be exactly the same as mqks.server.config['ring_hash']
+    ring_pins={},                           # Should be exactly the same as mqks.server.config['ring_pins'], updated on "--moved" response.
+    logger_name='mqks.client',              # Change to logger_name you configured in your service.
+    ping_seconds=15,                        # Ping each connected worker each N seconds to detect disconnect.
+    reconnect_seconds=1,                    # How many seconds to wait on disconnect before trying to reconnect.
+    id_length=24,                           # Length of random ID. More bytes = more secure = more slow.
+    publish_many_bytes=64*1024,             # Max bytes of messages in one "publish_many" request. Bigger batch is split to many requests.
+    requests_batch_bytes=64*1024,           # Max bytes of pending requests coalesced into one write to worker. Single bigger request is written alone.
+    response_bytes_limit=16*1024*1024,      # Max bytes of one response line, e.g. of a big message.
+    consumer_queue_size=100,                # Messages buffered by consumer that is not iterated fast enough. When full, client stops reading
+                                            # responses from the worker of the queue, so server gets backpressure via TCP.
+    encoding='utf-8',                       # Of "data" of messages and results of "_eval". None = bytes.
+)
+
+### const
+
+MOVED = b'--moved '  # Response when ring of workers is changed, see "mqks.server.lib.migration".
+ESCAPED = b',esc=1'  # Prop of message with data escaped for "protocol v1", see "mqks.server.lib.clients.escape_msg".
+
+### Client
+
+class Client:
+    """
+    Connects to each worker on demand, keeps one reading task and one writing task per worker.
+    All methods are coroutines, except "get_worker".
+    """
+
+    ### init
+
+    def __init__(self, **config):
+        """
+        @param config: dict - overrides "default_config"
+        """
+        self.config = dict(default_config, **config)
+        self.log = logging.getLogger(self.config['logger_name'])
+        self._ring = Ring(self.config['workers'], self.config['ring_vnodes'], self.config['ring_hash'], self.config['ring_pins'])  # Replaced on "--moved" response.
+        self._links = {}                    # _links[worker: int] == _Link
+        self._consumers = {}                # _consumers[consumer_id: str] == Consumer
+        self._confirms = {}                 # _confirms[request_id: str] == asyncio.Future
+        self._eval_results = {}             # _eval_results[request_id: str] == asyncio.Future
+        self._is_closed = False
+
+    ### close
+
+    async def close(self):
+        """
+        Disconnect from all workers, stop all consumers.
+        """
+        self._is_closed = True
+        for link in self._links.values():
+            for task in link.tasks:
+                task.cancel()
+            if link.writer:
+                link.writer.close()
+        for consumer in list(self._consumers.values()):
+            consumer._stop()
+        self._links.clear()
+        self._consumers.clear()
+
+    ### publish
+
+    async def publish(self, event, data, confirm=False):
+        """
+        Client publishes new message to server.
+        Server puts copies of this message to zero or more queues that were subscribed to this event.
+
+        @param event: str
+        @param data: str|bytes
+        @param confirm: bool
+        @return msg_id: str
+        """
+        return await self._send(self.get_worker(event), self._request_id(), 'publish', b'%s %s' % (event.encode(), self._encode(data)), confirm=confirm)
+
+    ### publish many
+
+    async def publish_many(self, events_and_data, confirm=False):
+        """
+        Client publishes many messages with one request per worker of events, see "mqks.client.mqks.publish_many".
+
+        @param events_and_data: iterable(tuple(event: str, data: str|bytes))
+        @param confirm: bool
+        @return list(msg_id: str) - in the same order as "events_and_data"
+        """
+        msg_ids = []
+        batches = {}  # batches[worker: int] == tuple(request_id: str, pairs: list(bytes), pairs_bytes: int)
+        sends = []
+
+        for event, data in events_and_data:
+            worker = self.get_worker(event)
+            batch = batches.get(worker)
+            data = self._encode(data)
+            pair = b'%s %d %s' % (event.encode(), len(data), data)
+
+            if batch and batch[2] + len(pair) > self.config['publish_many_bytes']:
+                sends.append(self._send(worker, batch[0], 'publish_many', b' '.join(batch[1]), confirm=confirm))
+                batch = None
+
+            if not batch:
+                batch = (self._request_id(), [], 0)
+
+            request_id, pairs, pairs_bytes = batch
+            msg_ids.append('{}.{}'.format(request_id, len(pairs)))  # See "msg_id" in server "publish_many".
+            pairs.append(pair)
+            batches[worker] = (request_id, pairs, pairs_bytes + len(pair) + 1)
+
+        for worker, (request_id, pairs, _) in batches.items():
+            sends.append(self._send(worker, request_id, 'publish_many', b' '.join(pairs), confirm=confirm))
+
+        await asyncio.gather(*sends)
+        return msg_ids
+
+    ### consume
+
+    async def consume(self, queue, events, delete_queue_when_unused=False, manual_ack=False, add_events=False, confirm=False, prefetch=None):
+        """
+        Client starts consuming messages from queue, see "mqks.client.mqks.consume".
+        Messages are got with "async for msg in consumer".
+
+        @param queue: str
+        @param events: iterable(str)
+        @param delete_queue_when_unused: bool|float|int
+        @param manual_ack: bool
+        @param add_events: bool
+        @param confirm: bool
+        @param prefetch: int|None - With "manual_ack", server sends no more messages to this consumer while it has "prefetch" not-acked messages.
+        @return Consumer
+        """
+        events = ' '.join(events)  # To allow any iterable.
+        request = ''.join((
+            queue,
+            ' --add' if add_events else '',
+            ' ' + events if events else '',
+            '' if delete_queue_when_unused is False else ' --delete-queue-when-unused' + (
+                '' if delete_queue_when_unused is True else '={}'.format(delete_queue_when_unused)
+            ),
+            ' --manual-ack' if manual_ack else '',
+            ' --prefetch={}'.format(prefetch) if prefetch else '',
+        ))
+
+        consumer = Consumer(self, self._request_id(), self.get_worker(queue), request)
+        self._consumers[consumer.id] = consumer
+        await self._send(consumer.worker, consumer.id, 'consume', request.encode(), confirm=confirm)
+        return consumer
+
+    ### rebind
+
+    async def rebind(self, queue, replace=None, remove=None, add=None, remove_mask=None, confirm=False):
+        """
+        Replace subscriptions of the queue with new list of events, or remove some and add some other events, see "mqks.client.mqks.rebind".
+
+        @param queue: str
+        @param replace: list(str)|None
+        @param remove: list(str)|None
+        @param add: list(str)|None
+        @param remove_mask: list(str)|None
+        @param confirm: bool
+        @return request_id: str
+        """
+        assert replace or remove or add or remove_mask, (replace, remove, add, remove_mask)
+        events = list(replace or [])
+
+        for option, option_events in ('--remove', remove), ('--add', add), ('--remove-mask', remove_mask):
+            if option_events:
+                events.append(option)
+                events.extend(option_events)
+
+        return await self._send(self.get_worker(queue), self._request_id(), 'rebind', '{} {}'.format(queue, ' '.join(events)).encode(), confirm=confirm)
+
+    ### ack, reject
+
+    async def ack(self, consumer_id, msg_id, confirm=False):
+        """
+        @param consumer_id: str
+        @param msg_id: str
+        @param confirm: bool
+        @return request_id: str or None
+        """
+        return await self.ack_many(consumer_id, [msg_id], confirm=confirm)
+
+    async def ack_many(self, consumer_id, msg_ids, confirm=False):
+        """
+        @param consumer_id: str
+        @param msg_ids: list(str)
+        @param confirm: bool
+        @return request_id: str or None
+        """
+        return await self._send_to_consumer_worker(consumer_id, 'ack', msg_ids, confirm)
+
+    async def ack_all(self, consumer_id, confirm=False):
+        """
+        @param consumer_id: str
+        @param confirm: bool
+        @return request_id: str or None
+        """
+        return await self.ack_many(consumer_id, ['--all'], confirm=confirm)
+
+    async def reject(self, consumer_id, msg_id, confirm=False):
+        """
+        Reject this message - to return it to the queue with incremented "retry" counter.
+
+        @param consumer_id: str
+        @param msg_id: str
+        @param confirm: bool
+        @return request_id: str or None
+        """
+        return await self.reject_many(consumer_id, [msg_id], confirm=confirm)
+
+    async def reject_many(self, consumer_id, msg_ids, confirm=False):
+        """
+        @param consumer_id: str
+        @param msg_ids: list(str)
+        @param confirm: bool
+        @return request_id: str or None
+        """
+        return await self._send_to_consumer_worker(consumer_id, 'reject', msg_ids, confirm)
+
+    async def reject_all(self, consumer_id, confirm=False):
+        """
+        @param consumer_id: str
+        @param confirm: bool
+        @return request_id: str or None
+        """
+        return await self.reject_many(consumer_id, ['--all'], confirm=confirm)
+
+    async def _send_to_consumer_worker(self, consumer_id, action, msg_ids, confirm):
+        """
+        @param consumer_id: str
+        @param action: str - "ack" or "reject"
+        @param msg_ids: list(str)
+        @param confirm: bool
+        @return request_id: str or None - None if consumer is unknown, e.g. deleted
+        """
+        consumer = self._consumers.get(consumer_id)
+        if consumer:
+            return await self._send(consumer.worker, self._request_id(), action, '{} {}'.format(consumer_id, ' '.join(msg_ids)).encode(), confirm=confirm)
+
+    ### delete consumer
+
+    async def delete_consumer(self, consumer_id, confirm=False):
+        """
+        Delete the consumer. Client will not restart this consumer on reconnect.
+
+        @param consumer_id: str
+        @param confirm: bool
+        @return request_id: str or None
+        """
+        consumer = self._consumers.pop(consumer_id, None)
+        if consumer:
+            consumer._stop()
+            return await self._send(consumer.worker, self._request_id(), 'delete_consumer', consumer_id.encode(), confirm=confirm)
+
+    ### delete queue
+
+    async def delete_queue(self, queue, confirm=False):
+        """
+        @param queue: str
+        @param confirm: bool
+        @return request_id: str
+        """
+        return await self._send(self.get_worker(queue), self._request_id(), 'delete_queue', queue.encode(), confirm=confirm)
+
+    ### ping
+
+    async def ping(self, worker, data=None):
+        """
+        @param worker: int
+        @param data: str
+        @return request_id: str
+        """
+        return await self._send(worker, self._request_id(), 'ping', (data or self.config['logger_name']).encode())
+
+    async def _pinger(self, worker):
+        """
+        @param worker: int
+        """
+        while 1:
+            await asyncio.sleep(self.config['ping_seconds'] or 10)
+            if self.config['ping_seconds'] and self._links[worker].connected.is_set():
+                await self.ping(worker)
+
+    ### _eval
+
+    async def _eval(self, code, worker=0, timeout=None):
+        """
+        Backdoor to get any stats, see "stats.py".
+
+        @param code: str
+        @param worker: int
+        @param timeout: float|None - Max seconds to wait for result. Enables "asyncio.TimeoutError".
+        @return str - Result of successful code evaluation.
+        @raise Exception - Contains server-side "error_id".
+        """
+        eval_id = self._request_id()
+        eval_result = self._eval_results[eval_id] = asyncio.get_running_loop().create_future()
+        try:
+            await self._send(worker, eval_id, '_eval', code.encode())
+            return self._decode(await asyncio.wait_for(eval_result, timeout))
+        finally:
+            self._eval_results.pop(eval_id, None)
+
+    ### get worker
+
+    def get_worker(self, item):
+        """
+        Find out which worker serves this item, e.g. queue name.
+        Should match "mqks.client.mqks.get_worker" for the same "workers".
+
+        @param item: str
+        @return int
+        """
+        return self._ring.get_worker(item)
+
+    ### request id
+
+    def _request_id(self):
+        """
+        @return: str
+        """
+        return dtid(self.config['id_length'])
+
+    ### encode, decode
+
+    def _encode(self, data):
+        """
+        @param data: str|bytes
+        @return bytes
+        """
+        return data if isinstance(data, bytes) else data.encode(self.config['encoding'] or 'utf-8')
+
+    def _decode(self, data):
+        """
+        @param data: bytes
+        @return str|bytes - see "encoding"
+        """
+        return data.decode(self.config['encoding']) if self.config['encoding'] else data
+
+    ### _send
+
+    async def _send(self, worker, request_id, action, data, confirm=False):
+        """
+        Queue request for buffered batching write to worker.
+
+        @param worker: int
+        @param request_id: str
+        @param action: str
+        @param data: bytes
+        @param confirm: bool - wait for confirm
+        @return request_id: str
+        """
+        assert not self._is_closed, 'closed'
+        action_confirm = action + (' --confirm' if confirm else '')
+
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('#{} > w{}: {} {!r}'.format(request_id, worker, action_confirm, data))
+
+        link = self._get_link(worker)
+        if confirm:
+            confirm_future = self._confirms[request_id] = asyncio.get_running_loop().create_future()
+
+        try:
+            link.requests.append(b'%s %s %s\n' % (request_id.encode(), action_confirm.encode(), data))
+            link.has_requests.set()
+            if confirm:
+                await confirm_future
+        finally:
+            if confirm:
+                self._confirms.pop(request_id, None)
+
+        return request_id
+
+    ### link
+
+    def _get_link(self, worker):
+        """
+        Get link to worker, start its tasks if needed.
+
+        @param worker: int
+        @return _Link
+        """
+        link = self._links.get(worker)
+        if link is None:
+            link = self._links[worker] = _Link()
+            link.tasks = [asyncio.ensure_future(coro) for coro in (self._receiver(worker), self._sender(worker), self._pinger(worker))]
+        return link
+
+    ### _sender
+
+    async def _sender(self, worker):
+        """
+        Write all pending requests to worker, up to "requests_batch_bytes" at once.
+        Requests are deleted from the queue only when written, so they are sent again after reconnect.
+
+        @param worker: int
+        """
+        link = self._links[worker]
+        while 1:
+            await link.has_requests.wait()
+            await link.connected.wait()
+            if not link.requests:
+                link.has_requests.clear()
+                continue
+
+            batch = []
+            batch_bytes = 0
+            for request in link.requests:
+                batch_bytes += len(request)
+                if batch_bytes > self.config['requests_batch_bytes'] and batch:
+                    break
+                batch.append(request)
+
+            writer = link.writer
+            try:
+                writer.write(b''.join(batch))
+                await writer.drain()  # Flow control of asyncio.
+            except (ConnectionError, OSError) as e:
+                self.log.info('failed to send to w{}: {!r}'.format(worker, e))
+                writer.close()  # Receiver will reconnect.
+                await asyncio.sleep(self.config['reconnect_seconds'])
+                continue
+
+            for _ in batch:
+                link.requests.popleft()
+
+    ### _receiver
+
+    async def _receiver(self, worker):
+        """
+        Connect to worker, receive responses until disconnect, reconnect.
+
+        @param worker: int
+        """
+        link = self._links[worker]
+        host, _, port = self.config['workers'][worker].split(':')
+        is_reconnect = False
+
+        while worker < len(self.config['workers']):  # Removed worker is not reconnected, its consumers are moved already.
+            try:
+                self.log.info('connecting to w{}'.format(worker))
+                reader, link.writer = await asyncio.open_connection(host, int(port), limit=self.config['response_bytes_limit'])
+            except (ConnectionError, OSError) as e:
+                self.log.info('failed to connect to w{}: {!r}'.format(worker, e))
+                await asyncio.sleep(self.config['reconnect_seconds'])
+                continue
+
+            if is_reconnect:
+                self._reconsume(worker)
+            link.connected.set()
+
+            try:
+                while 1:
+                    response = await reader.readline()
+                    if not response:  # E.g. socket is broken.
+                        break
+                    await self._on_response(worker, response)
+            except (ConnectionError, OSError) as e:
+                self.log.info('disconnected from w{}: {!r}'.format(worker, e))
+            finally:
+                link.connected.clear()
+                link.writer.close()
+
+            is_reconnect = True
+            await asyncio.sleep(self.config['reconnect_seconds'])
+
+        del self._links[worker]
+        for task in link.tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+
+    ### _reconsume
+
+    def _reconsume(self, worker):
+        """
+        Request consume again with new consumer_ids, on reconnect.
+        Server deleted old consumers and rejected their not-acked messages on disconnect.
+
+        @param worker: int
+        """
+        link = self._links[worker]
+        for consumer in list(self._consumers.values()):
+            if consumer.worker == worker:
+                del self._consumers[consumer.id]
+                consumer.id = self._request_id()
+                self._consumers[consumer.id] = consumer
+                link.requests.appendleft(b'%s consume %s\n' % (consumer.id.encode(), consumer.request.encode()))  # Before any pending acks.
+
+    async def _move_consumer(self, old_consumer_id, is_ring_changed):
+        """
+        Consume again at new worker of queue, on "--moved" response, see "mqks.server.lib.migration".
+        Pending confirm of old consume is set by confirm of new one.
+
+        @param old_consumer_id: str
+        @param is_ring_changed: bool - if not, old worker of queue has not moved it yet, so wait a bit
+        """
+        if not is_ring_changed:
+            await asyncio.sleep(self.config['reconnect_seconds'])
+
+        consumer = self._consumers.pop(old_consumer_id, None)
+        if consumer is None:
+            return  # Deleted meanwhile.
+
+        consumer.id = self._request_id()
+        consumer.worker = self.get_worker(consumer.request.split(' ', 1)[0])
+        self._consumers[consumer.id] = consumer
+        old_confirm = self._confirms.get(old_consumer_id)
+
+        try:
+            await self._send(consumer.worker, consumer.id, 'consume', consumer.request.encode(), confirm=old_confirm is not None)
+        except Exception as e:
+            if old_confirm is not None and not old_confirm.done():
+                old_confirm.set_exception(e)
+            else:
+                self.log.exception('failed to move consumer {}'.format(old_consumer_id))
+        else:
+            if old_confirm is not None and not old_confirm.done():
+                old_confirm.set_result(None)
+
+    ### _on_response
+
+    async def _on_response(self, worker, response):
+        """
+        @param worker: int
+        @param response: bytes
+        """
+        try:
+            request_id, response_type, data = response.rstrip(b'\r\n').split(b' ', 2)  # Not trailing space in "ok " confirm.
+            request_id = request_id.decode()
+
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug('#{} < w{}: {} {!r}'.format(request_id, worker, response_type.decode(), data))
+
+            ### error
+
+            if response_type == b'error':
+                error = Exception(response.decode(errors='replace').rstrip())
+                future = self._eval_results.get(request_id) or self._confirms.get(request_id)
+                if future and not future.done():
+                    future.set_exception(error)
+                    return
+                raise error
+
+            ### moved
+
+            if data.startswith(MOVED):
+                workers, pins = parse_placement(data[len(MOVED):].decode())
+                is_ring_changed = workers != self.config['workers'] or pins != self.config['ring_pins']
+                if is_ring_changed:
+                    self.config.update(workers=workers, ring_pins=pins)
+                    self._ring = Ring(workers, self.config['ring_vnodes'], self.config['ring_hash'], pins)
+                if request_id in self._consumers:
+                    asyncio.ensure_future(self._move_consumer(request_id, is_ring_changed))
+                return
+
+            ### confirm
+
+            if data == b'':
+                future = self._confirms.get(request_id)
+                if future and not future.done():
+                    future.set_result(None)
+                return
+
+            ### consume
+
+            consumer = self._consumers.get(request_id)
+            if consumer:
+                if data.startswith(b'--update '):
+                    consumer.request = data.decode().split(' ', 1)[1]
+                    return
+
+                msg_id, props, data = data.split(b' ', 2)
+                if ESCAPED in props:  # "event=" is always the first prop.
+                    props = props.replace(ESCAPED, b'')
+                    data = unescape(data)
+                msg = Msg(id=msg_id.decode(), data=self._decode(data))
+                for prop in props.decode().split(','):
+                    name, value = prop.split('=', 1)
+                    msg[name] = value
+                msg._client = self
+                msg._consumer_id = consumer.id
+
+                await consumer._msgs.put(msg)  # Blocks reading from worker while consumer is full.
+                return
+
+            ### eval result
+
+            future = self._eval_results.get(request_id)
+            if future and not future.done():
+                future.set_result(data)
+
+        except Exception:
+            self.log.exception('w{}: failed to handle response {!r}'.format(worker, response))
+
+### _Link
+
+class _Link:
+    """
+    State of connection to one worker.
+    """
+
+    def __init__(self):
+        self.requests = deque()             # deque(request: bytes) - pending, deleted when written
+        self.has_requests = asyncio.Event()
+        self.connected = asyncio.Event()
+        self.writer = None                  # asyncio.StreamWriter|None
+        self.tasks = []                     # list(asyncio.Task)
+
+### Consumer
+
+class Consumer:
+    """
+    Async iterator of messages: "async for msg in consumer".
+    Its "id" changes on reconnect and on "--moved" response, like "on_reconnect" of "mqks.client.mqks.consume" reports.
+    """
+
+    def __init__(self, client, consumer_id, worker, request):
+        """
+        @param client: Client
+        @param consumer_id: str
+        @param worker: int
+        @param request: str - data of "consume" request, updated by server
+        """
+        self.client = client
+        self.id = consumer_id
+        self.worker = worker
+        self.request = request
+        self._msgs = asyncio.Queue(client.config['consumer_queue_size'])
+        self._is_stopped = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._is_stopped:
+            raise StopAsyncIteration
+        msg = await self._msgs.get()
+        if msg is None:
+            raise StopAsyncIteration
+        return msg
+
+    async def delete(self, confirm=False):
+        """
+        Delete this consumer, stop iteration.
+
+        @param confirm: bool
+        """
+        await self.client.delete_consumer(self.id, confirm=confirm)
+
+    def _stop(self):
+        self._is_stopped = True
+        if not self._msgs.full():
+            self._msgs.put_nowait(None)  # Wake up iteration.
+
+### Msg
+
+class Msg(dict):
+    """
+    Message: dict of "id", "data" and props like "event", "retry", with coroutine methods "ack" and "reject".
+    """
+
+    __slots__ = ('_client', '_consumer_id')
+
+    async def ack(self, confirm=False):
+        """
+        @param confirm: bool
+        @return request_id: str or None
+        """
+        return await self._client.ack(self._consumer_id, self['id'], confirm=confirm)
+
+    async def reject(self, confirm=False):
+        """
+        @param confirm: bool
+        @return request_id: str or None
+        """
+        return await self._client.reject(self._consumer_id, self['id'], confirm=confirm)
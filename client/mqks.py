@@ -4,15 +4,27 @@ Client of "mqks" - Message Queue Kept Simple.
 
 ### import
 
+from __future__ import absolute_import  # "mqks.sharding", not this "mqks" module.
 from critbot import crit
 from functools import partial
-from gevent import socket, spawn
-from gevent.event import AsyncResult, Event
+from gevent import GreenletExit, getcurrent, socket, spawn, spawn_later
+from gevent.event import AsyncResult
+from gevent.pool import Pool
 from gevent.queue import Queue, Empty
 import logging
 import random
+from struct import Struct
 import time
 from uqid import dtid
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from mqks.escape import unescape
+from mqks.sharding import Ring, get_partitions, parse_placement
 
 ### config
 
@@ -21,13 +33,49 @@ config = dict(
         '127.0.0.1:24000:25000',
         '127.0.0.1:24001:25001',
     ],
+    ring_vnodes=0,                          # Should be exactly the same as mqks.server.config['ring_vnodes']
+    ring_hash='crc32',                      # Should be exactly the same as mqks.server.config['ring_hash']
+    ring_pins={},                           # Should be exactly the same as mqks.server.config['ring_pins'], updated on "--moved" response.
     logger_name='mqks.client',              # Change to logger_name you configured in your service.
     ping_seconds=15,                        # Ping each connected worker each N seconds to detect disconnect.
     reconnect_seconds=1,                    # How many seconds to wait on disconnect before trying to reconnect.
     id_length=24,                           # Length of random ID. More bytes = more secure = more slow.
+    publish_many_bytes=64*1024,             # Max bytes of messages in one "publish_many" request. Bigger batch is split to many requests.
+    requests_batch_bytes=64*1024,           # Max bytes of pending requests coalesced into one "sendall" to worker. Single bigger request is sent alone.
+    ack_batch_count=0,                      # Buffer acks of each consumer and send them with one request each N acks. 0 = send each ack at once.
+    ack_batch_seconds=0.05,                 # Send buffered acks after N seconds, if "ack_batch_count" is not reached yet.
+    protocol=1,                             # 2 = length-prefixed binary frames, data may contain any bytes. Change before connect().
+    compress_bytes=0,                       # With "protocol" 2, compress data of published messages that is N bytes or bigger. 0 = disabled.
+    compress_codec='zlib',                  # Or "lz4" if "lz4" package is installed here and at server.
+    compress_level=1,                       # Level of "zlib": 1 = fastest, 9 = smallest.
 )
 
 WORKERS = 0  # Updated on connect()
+RING = None  # Updated on connect() and on "--moved" response, see "get_worker"
+
+### const
+
+MOVED = '--moved '  # Response when ring of workers is changed, see "mqks.server.lib.migration".
+ESCAPED = ',esc=1'  # Prop of message with data escaped for "protocol v1", see "mqks.server.lib.clients.escape_msg".
+
+# "protocol v2", see "spec.txt" and "mqks.server.lib.clients":
+V2_MAGIC = 'MQKS2\n'
+V2_REQUEST_HEADER = Struct('!BBHII')    # action_code, flags, id_length, args_length, payload_length
+V2_RESPONSE_HEADER = Struct('!BHI')     # response_code, id_length, data_length
+V2_CONFIRM = 1
+V2_PAYLOAD = 2
+V2_ERROR = 1
+
+# Append only, the same list is in "mqks.server.lib.clients":
+V2_ACTIONS = ['ping', 'publish', 'publish_many', 'consume', 'rebind', 'ack', 'reject', 'delete_consumer', 'delete_queue', '_eval']
+V2_ACTION_CODES = dict((action, action_code) for action_code, action in enumerate(V2_ACTIONS))
+
+# Compression, see "mqks.server.lib.compression":
+CODECS = dict(  # CODECS[codec: str] == tuple(compress: callable(data: str) -> str, decompress: callable(data: str) -> str)
+    zlib=(lambda data: zlib.compress(data, config['compress_level']), zlib.decompress),
+)
+if lz4:
+    CODECS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
 
 ### state
 
@@ -42,10 +90,18 @@ def init_state():
     state['consumers'] = {}                 # state['consumers'][worker: int][consumer_id: str] == consumer: str
     state['workers'] = {}                   # state['workers'][consumer_id: str] == worker: int
     state['on_msg'] = {}                    # state['on_msg'][consumer_id: str] == on_msg: callable(msg: dict)
+    state['dispatchers'] = {}               # state['dispatchers'][consumer_id: str] == dispatch: callable(msg: dict) - bounded, see "concurrency" of "consume"
     state['on_disconnect'] = {}             # state['on_disconnect'][consumer_id: str] == on_disconnect: callable()
     state['on_reconnect'] = {}              # state['on_reconnect'][consumer_id: str] == on_reconnect: callable(old_consumer_id: str, new_consumer_id: str)
-    state['confirms'] = {}                  # state['confirms'][request_id: str] == confirm_event: gevent.event.Event
+    state['confirms'] = {}                  # state['confirms'][request_id: str] == Confirm
     state['eval_results'] = {}              # state['eval_results'][request_id: str] == eval_result: gevent.event.AsyncResult
+    state['acks'] = {}                      # state['acks'][consumer_id: str] == msg_ids: list(str) - buffered, see "ack_batch_count"
+    state['partition_consumers'] = {}       # state['partition_consumers'][consumer_id: str] == [partition_consumer_id: str] - see "partitions" of "consume"
+    state['partitioned_consumers'] = {}     # state['partitioned_consumers'][partition_consumer_id: str] == consumer_id: str
+    state['requests_sent'] = 0              # int
+    state['requests_flushes'] = 0           # int - number of "sendall" of coalesced requests, requests_sent / requests_flushes == average batch size
+    state['compressed'] = 0                 # int - published messages compressed by this client, see "compress_bytes"
+    state['compressed_bytes_saved'] = 0     # int - original minus compressed bytes of these messages
     state['auto_reconnect'] = False         # bool, enabled on manual connect()
 
 init_state()
@@ -59,8 +115,7 @@ def connect(worker=None, old_sock=None):
     @param worker: int|None
     @param old_sock: gevent._socket2.socket|None - For atomic CAS.
     """
-    global WORKERS
-    WORKERS = len(config['workers'])
+    _update_ring()
     state['auto_reconnect'] = True
 
     if worker is None:
@@ -77,6 +132,11 @@ def connect(worker=None, old_sock=None):
             sock = socket.socket()
             sock.connect((host, port))
 
+            if config['protocol'] == 2:
+                sock.sendall(V2_MAGIC)
+                magic = _recv_exactly(sock, len(V2_MAGIC))
+                assert magic == V2_MAGIC, magic  # E.g. old server without "protocol v2".
+
             if state['socks'].get(worker) is old_sock:  # Greenlet-atomic CAS.
                 state['socks'][worker] = sock
             else:
@@ -107,6 +167,25 @@ def connect(worker=None, old_sock=None):
             crit(also=worker)
             time.sleep(config['reconnect_seconds'])
 
+### _recv_exactly
+
+def _recv_exactly(sock, length):
+    """
+    Receive exactly "length" bytes from sock.
+
+    @param sock: gevent._socket2.socket
+    @param length: int
+    @return str
+    """
+    chunks = []
+    while length:
+        chunk = sock.recv(length)
+        if not chunk:
+            raise socket.error('disconnected')
+        chunks.append(chunk)
+        length -= len(chunk)
+    return ''.join(chunks)
+
 ### _on_disconnect
 
 def _on_disconnect(worker, e, old_sock):
@@ -120,6 +199,18 @@ def _on_disconnect(worker, e, old_sock):
     if config['_log'].level == logging.DEBUG:
         config['_log'].debug('disconnected from w{}: {}'.format(worker, e))
 
+    if worker >= len(config['workers']):  # Removed by migration, its consumers are moved already.
+        for greenlet_name in 'pingers', 'receivers', 'senders':
+            greenlet = state[greenlet_name].pop(worker, None)
+            if greenlet and greenlet is not getcurrent():
+                greenlet.kill(block=False)
+        for state_name in 'requests', 'consumers':
+            state[state_name].pop(worker, None)
+        sock = state['socks'].pop(worker, None)
+        if sock:
+            sock.close()
+        raise GreenletExit  # Stop "_receiver" or "_sender" calling this function.
+
     for consumer_id in state['consumers'][worker].keys():
         on_disconnect = state['on_disconnect'].get(consumer_id)
         if on_disconnect:
@@ -144,33 +235,86 @@ def _reconsume(worker):
 
     consumers = state['consumers'][worker]
     for old_consumer_id, consumer in consumers.items():
-        new_consumer_id = _request_id()
+        new_consumer_id = _renew_consumer(old_consumer_id, worker)
         consumers.pop(old_consumer_id, None)
         consumers[new_consumer_id] = consumer
 
-        state['workers'].pop(old_consumer_id, None)
-        state['workers'][new_consumer_id] = worker
+        # No need to update old "consumer_id" bound into "msg.ack()" and "msg.reject()":
+        # when client disconnects from server, server deletes old consumer and rejects all msgs.
 
-        on_reconnect = state['on_reconnect'].pop(old_consumer_id, None)
-        if on_reconnect:
-            state['on_reconnect'][new_consumer_id] = on_reconnect
-            try:
-                on_reconnect(old_consumer_id, new_consumer_id)
-            except Exception:
-                crit(also=dict(old_consumer_id=old_consumer_id, new_consumer_id=new_consumer_id))
+        _send(worker, new_consumer_id, 'consume', consumer)
 
-        on_disconnect = state['on_disconnect'].pop(old_consumer_id, None)
-        if on_disconnect:
-            state['on_disconnect'][new_consumer_id] = on_disconnect
+def _renew_consumer(old_consumer_id, worker):
+    """
+    Move callbacks of consumer to new consumer_id.
 
-        on_msg = state['on_msg'].pop(old_consumer_id, None)
-        if on_msg:
-            state['on_msg'][new_consumer_id] = on_msg
+    @param old_consumer_id: str
+    @param worker: int
+    @return new_consumer_id: str
+    """
+    new_consumer_id = _request_id()
 
-        # No need to update old "consumer_id" partial-bound into "msg.ack()" and "msg.reject()":
-        # when client disconnects from server, server deletes old consumer and rejects all msgs.
+    state['workers'].pop(old_consumer_id, None)
+    state['workers'][new_consumer_id] = worker
 
-        _send(worker, new_consumer_id, 'consume', consumer)
+    on_reconnect = state['on_reconnect'].pop(old_consumer_id, None)
+    if on_reconnect:
+        state['on_reconnect'][new_consumer_id] = on_reconnect
+        try:
+            on_reconnect(old_consumer_id, new_consumer_id)
+        except Exception:
+            crit(also=dict(old_consumer_id=old_consumer_id, new_consumer_id=new_consumer_id))
+
+    on_disconnect = state['on_disconnect'].pop(old_consumer_id, None)
+    if on_disconnect:
+        state['on_disconnect'][new_consumer_id] = on_disconnect
+
+    on_msg = state['on_msg'].pop(old_consumer_id, None)
+    if on_msg:
+        state['on_msg'][new_consumer_id] = on_msg
+
+    dispatch = state['dispatchers'].pop(old_consumer_id, None)
+    if dispatch:
+        state['dispatchers'][new_consumer_id] = dispatch
+
+    consumer_id = state['partitioned_consumers'].pop(old_consumer_id, None)
+    if consumer_id:
+        state['partitioned_consumers'][new_consumer_id] = consumer_id
+        partition_consumer_ids = state['partition_consumers'][consumer_id]
+        partition_consumer_ids[partition_consumer_ids.index(old_consumer_id)] = new_consumer_id
+
+    return new_consumer_id
+
+### _move_consumer
+
+def _move_consumer(old_consumer_id, is_ring_changed):
+    """
+    Consume again at new worker of queue, on "--moved" response, see "mqks.server.lib.migration".
+    Pending confirm of old consume is resolved by confirm of new one.
+
+    @param old_consumer_id: str
+    @param is_ring_changed: bool - if not, old worker of queue has not moved it yet, so wait a bit
+    """
+    try:
+        if not is_ring_changed:
+            time.sleep(config['reconnect_seconds'])
+
+        old_worker = state['workers'].get(old_consumer_id)
+        consumer = state['consumers'].get(old_worker, {}).pop(old_consumer_id, None)
+        if consumer is None:
+            return  # Deleted meanwhile.
+
+        worker = get_worker(consumer.split(' ', 1)[0])
+        new_consumer_id = _renew_consumer(old_consumer_id, worker)
+        old_confirm = state['confirms'].pop(old_consumer_id, None)
+        confirm = _send(worker, new_consumer_id, 'consume', consumer, confirm=old_confirm is not None, wait=False)
+        state['consumers'][worker][new_consumer_id] = consumer
+
+        if old_confirm is not None:
+            confirm.rawlink(lambda result: old_confirm.set(old_confirm.request_id) if result.successful() else old_confirm.set_exception(result.exception))
+
+    except Exception:
+        crit(also=dict(old_consumer_id=old_consumer_id))
 
 ### disconnect
 
@@ -202,7 +346,7 @@ def disconnect():
 
 ### publish
 
-def publish(event, data, confirm=False):
+def publish(event, data, confirm=False, partition_key=None):
     """
     Client publishes new message to server.
     Server puts copies of this message to zero or more queues that were subscribed to this event.
@@ -210,13 +354,93 @@ def publish(event, data, confirm=False):
     @param event: str
     @param data: str
     @param confirm: bool
+    @param partition_key: str|None - Messages with the same key go to the same partition of each partitioned queue, in order.
+        Else partitions get messages round-robin. See "partitions" of "consume".
     @return msg_id: str
     """
-    return _send(get_worker(event), _request_id(), 'publish', '{} {}'.format(event, data), confirm=confirm)
+    codec, data = _compress(data)
+    return _send(get_worker(event), _request_id(), 'publish', _get_options(codec, partition_key) + event if codec or partition_key else event, confirm=confirm, payload=data)
+
+### publish async
+
+def publish_async(event, data, partition_key=None):
+    """
+    Client publishes new message to server and does not wait for its confirm,
+    so many confirmed publishes may be in flight at once, instead of one round trip per message.
+
+    Usage:
+        confirms = [mqks.publish_async(event, data) for event, data in events_and_data]
+        errors = mqks.wait_confirms(confirms, timeout=10)
+
+    @param event: str
+    @param data: str
+    @param partition_key: str|None - see "publish"
+    @return Confirm - its "request_id" is "msg_id"
+    """
+    codec, data = _compress(data)
+    return _send(get_worker(event), _request_id(), 'publish', _get_options(codec, partition_key) + event if codec or partition_key else event, confirm=True, payload=data, wait=False)
+
+def _get_options(codec, partition_key):
+    """
+    Options of published message.
+
+    @param codec: str|None
+    @param partition_key: str|None
+    @return str - each option is followed by space
+    """
+    return ''.join((
+        '--z={} '.format(codec) if codec else '',
+        '--key={} '.format(partition_key) if partition_key else '',
+    ))
+
+### publish many
+
+def publish_many(events_and_data, confirm=False):
+    """
+    Client publishes many messages with one request per worker of events, instead of one request per message.
+    Server puts copies of these messages to queues with one command per worker of queues.
+
+    @param events_and_data: iterable(tuple(event: str, data: str[, partition_key: str])) - see "partition_key" of "publish"
+    @param confirm: bool
+    @return list(msg_id: str) - in the same order as "events_and_data"
+    """
+    msg_ids = []
+    batches = {}  # batches[worker: int] == tuple(request_id: str, pairs: list(str), pairs_bytes: int)
+    confirms = []
+
+    for event_and_data in events_and_data:
+        event, data = event_and_data[:2]
+        partition_key = event_and_data[2] if len(event_and_data) > 2 else None
+        worker = get_worker(event)
+        batch = batches.get(worker)
+        codec, data = _compress(data)
+        pair = '{}{} {} {}'.format(_get_options(codec, partition_key), event, len(data), data)
+
+        if batch and batch[2] + len(pair) > config['publish_many_bytes']:
+            confirms.append(_send(worker, batch[0], 'publish_many', '', confirm=confirm, payload=' '.join(batch[1]), wait=False))
+            batch = None
+
+        if not batch:
+            batch = (_request_id(), [], 0)
+
+        request_id, pairs, pairs_bytes = batch
+        msg_ids.append('{}.{}'.format(request_id, len(pairs)))  # See "msg_id" in server "publish_many".
+        pairs.append(pair)
+        batches[worker] = (request_id, pairs, pairs_bytes + len(pair) + 1)
+
+    for worker, (request_id, pairs, _) in batches.iteritems():
+        confirms.append(_send(worker, request_id, 'publish_many', '', confirm=confirm, payload=' '.join(pairs), wait=False))
+
+    if confirm:  # All requests are in flight at once, instead of one round trip per request.
+        for confirm_result in confirms:
+            confirm_result.get()
+
+    return msg_ids
 
 ### consume
 
-def consume(queue, events, on_msg, on_disconnect=None, on_reconnect=None, delete_queue_when_unused=False, manual_ack=False, add_events=False, confirm=False):
+def consume(queue, events, on_msg, on_disconnect=None, on_reconnect=None, delete_queue_when_unused=False, manual_ack=False, add_events=False, confirm=False, prefetch=None, compressed=False, concurrency=None,
+        partitions=None, partition=False):
     """
     Client starts consuming messages from queue.
     May replace subscriptions of the queue (if any) with new list of events.
@@ -237,13 +461,40 @@ def consume(queue, events, on_msg, on_disconnect=None, on_reconnect=None, delete
     @param manual_ack: bool
     @param add_events: bool
     @param confirm: bool
+    @param prefetch: int|None - With "manual_ack", server sends no more messages to this consumer while it has "prefetch" not-acked messages.
+    @param compressed: bool - With "protocol" 2, server sends compressed data as is, and it is decompressed here before "on_msg".
+    @param concurrency: int|None -
+        None - Call "on_msg" in a new greenlet for each message, not bounded.
+        1 - Call "on_msg" for one message at a time, in order.
+        5 - Call "on_msg" for at most 5 messages at a time, using a pool of greenlets.
+        When bounded "on_msg" is busy, client stops reading responses from the worker of the queue,
+        so server gets backpressure via TCP. Avoid waiting for "confirm" from the same worker inside such "on_msg".
+    @param partitions: int|None - Spread the queue over N queues "{queue}#{index}" on different workers, see "mqks.sharding.get_partitions":
+        each message goes to one of them only, see "partition_key" of "publish".
+        The same number should be used by all consumers of the queue, and in "rebind" and "delete_queue".
+        All other args are applied to each partition, e.g. "concurrency" and "on_reconnect".
+        Messages have consumer_id of their partition, other functions accept both.
+    @param partition: bool - The queue is one of "partitions", server registers it as such: "{queue}#{index}" without it is a usual queue.
     @return consumer_id: str
     """
+    assert not compressed or config['protocol'] == 2, 'compressed data is binary'
 
     consumer_id = _request_id()
 
+    if partitions:
+        events = list(events)  # To allow any iterable.
+        partition_consumer_ids = state['partition_consumers'][consumer_id] = []
+        for partition in get_partitions(queue, partitions):
+            partition_consumer_id = consume(partition, events, on_msg, on_disconnect, on_reconnect, delete_queue_when_unused, manual_ack, add_events, confirm, prefetch, compressed, concurrency, partition=True)
+            state['partitioned_consumers'][partition_consumer_id] = consumer_id
+            partition_consumer_ids.append(partition_consumer_id)
+        return consumer_id
+
     state['on_msg'][consumer_id] = on_msg
 
+    if concurrency:
+        state['dispatchers'][consumer_id] = _get_dispatcher(on_msg, concurrency)
+
     if on_disconnect:
         state['on_disconnect'][consumer_id] = on_disconnect
 
@@ -260,6 +511,9 @@ def consume(queue, events, on_msg, on_disconnect=None, on_reconnect=None, delete
             '' if delete_queue_when_unused is True else '={}'.format(delete_queue_when_unused)
         ),
         ' --manual-ack' if manual_ack else '',
+        ' --prefetch={}'.format(prefetch) if prefetch else '',
+        ' --compressed' if compressed else '',
+        ' --partition' if partition else '',
     ))
 
     state['workers'][consumer_id] = worker = get_worker(queue)
@@ -267,16 +521,22 @@ def consume(queue, events, on_msg, on_disconnect=None, on_reconnect=None, delete
     # Worker-indexed state['consumers'] is created after first "_send() -> connect(worker)",
     # and should not be created before - to avoid "_reconsume()".
 
-    _send(worker, consumer_id, 'consume', consumer, confirm=confirm)
+    confirm_result = _send(worker, consumer_id, 'consume', consumer, confirm=confirm, wait=False)
 
     if not add_events:  # Don't overwrite result of "update consumer" flow.
         state['consumers'][worker][consumer_id] = consumer
 
+    if confirm:  # After consumer is saved, to follow "--moved" response, see "_move_consumer".
+        try:
+            confirm_result.get()
+        finally:
+            state['confirms'].pop(consumer_id, None)
+
     return consumer_id
 
 ### rebind
 
-def rebind(queue, replace=None, remove=None, add=None, remove_mask=None, confirm=False):
+def rebind(queue, replace=None, remove=None, add=None, remove_mask=None, confirm=False, partitions=None):
     """
     Replace subscriptions of the queue with new list of events, or remove some and add some other events.
     TODO: On next incompatible change, move "remove_mask" right after "remove" - to match docs and execution order at server.
@@ -287,7 +547,8 @@ def rebind(queue, replace=None, remove=None, add=None, remove_mask=None, confirm
     @param add: list(str)|None - Add some events to subscriptions of this queue.
     @param remove_mask: list(str)|None - Remove some events from subscriptions of this queue by event mask like "e1.*.a1".
     @param confirm: bool
-    @return request_id: str
+    @param partitions: int|None - Rebind all partitions of the queue, see "consume".
+    @return request_id: str - of the last partition, if any
     """
 
     assert replace or remove or add or remove_mask, (replace, remove, add, remove_mask)
@@ -305,22 +566,69 @@ def rebind(queue, replace=None, remove=None, add=None, remove_mask=None, confirm
         events.append('--remove-mask')
         events.extend(remove_mask)
 
-    return _send(get_worker(queue), _request_id(), 'rebind', '{} {}'.format(queue, ' '.join(events)), confirm=confirm)
+    events = ' '.join(events)
+    request_id = None
+    for queue in get_partitions(queue, partitions) if partitions else [queue]:
+        request_id = _send(get_worker(queue), _request_id(), 'rebind', '{} {}'.format(queue, events), confirm=confirm)
+    return request_id
 
 ### ack
 
 def ack(consumer_id, msg_id, confirm=False):
     """
     Acknowledge this message was processed by this consumer.
+    If "ack_batch_count" is set, ack without "confirm" is buffered and sent later by "flush_acks".
 
     @param consumer_id: str
     @param msg_id: str
     @param confirm: bool
     @return request_id: str or None
     """
+    if config['ack_batch_count'] and not confirm:
+        msg_ids = state['acks'].get(consumer_id)
+        if msg_ids is None:
+            msg_ids = state['acks'][consumer_id] = []
+            spawn_later(config['ack_batch_seconds'], flush_acks, consumer_id)
+        msg_ids.append(msg_id)
+        if len(msg_ids) >= config['ack_batch_count']:
+            return flush_acks(consumer_id)
+        return
+
+    return ack_many(consumer_id, [msg_id], confirm=confirm)
+
+### ack many
+
+def ack_many(consumer_id, msg_ids, confirm=False):
+    """
+    Acknowledge these messages were processed by this consumer, with one request.
+
+    @param consumer_id: str
+    @param msg_ids: iterable(str)
+    @param confirm: bool
+    @return request_id: str or None
+    """
     worker = state['workers'].get(consumer_id)
     if worker is not None:
-        return _send(worker, _request_id(), 'ack', '{} {}'.format(consumer_id, msg_id), confirm=confirm)
+        return _send(worker, _request_id(), 'ack', '{} {}'.format(consumer_id, ' '.join(msg_ids)), confirm=confirm)
+
+### flush acks
+
+def flush_acks(consumer_id=None):
+    """
+    Send acks buffered by "ack" now.
+
+    @param consumer_id: str|None - Flush acks of this consumer only. All by default.
+    @return request_id: str or None - of the last request
+    """
+    request_id = None
+    for consumer_id in [consumer_id] if consumer_id else state['acks'].keys():
+        msg_ids = state['acks'].pop(consumer_id, None)
+        if msg_ids:
+            try:
+                request_id = ack_many(consumer_id, msg_ids)
+            except Exception:
+                crit(also=dict(consumer_id=consumer_id))
+    return request_id
 
 ### ack all
 
@@ -332,7 +640,11 @@ def ack_all(consumer_id, confirm=False):
     @param confirm: bool
     @return request_id: str or None
     """
-    return ack(consumer_id, '--all', confirm=confirm)
+    if consumer_id in state['partition_consumers']:
+        return _for_partitions(ack_all, consumer_id, confirm)
+
+    state['acks'].pop(consumer_id, None)  # Included.
+    return ack_many(consumer_id, ['--all'], confirm=confirm)
 
 ### reject
 
@@ -345,9 +657,22 @@ def reject(consumer_id, msg_id, confirm=False):
     @param confirm: bool
     @return request_id: str or None
     """
+    return reject_many(consumer_id, [msg_id], confirm=confirm)
+
+### reject many
+
+def reject_many(consumer_id, msg_ids, confirm=False):
+    """
+    Reject these messages with one request - to return them to the queue in this order, with incremented "retry" counter.
+
+    @param consumer_id: str
+    @param msg_ids: iterable(str)
+    @param confirm: bool
+    @return request_id: str or None
+    """
     worker = state['workers'].get(consumer_id)
     if worker is not None:
-        return _send(worker, _request_id(), 'reject', '{} {}'.format(consumer_id, msg_id), confirm=confirm)
+        return _send(worker, _request_id(), 'reject', '{} {}'.format(consumer_id, ' '.join(msg_ids)), confirm=confirm)
 
 ### reject all
 
@@ -359,6 +684,10 @@ def reject_all(consumer_id, confirm=False):
     @param confirm: bool
     @return request_id: str or None
     """
+    if consumer_id in state['partition_consumers']:
+        return _for_partitions(reject_all, consumer_id, confirm)
+
+    flush_acks(consumer_id)  # Else they would be rejected too.
     return reject(consumer_id, '--all', confirm=confirm)
 
 ### delete consumer
@@ -371,31 +700,58 @@ def delete_consumer(consumer_id, confirm=False):
 
     @param consumer_id: str
     @param confirm: bool
-    @return request_id: str
+    @return request_id: str - of the last partition, if any
     """
+    if consumer_id in state['partition_consumers']:
+        request_id = _for_partitions(delete_consumer, consumer_id, confirm)
+        state['partition_consumers'].pop(consumer_id, None)
+        return request_id
+
+    flush_acks(consumer_id)  # Else server would reject them.
+
     worker = state['workers'].pop(consumer_id, None)
     if worker is None:
         return
 
     state['consumers'][worker].pop(consumer_id, None)
     state['on_msg'].pop(consumer_id, None)
+    state['dispatchers'].pop(consumer_id, None)  # Messages already dispatched are processed.
     state['on_disconnect'].pop(consumer_id, None)
     state['on_reconnect'].pop(consumer_id, None)
+    state['partitioned_consumers'].pop(consumer_id, None)
 
     return _send(worker, _request_id(), 'delete_consumer', consumer_id, confirm=confirm)
 
+def _for_partitions(func, consumer_id, confirm):
+    """
+    Call function for each partition consumer of consumer with "partitions", see "consume".
+
+    @param func: callable(consumer_id: str, confirm: bool) -> request_id: str or None
+    @param consumer_id: str
+    @param confirm: bool
+    @return request_id: str or None - of the last partition
+    """
+    request_id = None
+    for partition_consumer_id in list(state['partition_consumers'].get(consumer_id, ())):
+        request_id = func(partition_consumer_id, confirm=confirm)
+    return request_id
+
 ### delete queue
 
-def delete_queue(queue, confirm=False):
+def delete_queue(queue, confirm=False, partitions=None):
     """
     Delete the queue instantly.
     Server will not copy messages to this queue any more.
 
     @param queue: str
     @param confirm: bool
-    @return request_id: str
+    @param partitions: int|None - Delete all partitions of the queue, see "consume".
+    @return request_id: str - of the last partition, if any
     """
-    return _send(get_worker(queue), _request_id(), 'delete_queue', queue, confirm=confirm)
+    request_id = None
+    for queue in get_partitions(queue, partitions) if partitions else [queue]:
+        request_id = _send(get_worker(queue), _request_id(), 'delete_queue', queue, confirm=confirm)
+    return request_id
 
 ### ping
 
@@ -444,6 +800,27 @@ def _eval(code, worker=0, timeout=None):
     _send(worker, eval_id, '_eval', code)
     return eval_result.get(timeout=timeout)
 
+### _compress
+
+def _compress(data):
+    """
+    Compress data of new message, if it is big enough and compression helps.
+
+    @param data: str
+    @return tuple(codec: str|None, data: str)
+    """
+    if not config['compress_bytes'] or len(data) < config['compress_bytes'] or config['protocol'] != 2:
+        return None, data
+
+    codec = config['compress_codec']
+    compressed = CODECS[codec][0](data)
+    if len(compressed) >= len(data):
+        return None, data
+
+    state['compressed'] += 1
+    state['compressed_bytes_saved'] += len(data) - len(compressed)
+    return codec, compressed
+
 ### request id
 
 def _request_id():
@@ -456,16 +833,19 @@ def _request_id():
 
 ### _send
 
-def _send(worker, request_id, action, data, confirm=False):
+def _send(worker, request_id, action, data, confirm=False, payload=None, wait=True):
     """
     Send request
 
     @param worker: int
     @param request_id: str
     @param action: str
-    @param data: str
+    @param data: str - args of action, or whole data if there is no payload
     @param confirm: bool
-    @return request_id: str
+    @param payload: str|None - arbitrary bytes appended to data after a space, if data is not empty
+    @param wait: bool - wait for confirm, if any
+    @return request_id: str, or Confirm if "confirm" and not "wait"
+    @raise ConfirmError - if "confirm" and "wait", and server responded with error
     """
 
     if worker not in state['socks']:
@@ -474,26 +854,90 @@ def _send(worker, request_id, action, data, confirm=False):
     action_confirm = action + (' --confirm' if confirm else '')
 
     if config['_log'].level == logging.DEBUG:
-        config['_log'].debug('#{} > w{}: {} {}'.format(request_id, worker, action_confirm, data))
+        config['_log'].debug('#{} > w{}: {} {}{}'.format(request_id, worker, action_confirm, data, '' if payload is None else (' ' if data else '') + payload))
 
-    request = '{} {} {}\n'.format(request_id, action_confirm, data)
+    if config['protocol'] == 2:
+        flags = V2_CONFIRM if confirm else 0
+        if payload is None:
+            payload = ''
+        else:
+            flags |= V2_PAYLOAD
+        request = V2_REQUEST_HEADER.pack(V2_ACTION_CODES[action], flags, len(request_id), len(data), len(payload)) + request_id + data + payload
 
-    if confirm:
-        confirm_event = state['confirms'][request_id] = Event()
     else:
-        confirm_event = None
+        if payload is not None:
+            data = '{} {}'.format(data, payload) if data else payload
+        request = '{} {} {}\n'.format(request_id, action_confirm, data)
+
+    if confirm:
+        confirm_result = state['confirms'][request_id] = Confirm(request_id)
 
     try:
         state['requests'][worker].put(request)
 
-        if confirm:
-            confirm_event.wait()
+        if confirm and wait:
+            confirm_result.get()
 
     finally:
-        if confirm:
+        if confirm and wait:
             state['confirms'].pop(request_id, None)
 
-    return request_id
+    return confirm_result if confirm and not wait else request_id
+
+### confirm
+
+class ConfirmError(Exception):
+    """
+    Server responded with error to request that waited for confirm.
+    Details are logged by server with "error_id".
+    """
+
+    def __init__(self, request_id, error_id):
+        """
+        @param request_id: str
+        @param error_id: str
+        """
+        Exception.__init__(self, '{} error {}'.format(request_id, error_id))
+        self.request_id = request_id
+        self.error_id = error_id
+
+class Confirm(AsyncResult):
+    """
+    Result of request sent with "confirm" and without waiting for it, e.g. by "publish_async".
+    "get()" returns "request_id" when confirmed, or raises "ConfirmError".
+    """
+
+    def __init__(self, request_id):
+        """
+        @param request_id: str
+        """
+        AsyncResult.__init__(self)
+        self.request_id = request_id
+
+def wait_confirms(confirms, timeout=None):
+    """
+    Wait for all confirms, e.g. returned by "publish_async".
+
+    @param confirms: iterable(Confirm)
+    @param timeout: float|None - Max seconds to wait for all confirms.
+    @return dict(request_id: str, error_id: str|None) - Not confirmed requests:
+        "error_id" if server responded with error, None if not confirmed in "timeout".
+        Empty dict if all requests are confirmed.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    errors = {}
+
+    for confirm_result in confirms:
+        confirm_result.wait(None if deadline is None else max(0, deadline - time.time()))
+
+        if not confirm_result.ready():
+            errors[confirm_result.request_id] = None
+            state['confirms'].pop(confirm_result.request_id, None)  # Late confirm will be ignored.
+
+        elif not confirm_result.successful():
+            errors[confirm_result.request_id] = confirm_result.exception.error_id
+
+    return errors
 
 ### _sender
 
@@ -516,19 +960,31 @@ def _sender(worker):
     while 1:
         try:
             try:
-                request = requests.peek(timeout=1)
+                requests.peek(timeout=1)
             except Empty:
                 continue
 
+            # Peek all pending requests up to "requests_batch_bytes", at least one:
+            batch = []
+            batch_bytes = 0
+            for request in requests.queue:  # No context switch while iterating.
+                batch_bytes += len(request)
+                if batch_bytes > config['requests_batch_bytes'] and batch:
+                    break
+                batch.append(request)
+
             sock = state['socks'][worker]
             try:
-                sock.sendall(request)
+                sock.sendall(''.join(batch))
 
             except Exception as e:
                 _on_disconnect(worker, e, sock)
-                continue
+                continue  # The whole batch is still in queue and will be sent again on reconnect.
 
-            requests.get()  # Delete request from queue.
+            for _ in xrange(len(batch)):
+                requests.get_nowait()  # Delete request from queue. This greenlet is the only getter.
+            state['requests_sent'] += len(batch)
+            state['requests_flushes'] += 1
 
         except Exception as e:
             crit()
@@ -548,83 +1004,178 @@ def _receiver(worker):
             sock = state['socks'][worker]
             f = sock.makefile('r')
 
-            while 1:
-                response = f.readline()
-                if response == '':  # E.g. socket is broken.
-                    break
+            if config['protocol'] == 2:
+                header_size = V2_RESPONSE_HEADER.size
+                while 1:
+                    header = f.read(header_size)
+                    if len(header) < header_size:  # E.g. socket is broken.
+                        break
 
-                try:
-                    response = response.rstrip('\r\n')  # Not trailing space in "ok " confirm.
-                    request_id, response_type, data = response.split(' ', 2)
+                    response_code, id_length, data_length = V2_RESPONSE_HEADER.unpack(header)
+                    request_id = f.read(id_length)
+                    data = f.read(data_length)
+                    if len(data) < data_length:
+                        break
 
-                    if config['_log'].level == logging.DEBUG:
-                        config['_log'].debug('#{} < w{}: {} {}'.format(request_id, worker, response_type, data))
+                    _on_response(worker, request_id, 'error' if response_code == V2_ERROR else 'ok', data)
 
-                    ### error
+            else:
+                while 1:
+                    response = f.readline()
+                    if response == '':  # E.g. socket is broken.
+                        break
+
+                    try:
+                        response = response.rstrip('\r\n')  # Not trailing space in "ok " confirm.
+                        request_id, response_type, data = response.split(' ', 2)
+                    except Exception:
+                        crit(also=dict(worker=worker, response=response))
+                        continue
 
-                    if response_type == 'error':
-                        error = Exception(response)
-                        eval_result = state['eval_results'].pop(request_id, None)
-                        if eval_result:
-                            eval_result.set_exception(error)
-                            continue
-                        raise error
+                    _on_response(worker, request_id, response_type, data)
 
-                    ### confirm
+        except Exception as e:
+            _on_disconnect(worker, e, sock)
+        else:
+            _on_disconnect(worker, None, sock)
 
-                    if data == '':
-                        confirm_event = state['confirms'].get(request_id)
-                        if confirm_event is not None:
-                            confirm_event.set()
-                        continue
+### _on_response
 
-                    ### consume
+def _on_response(worker, request_id, response_type, data):
+    """
+    Handle response of any protocol.
 
-                    on_msg = state['on_msg'].get(request_id)
-                    if on_msg:
-                        consumer_id = request_id
+    @param worker: int
+    @param request_id: str
+    @param response_type: str - "ok" or "error"
+    @param data: str
+    """
+    try:
+        if config['_log'].level == logging.DEBUG:
+            config['_log'].debug('#{} < w{}: {} {}'.format(request_id, worker, response_type, data))
 
-                        ### update consumer
+        ### error
 
-                        if data.startswith('--update '):
-                            _, consumer = data.split(' ', 1)
-                            if consumer_id in state['workers']:
-                                state['consumers'][worker][consumer_id] = consumer
-                            continue
+        if response_type == 'error':
+            confirm_result = state['confirms'].pop(request_id, None)
+            if confirm_result is not None:
+                confirm_result.set_exception(ConfirmError(request_id, data))
+                return
 
-                        ### msg
+            error = Exception('{} {} {}'.format(request_id, response_type, data))
+            eval_result = state['eval_results'].pop(request_id, None)
+            if eval_result:
+                eval_result.set_exception(error)
+                return
+            raise error
 
-                        msg_id, props, data = data.split(' ', 2)
+        ### moved
 
-                        msg = dict(
-                            id=msg_id,
-                            data=data,
-                            ack=partial(ack, consumer_id, msg_id),
-                            reject=partial(reject, consumer_id, msg_id),
-                        )
+        if data.startswith(MOVED):
+            workers, pins = parse_placement(data[len(MOVED):])
+            is_ring_changed = workers != config['workers'] or pins != config['ring_pins']
+            if is_ring_changed:
+                config.update(workers=workers, ring_pins=pins)
+                _update_ring()
+            if request_id in state['on_msg']:
+                spawn(_move_consumer, request_id, is_ring_changed)
+            return
 
-                        for prop in props.split(','):
-                            name, value = prop.split('=', 1)
-                            msg[name] = value
+        ### confirm
 
-                        spawn(_safe_on_msg, on_msg, msg)
-                        continue
+        if data == '':
+            confirm_result = state['confirms'].pop(request_id, None)
+            if confirm_result is not None:
+                confirm_result.set(request_id)
+            return
 
-                    ### eval_result
+        ### consume
 
-                    eval_result = state['eval_results'].pop(request_id, None)
-                    if eval_result:
-                        eval_result.set(data)
+        on_msg = state['on_msg'].get(request_id)
+        if on_msg:
+            consumer_id = request_id
 
-                    ### except
+            ### update consumer
 
-                except Exception:
-                    crit(also=dict(worker=worker, response=response))
+            if data.startswith('--update '):
+                _, consumer = data.split(' ', 1)
+                if consumer_id in state['workers']:
+                    state['consumers'][worker][consumer_id] = consumer
+                return
 
-        except Exception as e:
-            _on_disconnect(worker, e, sock)
-        else:
-            _on_disconnect(worker, None, sock)
+            ### msg
+
+            msg_id, props, data = data.split(' ', 2)
+            if ESCAPED in props:  # "event=" is always the first prop.
+                props = props.replace(ESCAPED, '')
+                data = unescape(data)
+            msg = _get_msg(consumer_id, msg_id, props, data)
+
+            if ',z=' in props:  # "event=" is always the first prop.
+                msg['data'] = CODECS[msg.pop('z')][1](data)
+
+            dispatch = state['dispatchers'].get(consumer_id)
+            if dispatch:
+                dispatch(msg)  # May block "_receiver".
+            else:
+                spawn(_safe_on_msg, on_msg, msg)
+            return
+
+        ### eval_result
+
+        eval_result = state['eval_results'].pop(request_id, None)
+        if eval_result:
+            eval_result.set(data)
+
+        ### except
+
+    except Exception:
+        crit(also=dict(worker=worker, request_id=request_id, response_type=response_type, data=data))
+
+### Msg
+
+class Msg(dict):
+    """
+    Message passed to "on_msg": dict of "id", "data" and props like "event", "retry", with methods "ack" and "reject".
+    For compatibility "msg['ack']()" == "msg.ack()", but "ack" and "reject" are not items: "get", "in", "copy" do not see them.
+    Is created with "_get_msg".
+    """
+
+    __slots__ = ('_consumer_id', )
+
+    def __missing__(self, key):
+        if key == 'ack' or key == 'reject':
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def ack(self, confirm=False):
+        """
+        @param confirm: bool
+        @return request_id: str or None
+        """
+        return ack(self._consumer_id, self['id'], confirm=confirm)
+
+    def reject(self, confirm=False):
+        """
+        @param confirm: bool
+        @return request_id: str or None
+        """
+        return reject(self._consumer_id, self['id'], confirm=confirm)
+
+def _get_msg(consumer_id, msg_id, props, data):
+    """
+    @param consumer_id: str
+    @param msg_id: str
+    @param props: str - "event={event}[,retry={n}]..."
+    @param data: str
+    @return Msg
+    """
+    msg = Msg(id=msg_id, data=data)  # No "__init__" in Python: this is the hot path.
+    for prop in props.split(','):
+        name, value = prop.split('=', 1)
+        msg[name] = value
+    msg._consumer_id = consumer_id
+    return msg
 
 ### _safe_on_msg
 
@@ -634,14 +1185,56 @@ def _safe_on_msg(on_msg, msg):
     except Exception:
         crit()
 
+### _get_dispatcher
+
+def _get_dispatcher(on_msg, concurrency):
+    """
+    Get bounded dispatcher of messages to "on_msg", see "concurrency" in "consume".
+
+    @param on_msg: callable(msg: dict)
+    @param concurrency: int
+    @return dispatch: callable(msg: dict) - blocks while "on_msg" is busy
+    """
+    if concurrency > 1:
+        return partial(Pool(concurrency).spawn, _safe_on_msg, on_msg)
+
+    # In order: one greenlet per burst of messages, not per message.
+    msgs = Queue(1)  # The next message waits here while "on_msg" processes the current one.
+    runner = [None]
+
+    def run():
+        while 1:
+            try:
+                msg = msgs.get_nowait()
+            except Empty:
+                return
+            _safe_on_msg(on_msg, msg)
+
+    def dispatch(msg):
+        msgs.put(msg)
+        if runner[0] is None or runner[0].ready():
+            runner[0] = spawn(run)
+
+    return dispatch
+
 ### get_worker
 
 def get_worker(item):
     """
     Find out which worker serves this item, e.g. queue name.
-    Items are almost uniformly distributed by workers using hash of item.
+    Items are almost uniformly distributed by workers using consistent-hash ring, see "mqks.sharding".
 
-    @param item: hashable
+    @param item: str
     @return int
     """
-    return hash(item) % WORKERS
+    return RING.get_worker(item)
+
+def _update_ring():
+    """
+    Rebuild ring if "workers", "ring_vnodes", "ring_hash" or "ring_pins" are changed.
+    """
+    global RING, WORKERS
+    WORKERS = len(config['workers'])
+    if (RING is None or RING.workers != tuple(config['workers']) or RING.vnodes != config['ring_vnodes'] or RING.hash_name != config['ring_hash']
+            or RING.pins != config['ring_pins']):
+        RING = Ring(config['workers'], config['ring_vnodes'], config['ring_hash'], config['ring_pins'])
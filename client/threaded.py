@@ -0,0 +1,764 @@
+"""
+Thread-safe client of "mqks" - Message Queue Kept Simple - for services with plain threads or multiprocessing, without gevent.
+Same actions as gevent-based "mqks.client.mqks", but each "Client" instance owns its own sockets and state:
+
+    from mqks.client.threaded import Client
+    client = Client(workers=['10.0.0.1:24000:25000', '10.0.0.2:24000:25000'])
+    client.consume('q1', ['e1'], on_msg)
+    client.publish('e1', 'd1')
+"""
+
+### import
+
+from __future__ import absolute_import  # "mqks.sharding", not sibling "mqks" module.
+from critbot import crit
+from functools import partial
+import logging
+from Queue import Queue
+import socket
+import threading
+import time
+from uqid import dtid
+
+from mqks.escape import unescape
+from mqks.sharding import Ring, parse_placement
+
+### config
+
+default_config = dict(
+    workers=[                               # Should be exactly the same as mqks.server.config['workers']
+        '127.0.0.1:24000:25000',
+        '127.0.0.1:24001:25001',
+    ],
+    ring_vnodes=0,                          # Should be exactly the same as mqks.server.config['ring_vnodes']
+    ring_hash='crc32',                      # Should be exactly the same as mqks.server.config['ring_hash']
+    ring_pins={},                           # Should be exactly the same as mqks.server.config['ring_pins'], updated on "--moved" response.
+    logger_name='mqks.client',              # Change to logger_name you configured in your service.
+    ping_seconds=15,                        # Ping each connected worker each N seconds to detect disconnect.
+    reconnect_seconds=1,                    # How many seconds to wait on disconnect before trying to reconnect.
+    id_length=24,                           # Length of random ID. More bytes = more secure = more slow.
+    publish_many_bytes=64*1024,             # Max bytes of messages in one "publish_many" request. Bigger batch is split to many requests.
+    on_msg_threads=4,                       # Threads of the pool that calls "on_msg" of all consumers of this client.
+    on_msg_queue_size=1000,                 # Messages waiting for a free thread of the pool. When full, IO thread stops reading its socket,
+                                            # so server gets backpressure via TCP. Avoid waiting for "confirm" inside "on_msg" then.
+)
+
+### const
+
+MOVED = '--moved '  # Response when ring of workers is changed, see "mqks.server.lib.migration".
+ESCAPED = ',esc=1'  # Prop of message with data escaped for "protocol v1", see "mqks.server.lib.clients.escape_msg".
+
+### Client
+
+class Client(object):
+    """
+    Thread-safe client: any method may be called from any thread.
+    Runs one IO thread per connected worker - it connects, receives responses and reconnects.
+    Requests are sent from calling threads, one "sendall" per worker at a time.
+    """
+
+    ### init
+
+    def __init__(self, **config):
+        """
+        @param config: dict - overrides "default_config"
+        """
+        self.config = dict(default_config, **config)
+        self.log = logging.getLogger(self.config['logger_name'])
+
+        self._ring = Ring(self.config['workers'], self.config['ring_vnodes'], self.config['ring_hash'], self.config['ring_pins'])  # Replaced on "--moved" response.
+
+        self._lock = threading.RLock()      # Guards state below.
+        self._is_running = True
+        self._socks = {}                    # _socks[worker: int] == sock: socket.socket - while connected
+        self._connected = {}                # _connected[worker: int] == threading.Event
+        self._send_locks = {}               # _send_locks[worker: int] == threading.Lock
+        self._io_threads = {}               # _io_threads[worker: int] == threading.Thread
+        self._consumers = {}                # _consumers[consumer_id: str] == tuple(worker: int, consumer: str)
+        self._on_msg = {}                   # _on_msg[consumer_id: str] == on_msg: callable(msg: dict)
+        self._on_disconnect = {}            # _on_disconnect[consumer_id: str] == on_disconnect: callable()
+        self._on_reconnect = {}             # _on_reconnect[consumer_id: str] == on_reconnect: callable(old_consumer_id: str, new_consumer_id: str)
+        self._confirms = {}                 # _confirms[request_id: str] == list(event: threading.Event, error: ConfirmError|None)
+        self._eval_results = {}             # _eval_results[request_id: str] == list(event: threading.Event, result: str|None, error: Exception|None)
+        self._msgs = Queue(self.config['on_msg_queue_size'])  # _msgs.get() == tuple(on_msg: callable, msg: dict) | None to stop
+
+        self._threads = [self._start_thread(self._on_msg_loop, 'on_msg-{}'.format(index)) for index in xrange(self.config['on_msg_threads'])]
+        self._threads.append(self._start_thread(self._pinger, 'pinger'))
+
+    def _start_thread(self, target, name, *args):
+        """
+        @param target: callable
+        @param name: str
+        @param args: tuple
+        @return threading.Thread - daemon, started
+        """
+        thread = threading.Thread(target=target, name='mqks.{}'.format(name), args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    ### disconnect
+
+    def disconnect(self):
+        """
+        Disconnect from all workers and stop all threads of this client.
+        """
+        with self._lock:
+            self._is_running = False
+            socks = self._socks.values()
+            io_threads = self._io_threads.values()
+            on_disconnects = self._on_disconnect.values()
+
+        for sock in socks:
+            _close(sock)
+
+        for _ in xrange(self.config['on_msg_threads']):
+            self._msgs.put(None)
+
+        current_thread = threading.current_thread()
+        for thread in self._threads[:self.config['on_msg_threads']] + io_threads:  # Daemon threads still running at interpreter shutdown may fail noisily.
+            if thread is not current_thread:
+                thread.join(self.config['reconnect_seconds'])
+
+        for on_disconnect in on_disconnects:
+            try:
+                on_disconnect()
+            except Exception:
+                crit()
+
+    ### publish
+
+    def publish(self, event, data, confirm=False):
+        """
+        Client publishes new message to server.
+        Server puts copies of this message to zero or more queues that were subscribed to this event.
+
+        @param event: str
+        @param data: str
+        @param confirm: bool
+        @return msg_id: str
+        """
+        return self._send(self.get_worker(event), self._request_id(), 'publish', '{} {}'.format(event, data), confirm=confirm)
+
+    ### publish many
+
+    def publish_many(self, events_and_data, confirm=False):
+        """
+        Client publishes many messages with one request per worker of events, see "mqks.client.mqks.publish_many".
+
+        @param events_and_data: iterable(tuple(event: str, data: str))
+        @param confirm: bool
+        @return list(msg_id: str) - in the same order as "events_and_data"
+        """
+        msg_ids = []
+        batches = {}  # batches[worker: int] == tuple(request_id: str, pairs: list(str), pairs_bytes: int)
+
+        for event, data in events_and_data:
+            worker = self.get_worker(event)
+            batch = batches.get(worker)
+            pair = '{} {} {}'.format(event, len(data), data)
+
+            if batch and batch[2] + len(pair) > self.config['publish_many_bytes']:
+                self._send(worker, batch[0], 'publish_many', ' '.join(batch[1]), confirm=confirm)
+                batch = None
+
+            if not batch:
+                batch = (self._request_id(), [], 0)
+
+            request_id, pairs, pairs_bytes = batch
+            msg_ids.append('{}.{}'.format(request_id, len(pairs)))  # See "msg_id" in server "publish_many".
+            pairs.append(pair)
+            batches[worker] = (request_id, pairs, pairs_bytes + len(pair) + 1)
+
+        for worker, (request_id, pairs, _) in batches.iteritems():
+            self._send(worker, request_id, 'publish_many', ' '.join(pairs), confirm=confirm)
+
+        return msg_ids
+
+    ### consume
+
+    def consume(self, queue, events, on_msg, on_disconnect=None, on_reconnect=None, delete_queue_when_unused=False, manual_ack=False, add_events=False, confirm=False, prefetch=None):
+        """
+        Client starts consuming messages from queue, see "mqks.client.mqks.consume".
+        "on_msg" is called from the pool of "on_msg_threads", so messages of the same consumer may be processed concurrently.
+
+        @param queue: str
+        @param events: iterable(str)
+        @param on_msg: callable(msg: dict)
+        @param on_disconnect: callable()
+        @param on_reconnect: callable(old_consumer_id: str, new_consumer_id: str)
+        @param delete_queue_when_unused: bool|float|int
+        @param manual_ack: bool
+        @param add_events: bool
+        @param confirm: bool
+        @param prefetch: int|None
+        @return consumer_id: str
+        """
+        consumer_id = self._request_id()
+        events = ' '.join(events)  # To allow any iterable.
+
+        consumer = ''.join((
+            queue,
+            ' --add' if add_events else '',
+            ' ' + events if events else '',
+            '' if delete_queue_when_unused is False else ' --delete-queue-when-unused' + (
+                '' if delete_queue_when_unused is True else '={}'.format(delete_queue_when_unused)
+            ),
+            ' --manual-ack' if manual_ack else '',
+            ' --prefetch={}'.format(prefetch) if prefetch else '',
+        ))
+        worker = self.get_worker(queue)
+
+        with self._lock:
+            self._consumers[consumer_id] = (worker, consumer)
+            self._on_msg[consumer_id] = on_msg
+            if on_disconnect:
+                self._on_disconnect[consumer_id] = on_disconnect
+            if on_reconnect:
+                self._on_reconnect[consumer_id] = on_reconnect
+
+        self._send(worker, consumer_id, 'consume', consumer, confirm=confirm)
+        return consumer_id
+
+    ### rebind
+
+    def rebind(self, queue, replace=None, remove=None, add=None, remove_mask=None, confirm=False):
+        """
+        Replace subscriptions of the queue with new list of events, or remove some and add some other events, see "mqks.client.mqks.rebind".
+
+        @param queue: str
+        @param replace: list(str)|None
+        @param remove: list(str)|None
+        @param add: list(str)|None
+        @param remove_mask: list(str)|None
+        @param confirm: bool
+        @return request_id: str
+        """
+        assert replace or remove or add or remove_mask, (replace, remove, add, remove_mask)
+        events = list(replace or [])
+
+        for option, option_events in ('--remove', remove), ('--add', add), ('--remove-mask', remove_mask):
+            if option_events:
+                events.append(option)
+                events.extend(option_events)
+
+        return self._send(self.get_worker(queue), self._request_id(), 'rebind', '{} {}'.format(queue, ' '.join(events)), confirm=confirm)
+
+    ### ack, reject
+
+    def ack(self, consumer_id, msg_id, confirm=False):
+        """
+        Acknowledge this message was processed by this consumer.
+
+        @param consumer_id: str
+        @param msg_id: str
+        @param confirm: bool
+        @return request_id: str or None
+        """
+        return self.ack_many(consumer_id, [msg_id], confirm=confirm)
+
+    def ack_many(self, consumer_id, msg_ids, confirm=False):
+        """
+        @param consumer_id: str
+        @param msg_ids: list(str)
+        @param confirm: bool
+        @return request_id: str or None
+        """
+        return self._send_to_consumer_worker(consumer_id, 'ack', '{} {}'.format(consumer_id, ' '.join(msg_ids)), confirm=confirm)
+
+    def ack_all(self, consumer_id, confirm=False):
+        """
+        @param consumer_id: str
+        @param confirm: bool
+        @return request_id: str or None
+        """
+        return self.ack_many(consumer_id, ['--all'], confirm=confirm)
+
+    def reject(self, consumer_id, msg_id, confirm=False):
+        """
+        Reject this message - to return it to the queue with incremented "retry" counter.
+
+        @param consumer_id: str
+        @param msg_id: str
+        @param confirm: bool
+        @return request_id: str or None
+        """
+        return self.reject_many(consumer_id, [msg_id], confirm=confirm)
+
+    def reject_many(self, consumer_id, msg_ids, confirm=False):
+        """
+        @param consumer_id: str
+        @param msg_ids: list(str)
+        @param confirm: bool
+        @return request_id: str or None
+        """
+        return self._send_to_consumer_worker(consumer_id, 'reject', '{} {}'.format(consumer_id, ' '.join(msg_ids)), confirm=confirm)
+
+    def reject_all(self, consumer_id, confirm=False):
+        """
+        @param consumer_id: str
+        @param confirm: bool
+        @return request_id: str or None
+        """
+        return self.reject_many(consumer_id, ['--all'], confirm=confirm)
+
+    ### delete consumer
+
+    def delete_consumer(self, consumer_id, confirm=False):
+        """
+        Delete the consumer. Client will not restart this consumer on reconnect.
+
+        @param consumer_id: str
+        @param confirm: bool
+        @return request_id: str or None
+        """
+        with self._lock:
+            worker, _ = self._consumers.pop(consumer_id, (None, None))
+            self._on_msg.pop(consumer_id, None)
+            self._on_disconnect.pop(consumer_id, None)
+            self._on_reconnect.pop(consumer_id, None)
+
+        if worker is not None:
+            return self._send(worker, self._request_id(), 'delete_consumer', consumer_id, confirm=confirm)
+
+    ### delete queue
+
+    def delete_queue(self, queue, confirm=False):
+        """
+        @param queue: str
+        @param confirm: bool
+        @return request_id: str
+        """
+        return self._send(self.get_worker(queue), self._request_id(), 'delete_queue', queue, confirm=confirm)
+
+    ### ping
+
+    def ping(self, worker, data=None):
+        """
+        @param worker: int
+        @param data: str
+        @return request_id: str
+        """
+        return self._send(worker, self._request_id(), 'ping', data or self.config['logger_name'])
+
+    def _pinger(self):
+        while self._is_running:
+            try:
+                time.sleep(self.config['ping_seconds'] or 10)
+                if self.config['ping_seconds']:
+                    with self._lock:
+                        workers = self._socks.keys()
+                    for worker in workers:
+                        self.ping(worker)
+            except Exception:
+                crit()
+
+    ### _eval
+
+    def _eval(self, code, worker=0, timeout=None):
+        """
+        Backdoor to get any stats, see "stats.py".
+
+        @param code: str
+        @param worker: int
+        @param timeout: float|None - Max seconds to wait for result.
+        @return str - Result of successful code evaluation.
+        @raise Exception - Contains server-side "error_id", or timeout.
+        """
+        eval_id = self._request_id()
+        eval_result = self._eval_results[eval_id] = [threading.Event(), None, None]
+        try:
+            self._send(worker, eval_id, '_eval', code)
+            if not eval_result[0].wait(timeout):
+                raise Exception('timeout of _eval')
+        finally:
+            self._eval_results.pop(eval_id, None)
+
+        if eval_result[2]:
+            raise eval_result[2]
+        return eval_result[1]
+
+    ### get worker
+
+    def get_worker(self, item):
+        """
+        Find out which worker serves this item, e.g. queue name.
+
+        @param item: str
+        @return int
+        """
+        return self._ring.get_worker(item)
+
+    ### request id
+
+    def _request_id(self):
+        """
+        @return: str
+        """
+        return dtid(self.config['id_length'])
+
+    ### _send
+
+    def _send_to_consumer_worker(self, consumer_id, action, data, confirm=False):
+        """
+        @param consumer_id: str
+        @param action: str
+        @param data: str
+        @param confirm: bool
+        @return request_id: str or None - None if consumer is unknown, e.g. deleted
+        """
+        with self._lock:
+            worker, _ = self._consumers.get(consumer_id, (None, None))
+        if worker is not None:
+            return self._send(worker, self._request_id(), action, data, confirm=confirm)
+
+    def _send(self, worker, request_id, action, data, confirm=False):
+        """
+        Send request, waiting for connection to worker if needed.
+        On send error, waits for reconnect by IO thread and sends again.
+
+        @param worker: int
+        @param request_id: str
+        @param action: str
+        @param data: str
+        @param confirm: bool
+        @return request_id: str
+        @raise ConfirmError - if "confirm" and server responded with error
+        """
+        action_confirm = action + (' --confirm' if confirm else '')
+        if self.log.level == logging.DEBUG:
+            self.log.debug('#{} > w{}: {} {}'.format(request_id, worker, action_confirm, data))
+
+        request = '{} {} {}\n'.format(request_id, action_confirm, data)
+        if confirm:
+            confirm_result = self._confirms[request_id] = [threading.Event(), None]
+
+        try:
+            connected = self._get_connected(worker)
+            while 1:
+                connected.wait(self.config['reconnect_seconds'])
+                assert self._is_running, 'disconnected'
+                sock = self._socks.get(worker)
+                if sock is None:
+                    continue
+
+                try:
+                    with self._send_locks[worker]:
+                        sock.sendall(request)
+                    break
+                except socket.error:
+                    _close(sock)  # IO thread will reconnect.
+                    time.sleep(self.config['reconnect_seconds'])
+
+            while confirm and not confirm_result[0].wait(self.config['reconnect_seconds']):
+                assert self._is_running, 'disconnected'
+
+        finally:
+            if confirm:
+                self._confirms.pop(request_id, None)
+
+        if confirm and confirm_result[1]:
+            raise confirm_result[1]
+        return request_id
+
+    ### connect
+
+    def _get_connected(self, worker):
+        """
+        Start IO thread of worker, if needed.
+
+        @param worker: int
+        @return threading.Event - set while connected to worker
+        """
+        with self._lock:
+            assert self._is_running, 'disconnected'
+            if worker not in self._io_threads:
+                self._connected[worker] = threading.Event()
+                self._send_locks[worker] = threading.Lock()
+                self._io_threads[worker] = self._start_thread(self._io_loop, 'w{}'.format(worker), worker)
+            return self._connected[worker]
+
+    ### IO loop
+
+    def _io_loop(self, worker):
+        """
+        Connect to worker, receive responses until disconnect, reconnect.
+
+        @param worker: int
+        """
+        is_reconnect = False
+        while self._is_running and worker < len(self.config['workers']):  # Removed worker is not reconnected, its consumers are moved already.
+            sock = None
+            try:
+                self.log.info('connecting to w{}'.format(worker))
+                host, _, port = self.config['workers'][worker].split(':')
+                sock = socket.create_connection((host, int(port)))
+
+                with self._lock:
+                    if not self._is_running:
+                        break
+                    self._socks[worker] = sock
+                self._connected[worker].set()
+
+                if is_reconnect:
+                    self._reconsume(worker)
+
+                f = sock.makefile('r')
+                while 1:
+                    response = f.readline()
+                    if response == '':  # E.g. socket is broken.
+                        break
+                    self._on_response(worker, response)
+
+            except Exception:
+                if self._is_running:
+                    crit(also=worker)
+
+            finally:
+                self._connected[worker].clear()
+                with self._lock:
+                    if self._socks.get(worker) is sock:
+                        del self._socks[worker]
+                if sock:
+                    _close(sock)
+
+            if not self._is_running:
+                break
+
+            if is_reconnect or sock:
+                self._on_worker_disconnected(worker)
+            is_reconnect = True
+            time.sleep(self.config['reconnect_seconds'])
+
+    def _on_worker_disconnected(self, worker):
+        """
+        @param worker: int
+        """
+        with self._lock:
+            on_disconnects = [self._on_disconnect[consumer_id] for consumer_id, (consumer_worker, _) in self._consumers.iteritems()
+                if consumer_worker == worker and consumer_id in self._on_disconnect]
+
+        for on_disconnect in on_disconnects:
+            try:
+                on_disconnect()
+            except Exception:
+                crit(also=worker)
+
+    def _reconsume(self, worker):
+        """
+        Request consume again with new consumer_ids, on reconnect.
+
+        @param worker: int
+        """
+        with self._lock:
+            reconsumed = [self._renew_consumer(old_consumer_id, worker)
+                for old_consumer_id, (consumer_worker, _) in self._consumers.items() if consumer_worker == worker]
+
+        for old_consumer_id, new_consumer_id, consumer, on_reconnect in reconsumed:
+            self._call_on_reconnect(on_reconnect, old_consumer_id, new_consumer_id)
+            self._send(worker, new_consumer_id, 'consume', consumer)
+
+    def _move_consumer(self, old_consumer_id, is_ring_changed):
+        """
+        Consume again at new worker of queue, on "--moved" response, see "mqks.server.lib.migration".
+        Pending confirm of old consume is set by confirm of new one.
+
+        @param old_consumer_id: str
+        @param is_ring_changed: bool - if not, old worker of queue has not moved it yet, so wait a bit
+        """
+        try:
+            if not is_ring_changed:
+                time.sleep(self.config['reconnect_seconds'])
+
+            with self._lock:
+                if old_consumer_id not in self._consumers:
+                    return  # Deleted meanwhile.
+                _, consumer = self._consumers[old_consumer_id]
+                worker = self.get_worker(consumer.split(' ', 1)[0])
+                _, new_consumer_id, _, on_reconnect = self._renew_consumer(old_consumer_id, worker)
+                old_confirm_result = self._confirms.get(old_consumer_id)
+
+            self._call_on_reconnect(on_reconnect, old_consumer_id, new_consumer_id)
+            try:
+                self._send(worker, new_consumer_id, 'consume', consumer, confirm=old_confirm_result is not None)
+            except ConfirmError as e:
+                old_confirm_result[1] = e
+                raise
+            finally:
+                if old_confirm_result is not None:
+                    old_confirm_result[0].set()
+
+        except Exception:
+            if self._is_running:
+                crit(also=dict(old_consumer_id=old_consumer_id))
+
+    def _renew_consumer(self, old_consumer_id, worker):
+        """
+        Move consumer and its callbacks to new consumer_id, under "_lock".
+
+        @param old_consumer_id: str
+        @param worker: int
+        @return tuple(old_consumer_id: str, new_consumer_id: str, consumer: str, on_reconnect: callable|None)
+        """
+        new_consumer_id = self._request_id()
+        _, consumer = self._consumers.pop(old_consumer_id)
+        self._consumers[new_consumer_id] = (worker, consumer)
+        for callbacks in self._on_msg, self._on_disconnect, self._on_reconnect:
+            if old_consumer_id in callbacks:
+                callbacks[new_consumer_id] = callbacks.pop(old_consumer_id)
+        return old_consumer_id, new_consumer_id, consumer, self._on_reconnect.get(new_consumer_id)
+
+    def _call_on_reconnect(self, on_reconnect, old_consumer_id, new_consumer_id):
+        """
+        @param on_reconnect: callable(old_consumer_id: str, new_consumer_id: str)|None
+        @param old_consumer_id: str
+        @param new_consumer_id: str
+        """
+        if on_reconnect:
+            try:
+                on_reconnect(old_consumer_id, new_consumer_id)
+            except Exception:
+                crit(also=dict(old_consumer_id=old_consumer_id, new_consumer_id=new_consumer_id))
+
+    ### on response
+
+    def _on_response(self, worker, response):
+        """
+        Handle response, called by IO thread of worker.
+
+        @param worker: int
+        @param response: str
+        """
+        try:
+            response = response.rstrip('\r\n')  # Not trailing space in "ok " confirm.
+            request_id, response_type, data = response.split(' ', 2)
+
+            if self.log.level == logging.DEBUG:
+                self.log.debug('#{} < w{}: {} {}'.format(request_id, worker, response_type, data))
+
+            ### error
+
+            if response_type == 'error':
+                confirm_result = self._confirms.get(request_id)
+                if confirm_result:
+                    confirm_result[1] = ConfirmError(request_id, data)
+                    confirm_result[0].set()
+                    return
+
+                error = Exception(response)
+                eval_result = self._eval_results.get(request_id)
+                if eval_result:
+                    eval_result[2] = error
+                    eval_result[0].set()
+                    return
+                raise error
+
+            ### moved
+
+            if data.startswith(MOVED):
+                workers, pins = parse_placement(data[len(MOVED):])
+                with self._lock:
+                    is_ring_changed = workers != self.config['workers'] or pins != self.config['ring_pins']
+                    if is_ring_changed:
+                        self.config.update(workers=workers, ring_pins=pins)
+                        self._ring = Ring(workers, self.config['ring_vnodes'], self.config['ring_hash'], pins)
+                    is_consumer = request_id in self._consumers
+                if is_consumer:  # Not from IO thread: new worker of queue may be this one.
+                    self._start_thread(self._move_consumer, 'move-{}'.format(request_id), request_id, is_ring_changed)
+                return
+
+            ### confirm
+
+            if data == '':
+                confirm_result = self._confirms.get(request_id)
+                if confirm_result is not None:
+                    confirm_result[0].set()
+                return
+
+            ### consume
+
+            on_msg = self._on_msg.get(request_id)
+            if on_msg:
+                consumer_id = request_id
+
+                if data.startswith('--update '):
+                    _, consumer = data.split(' ', 1)
+                    with self._lock:
+                        if consumer_id in self._consumers:
+                            self._consumers[consumer_id] = (worker, consumer)
+                    return
+
+                msg_id, props, data = data.split(' ', 2)
+                if ESCAPED in props:  # "event=" is always the first prop.
+                    props = props.replace(ESCAPED, '')
+                    data = unescape(data)
+                msg = dict(
+                    id=msg_id,
+                    data=data,
+                    ack=partial(self.ack, consumer_id, msg_id),
+                    reject=partial(self.reject, consumer_id, msg_id),
+                )
+                for prop in props.split(','):
+                    name, value = prop.split('=', 1)
+                    msg[name] = value
+
+                self._msgs.put((on_msg, msg))  # Blocks IO thread while the pool is busy.
+                return
+
+            ### eval result
+
+            eval_result = self._eval_results.get(request_id)
+            if eval_result:
+                eval_result[1] = data
+                eval_result[0].set()
+
+        except Exception:
+            crit(also=dict(worker=worker, response=response))
+
+    ### on msg loop
+
+    def _on_msg_loop(self):
+        """
+        Thread of the pool that calls "on_msg".
+        """
+        while 1:
+            item = self._msgs.get()
+            if item is None:
+                break
+
+            on_msg, msg = item
+            try:
+                on_msg(msg)
+            except Exception:
+                crit()
+
+### confirm
+
+class ConfirmError(Exception):
+    """
+    Server responded with error to request that waited for confirm.
+    Details are logged by server with "error_id".
+    """
+
+    def __init__(self, request_id, error_id):
+        """
+        @param request_id: str
+        @param error_id: str
+        """
+        Exception.__init__(self, '{} error {}'.format(request_id, error_id))
+        self.request_id = request_id
+        self.error_id = error_id
+
+### close
+
+def _close(sock):
+    """
+    Close socket, unblocking any thread that reads it.
+
+    @param sock: socket.socket
+    """
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+    sock.close()
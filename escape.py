@@ -0,0 +1,26 @@
+"""
+Escape of binary data - shared by server and clients of "mqks".
+
+Binary data, e.g. from "protocol v2" or compressed, may contain separators of text-based "command protocol", "wal" records and "protocol v1" responses.
+Only backslash, tab and newline are escaped: "string_escape" would inflate random bytes of compressed data about 3 times.
+Works with "str" of Python 2 and "bytes" of Python 3.
+"""
+
+### escape, unescape
+
+def escape(data):
+    """
+    @param data: str|bytes
+    @return str|bytes - without tabs and newlines
+    """
+    return data.replace(b'\\', b'\\\\').replace(b'\t', b'\\t').replace(b'\n', b'\\n')
+
+def unescape(data):
+    """
+    @param data: str|bytes - see "escape"
+    @return str|bytes
+    """
+    if b'\\' not in data:
+        return data
+    # Backslashes of escaped data come in pairs "\\" or before "t" and "n", so splitting by pairs from left is unambiguous:
+    return b'\\'.join(part.replace(b'\\t', b'\t').replace(b'\\n', b'\n') for part in data.split(b'\\\\'))
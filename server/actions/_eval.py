@@ -12,7 +12,7 @@ import logging
 from mqks.server.config import config, log, WORKERS
 
 # noinspection PyUnresolvedReferences
-from mqks.server.lib import gbn_profile
+from mqks.server.lib import gbn_profile, latency, migration
 
 # noinspection PyUnresolvedReferences
 from mqks.server.lib.workers import get_worker
@@ -4,9 +4,10 @@
 import logging
 
 from mqks.server.config import config, log
-from mqks.server.lib import state
+from mqks.server.lib import latency, state, wal
 from mqks.server.lib.clients import respond
 from mqks.server.lib.log import verbose
+from mqks.server.actions.consume import _resume_consumer
 
 ### ack action
 
@@ -15,11 +16,11 @@ def ack(request):
     Ack action
 
     @param request: dict - defined in "on_request" with (
-        data: str - "{consumer_id} {msg_id}" or "{consumer_id} --all",
+        data: str - "{consumer_id} {msg_id} [{msg_id} ...]" or "{consumer_id} --all",
         ...
     )
     """
-    consumer_id, msg_id = request['data'].split(' ', 1)
+    consumer_id, msg_ids = request['data'].split(' ', 1)
 
     queue = state.queues_by_consumer_ids.get(consumer_id)
     if not queue:
@@ -27,10 +28,27 @@ def ack(request):
             verbose('w{}: found no queue for request={}'.format(state.worker, request))
         return
 
-    if msg_id == '--all':
-        state.messages_by_consumer_ids.pop(consumer_id, {}).clear()
+    if msg_ids == '--all':
+        msgs = state.messages_by_consumer_ids.pop(consumer_id, {})
+        if config['wal'] or config['latency']:
+            for msg_id, msg in msgs.iteritems():
+                if config['wal']:
+                    wal.remove(queue, msg_id)
+                if config['latency']:
+                    latency.on_ack(msg)
+        msgs.clear()
+
     else:
-        state.messages_by_consumer_ids.get(consumer_id, {}).pop(msg_id, None)
+        msgs = state.messages_by_consumer_ids.get(consumer_id, {})
+        for msg_id in msg_ids.split(' '):
+            msg = msgs.pop(msg_id, None)
+            if msg is not None:
+                if config['wal']:
+                    wal.remove(queue, msg_id)
+                if config['latency']:
+                    latency.on_ack(msg)
+
+    _resume_consumer(queue, consumer_id)
 
     if request['confirm']:
         respond(request)
@@ -1,17 +1,21 @@
 
 ### import
 
+from collections import deque
 from gbn import gbn
 from gevent import spawn
 from gevent.event import Event
-from gevent.queue import Empty, Queue
+from gevent.queue import Queue
 import time
 
+from mqks.sharding import parse_partition
 from mqks.server.config import config
-from mqks.server.actions.rebind import rebind
-from mqks.server.lib import state
-from mqks.server.lib.clients import respond
-from mqks.server.lib.workers import on_error
+from mqks.server.actions.rebind import _add_partition, rebind
+from mqks.server.lib import latency, state, wal
+from mqks.server.lib.compression import decompress_msg
+from mqks.server.lib.event_masks import ANY, is_mask
+from mqks.server.lib.clients import escape_msg, respond
+from mqks.server.lib.workers import notify_moved, on_error, serves_queue
 
 ### consume action
 
@@ -20,7 +24,7 @@ def consume(request):
     Consume action
 
     @param request: dict - defined in "on_request" with (
-        data: str - "{queue} [{event} ... {event}] [--add {event} ... {event}] [--delete-queue-when-unused[={seconds}]] [--manual-ack]"
+        data: str - "{queue} [{event} ... {event}] [--add {event} ... {event}] [--delete-queue-when-unused[={seconds}]] [--manual-ack [--prefetch={n}]] [--compressed] [--partition]"
     )
     """
 
@@ -30,11 +34,20 @@ def consume(request):
     parts = request['data'].split(' ', 1)
     queue, data = parts if len(parts) == 2 else (request['data'], '')
 
+    if not serves_queue(queue):  # Client with old ring, consumer follows "--moved" to new worker of queue.
+        notify_moved(request, once=False)
+        return
+
+    assert consumer_id not in state.clients_by_consumer_ids, consumer_id  # Before any state is changed.
+
     events_replace = []
     events_add = []
     adding = False
     delete_queue_when_unused = False
     manual_ack = False
+    prefetch = None
+    compressed = False
+    partition = False
 
     for part in data.split(' '):
         if part.startswith('--'):
@@ -46,9 +59,19 @@ def consume(request):
                 delete_queue_when_unused = float(part.replace('--delete-queue-when-unused=', ''))
             elif part == '--manual-ack':
                 manual_ack = True
+            elif part.startswith('--prefetch='):
+                prefetch = int(part.replace('--prefetch=', ''))
+                assert prefetch > 0, part
+            elif part == '--compressed':
+                compressed = True
+            elif part == '--partition':
+                partition = True
+                assert parse_partition(queue), queue
             else:
                 assert False, part
         elif part:
+            if ANY in part:
+                is_mask(part)  # Validate before anything is changed.
             (events_add if adding else events_replace).append(part)
 
     ### stop delete_queue_when_unused, reconfigure it
@@ -63,6 +86,9 @@ def consume(request):
         state.queues_to_delete_when_unused[queue] = delete_queue_when_unused
         update_consumers = True
 
+    if update_consumers:
+        state.bindings_version += 1
+
     ### consumer_ids_by_clients, clients_by_consumer_ids
 
     consumer_ids = state.consumer_ids_by_clients.setdefault(request['client'], set())
@@ -73,6 +99,15 @@ def consume(request):
 
     state.queues_by_consumer_ids[consumer_id] = queue
     state.consumers_by_queues.setdefault(queue, {})[consumer_id] = manual_ack
+    if prefetch and manual_ack:  # Auto-acked messages are never in flight.
+        state.prefetch_by_consumer_ids[consumer_id] = prefetch
+    if compressed:
+        state.compressed_consumer_ids.add(consumer_id)
+
+    ### partition
+
+    if partition and queue not in state.partitions:  # Before "_rebind" at workers of events, as commands to each worker are ordered.
+        _add_partition(request, queue)
 
     ### rebind
 
@@ -80,48 +115,137 @@ def consume(request):
 
     ### finish consume init
 
-    queue = state.queues.setdefault(queue, Queue())
-    spawn(_consume_loop, request, queue, consumer_id, consumer_ids, manual_ack)
+    _add_ready_consumer(queue, consumer_id)
     # "rebind" will confirm instead of "consume" when all required workers are notified.
 
-### consume loop greenlet
+### ready consumer
 
-def _consume_loop(request, queue, consumer_id, consumer_ids, manual_ack):
+def _add_ready_consumer(queue_name, consumer_id):
     """
-    Async loop to consume messages and to send them to clients.
+    Add consumer to the tail of ready consumers of the queue, start dispatcher of the queue if needed.
+    Consumer deleted and consumed again while still in ready consumers keeps its place there, not added twice.
 
-    @param request: dict - defined in "on_request"
-    @param queue: gevent.queue.Queue
+    @param queue_name: str
     @param consumer_id: str
-    @param consumer_ids: set([str])
-    @param manual_ack: bool
     """
+    ready = state.ready_consumers_by_queues.get(queue_name)
+    if ready is None:
+        ready = state.ready_consumers_by_queues[queue_name] = (deque(), Event())
+        state.dispatchers_by_queues[queue_name] = spawn(_dispatcher, queue_name, state.queues.setdefault(queue_name, Queue()), *ready)
+
+    consumer_ids, consumer_ready = ready
+    if state.ready_queues_by_consumer_ids.get(consumer_id) != queue_name:
+        state.ready_queues_by_consumer_ids[consumer_id] = queue_name
+        consumer_ids.append(consumer_id)
+    consumer_ready.set()
+
+def _stop_dispatcher(queue_name):
+    """
+    Kill dispatcher of deleted or moved queue, forget its ready consumers.
+
+    @param queue_name: str
+    """
+    dispatcher = state.dispatchers_by_queues.pop(queue_name, None)
+    if dispatcher:
+        dispatcher.kill(block=False)
+
+    ready = state.ready_consumers_by_queues.pop(queue_name, None)
+    if ready:
+        for consumer_id in ready[0]:
+            if state.ready_queues_by_consumer_ids.get(consumer_id) == queue_name:
+                del state.ready_queues_by_consumer_ids[consumer_id]
+
+def _resume_consumer(queue_name, consumer_id):
+    """
+    Resume dispatching to consumer paused by prefetch, if it has less not-acked messages now.
+    Is called on "ack" and "reject".
 
-    try:
-        while consumer_id in consumer_ids:
-            try:
-                data = queue.get(timeout=config['block_seconds'])
-            except Empty:
+    @param queue_name: str
+    @param consumer_id: str
+    """
+    if consumer_id in state.paused_consumer_ids and len(state.messages_by_consumer_ids.get(consumer_id, ())) < state.prefetch_by_consumer_ids[consumer_id]:
+        state.paused_consumer_ids.remove(consumer_id)
+        _add_ready_consumer(queue_name, consumer_id)
+
+### dispatcher greenlet
+
+def _dispatcher(queue_name, queue, consumer_ids, consumer_ready):
+    """
+    Dispatches messages of the queue to ready consumers round-robin.
+    Blocks without timeout, so it wakes up only when a message or a ready consumer arrives.
+    Message is got from the queue only when it is handed to a live consumer, so order of messages is kept.
+    Consumer with prefetch is paused when it has enough not-acked messages, see "_resume_consumer".
+    Deleted consumer is dropped lazily when it reaches the head of ready consumers, see "_delete_consumer".
+
+    @param queue_name: str
+    @param queue: gevent.queue.Queue
+    @param consumer_ids: collections.deque([consumer_id: str]) - ready consumers, see "_add_ready_consumer"
+    @param consumer_ready: gevent.event.Event
+    """
+    while 1:
+        request = None
+        try:
+            queue.peek()  # Wait for message.
+
+            while not consumer_ids:
+                consumer_ready.clear()
+                consumer_ready.wait()
+
+            # No context switch from here: dispatcher is the only getter of the queue, so peeked message is still at the head.
+
+            consumer_id = consumer_ids[0]
+            manual_ack = state.consumers_by_queues.get(queue_name, {}).get(consumer_id)
+            client = state.clients_by_consumer_ids.get(consumer_id)
+            if manual_ack is None or client is None:  # Deleted or unknown consumer.
+                consumer_ids.popleft()
+                if state.ready_queues_by_consumer_ids.get(consumer_id) == queue_name:  # Not consumed from other queue again.
+                    del state.ready_queues_by_consumer_ids[consumer_id]
                 continue
 
-            if consumer_id in consumer_ids:  # Consumer could be deleted while being blocked above.
-                if manual_ack:
-                    wall = gbn('manual_ack')
-                    msg_id, _ = data.split(' ', 1)
-                    state.messages_by_consumer_ids.setdefault(consumer_id, {})[msg_id] = data
-                    gbn(wall=wall)
+            # Anything that may fail goes before consumer and message are taken, so a failure can't lose them:
+
+            request = dict(id=consumer_id, client=client, worker=state.worker)
+            data = queue.peek()
+            msg_id, props, _ = data.split(' ', 2)
+            response = data
+
+            if ',z=' in props and consumer_id not in state.compressed_consumer_ids:  # "event=" is always the first prop.
+                try:
+                    response = decompress_msg(data)  # Not stored: reject returns compressed msg to the queue.
+                except Exception:
+                    queue.get_nowait()  # Undecodable message would block the queue forever. Only header of data compressed by client is checked on publish.
+                    if config['wal']:
+                        wal.remove(queue_name, msg_id)
+                    on_error(('_dispatcher', queue_name, msg_id))  # Consumer stays ready for next message.
+                    continue
+
+            consumer_ids.popleft()
+            queue.get_nowait()
+            is_paused = False
+            if config['latency']:
+                latency.on_dispatch(data, manual_ack)
+
+            if manual_ack:
+                wall = gbn('manual_ack')
+                msgs = state.messages_by_consumer_ids.setdefault(consumer_id, {})
+                msgs[msg_id] = data
+                prefetch = state.prefetch_by_consumer_ids.get(consumer_id)
+                is_paused = prefetch is not None and len(msgs) >= prefetch
+                gbn(wall=wall)
 
-                respond(request, data)
-                state.consumed += 1
+            elif config['wal']:
+                wal.remove(queue_name, msg_id)
+
+            respond(request, escape_msg(request, response))
+            state.consumed += 1
+            if is_paused:
+                state.ready_queues_by_consumer_ids.pop(consumer_id, None)
+                state.paused_consumer_ids.add(consumer_id)
             else:
-                wall = gbn('consume_back')
-                queue.put(data)
-                gbn(wall=wall)
-                # Don't try to preserve chronological order of messages in this edge case:
-                # "peek() + get()" does not fit for multiple consumers from the same queue.
-                # "JoinableQueue().task_done()" is heavier and "reject()" will change order anyway.
+                consumer_ids.append(consumer_id)  # Round-robin.
 
             time.sleep(0)
 
-    except Exception:
-        on_error('_consume_loop', request)
+        except Exception:
+            on_error('_dispatcher', request)
+            time.sleep(config['block_seconds'])  # Avoid busy loop of errors.
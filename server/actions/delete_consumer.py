@@ -37,14 +37,18 @@ def _delete_consumer(request, consumer_id):
     confirm = request['confirm']
     request['confirm'] = False  # To avoid double confirm.
 
-    for client, consumer_ids in state.consumer_ids_by_clients.items():
-        # We should check all clients, not only request['client'],
-        # because _delete_consumer() may be called from _delete_queue() by another client.
+    client = state.clients_by_consumer_ids.pop(consumer_id, None)
+    # Client of consumer, not request['client'],
+    # because _delete_consumer() may be called from _delete_queue() by another client.
+    consumer_ids = state.consumer_ids_by_clients.get(client)
+    if consumer_ids is not None:
         consumer_ids.discard(consumer_id)
         if not consumer_ids:
             state.consumer_ids_by_clients.pop(client, None)
 
-    state.clients_by_consumer_ids.pop(consumer_id, None)
+    state.prefetch_by_consumer_ids.pop(consumer_id, None)
+    state.compressed_consumer_ids.discard(consumer_id)
+    state.paused_consumer_ids.discard(consumer_id)  # Before "_reject" below, to avoid resuming.
 
     queue = state.queues_by_consumer_ids.pop(consumer_id, None)
     if not queue:
@@ -58,7 +62,7 @@ def _delete_consumer(request, consumer_id):
 
     _reject(request, queue, consumer_id, '--all')
 
-    if queue not in state.queues_by_consumer_ids.itervalues():
+    if queue not in state.consumers_by_queues:  # Popped above when the last consumer of queue is deleted.
 
         queue_used = state.queues_used.get(queue)
         if queue_used is not None:
@@ -84,7 +88,7 @@ def delete_consumers(client):
     wall = gbn('delete_consumers')
     for consumer_id in list(state.consumer_ids_by_clients.get(client, ())):
         # get() is used instead of pop() because
-        # "_delete_consumer" will discard "consumer_id" from "consumer_ids" to stop "_consume_loop",
+        # "_delete_consumer" will discard "consumer_id" from "consumer_ids", and "_dispatcher" will drop it from ready consumers,
         # and once client has no consumers - it will pop().
         # list(set()) is used to avoid "Set changed size during iteration".
 
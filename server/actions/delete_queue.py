@@ -5,10 +5,11 @@ from critbot import crit
 import logging
 
 from mqks.server.config import config, log
-from mqks.server.actions.rebind import rebind
-from mqks.server.lib import state
+from mqks.server.actions.rebind import _remove_partition, rebind
+from mqks.server.lib import state, wal
 from mqks.server.lib.clients import respond
 from mqks.server.lib.log import verbose
+from mqks.server.lib.workers import forward_action, serves_queue
 
 ### delete queue action
 
@@ -21,6 +22,10 @@ def delete_queue(request):
     )
     """
     queue = request['data']
+    if not serves_queue(queue) and not request.get('is_forwarded'):  # Client with old ring.
+        forward_action(request, queue)
+        return
+
     _delete_queue(request, queue)
 
 ### delete queue command
@@ -40,13 +45,18 @@ def _delete_queue(request, queue):
     request['confirm'] = False  # To avoid double confirm.
 
     rebind(request, queue)  # Unbind all by default.
+    if queue in state.partitions:
+        _remove_partition(request, queue)
+
+    for consumer_id in list(state.consumers_by_queues.get(queue, ())):
+        _delete_consumer(request, consumer_id)
 
-    for consumer_id, queue_of_consumer in state.queues_by_consumer_ids.items():
-        if queue_of_consumer == queue:
-            _delete_consumer(request, consumer_id)
+    _stop_dispatcher(queue)
 
-    state.queues.pop(queue, None)
-    state.queues_to_delete_when_unused.pop(queue, None)
+    if state.queues.pop(queue, None) is not None and config['wal']:
+        wal.delete_queue(queue)
+    if state.queues_to_delete_when_unused.pop(queue, None) is not None:
+        state.bindings_version += 1
 
     queue_used = state.queues_used.pop(queue, None)
     if queue_used:
@@ -79,4 +89,5 @@ def _wait_used_or_delete_queue(client, queue, seconds):
 
 ### anti-loop import
 
+from mqks.server.actions.consume import _stop_dispatcher
 from mqks.server.actions.delete_consumer import _delete_consumer
@@ -3,10 +3,13 @@
 
 import time
 
+from mqks.sharding import crc32, parse_partition
 from mqks.server.config import config
-from mqks.server.lib import state
+from mqks.server.lib import latency, state, wal
 from mqks.server.lib.clients import respond
-from mqks.server.lib.workers import at_queues_batch_worker
+from mqks.server.lib.compression import CODECS, PROP, check_compressed, compress
+from mqks.server.lib.event_masks import get_queues
+from mqks.server.lib.workers import at_queues_batch_worker, at_worker_sent_to, forward_publish, get_next_worker, get_worker, send_to_worker
 
 ### publish action
 
@@ -14,37 +17,204 @@ def publish(request):
     """
     Publish action
 
-    @param request: dict - defined in "on_request"
+    @param request: dict - defined in "on_request" with (
+        data: str - "[--z={codec}] [--key={partition_key}] {event} {data}" - codec of data compressed by client, if any
+    )
     """
     state.published += 1
-    event, data = request['data'].split(' ', 1)
-    msg = '{} event={} {}'.format(request['id'], event, data)
+    data = request['data']
+    codec = key = None
+    while data.startswith('--'):
+        option, data = data.split(' ', 1)
+        if option.startswith('--z='):
+            codec = option[4:]
+        elif option.startswith('--key='):
+            key = option[6:]
+        else:
+            assert False, option
+    event, data = data.split(' ', 1)
+    if codec:
+        check_compressed(codec, data)
 
-    queues = state.queues_by_events.get(event)
-    if queues:
-        _put_to_queues(request, queues, msg)
+    if get_worker(event) == state.worker:
+        _publish(request, request['id'], event, data, codec, key)
+    else:  # Client with old ring, see "mqks.server.lib.migration".
+        forward_publish(request, request['id'], event, data, codec, key)
 
     if request['confirm']:
         respond(request)  # Once.
 
+def _publish(request, msg_id, event, data, codec, key=None):
+    """
+    Publish msg of event at worker of event.
+
+    @param request: dict - defined in "on_request"
+    @param msg_id: str
+    @param event: str
+    @param data: str
+    @param codec: str|None - codec of data compressed by client
+    @param key: str|None - partition key, see "_pick_partitions"
+    """
+    queues = _get_queues(event, key)
+    if queues:
+        msg = _get_msg(msg_id, event, data, codec)
+        if config['latency']:
+            _put_to_queues(request, queues, msg, repr(time.time()))
+        else:
+            _put_to_queues(request, queues, msg)
+
     if config['top_events']:
-        event_mask = config['top_events_id'].sub('{id}', event)
-        state.top_events[event_mask] = state.top_events.get(event_mask, 0) + 1
+        _count_top_event(event)
+
+### publish forwarded command
+
+@at_worker_sent_to
+def _publish_forwarded(request, msg_id, event, data, codec, key):
+    """
+    Publish command forwarded from old worker of event, see "forward_publish".
+
+    @param request: dict - defined in "on_request"
+    @param msg_id: str
+    @param event: str
+    @param data: str
+    @param codec: str - empty if none
+    @param key: str - partition key, empty if none
+    """
+    _publish(request, msg_id, event, data, codec or None, key or None)
+
+### get msg
+
+def _get_msg(msg_id, event, data, codec=None):
+    """
+    Build message, compressing its data if needed, see "compress_bytes".
+
+    @param msg_id: str
+    @param event: str
+    @param data: str
+    @param codec: str|None - codec of data compressed by client
+    @return str - "{msg_id} event={event}[,z={codec}] {data}"
+    """
+    if codec is None:
+        codec, data = compress(data)
+    else:
+        assert codec in CODECS, codec
+
+    if codec:
+        return '{} event={},{}={} {}'.format(msg_id, event, PROP, codec, data)
+    return '{} event={} {}'.format(msg_id, event, data)
+
+### get queues
+
+def _get_queues(event, key=None):
+    """
+    Find queues subscribed to the event and to event masks matching it.
+
+    @param event: str
+    @param key: str|None - partition key, see "_pick_partitions"
+    @return set(str)|None
+    """
+    queues = state.queues_by_events.get(event)
+    if state.queues_by_event_masks:
+        queues_by_masks = get_queues(event)
+        if queues_by_masks:
+            if queues:
+                queues_by_masks.update(queues)
+            queues = queues_by_masks
+    if queues and state.partitions:
+        queues = _pick_partitions(queues, key)
+    return queues
+
+### pick partitions
+
+def _pick_partitions(queues, key):
+    """
+    Keep only one partition of each partitioned queue, see "mqks.sharding.get_partitions":
+    by hash of partition key, so messages with the same key keep their order, else round-robin.
+    Only partitions registered by "consume --partition" are picked, other queues like "q1#0" get all messages.
+
+    @param queues: set(str)
+    @param key: str|None
+    @return set(str) - new set, if any partition is dropped
+    """
+    partitions_by_queues = None  # partitions_by_queues[queue: str] == [tuple(index: int, partition: str)]
+    for queue in queues:
+        if queue in state.partitions:
+            base, index = parse_partition(queue)
+            if partitions_by_queues is None:
+                partitions_by_queues = {}
+            partitions_by_queues.setdefault(base, []).append((index, queue))
+
+    if not partitions_by_queues:
+        return queues
+
+    queues = set(queues)  # Not to change bindings.
+    point = state.published if key is None else crc32(key)
+    for partitions in partitions_by_queues.itervalues():
+        partitions.sort()
+        queues.difference_update(partition for _, partition in partitions)
+        queues.add(partitions[point % len(partitions)][1])
+    return queues
+
+### count top event
+
+def _count_top_event(event):
+    """
+    @param event: str
+    """
+    event_mask = config['top_events_id'].sub('{id}', event)
+    state.top_events[event_mask] = state.top_events.get(event_mask, 0) + 1
 
 ### put to queues command
 
 @at_queues_batch_worker
-def _put_to_queues(request, queues_batch, msg):
+def _put_to_queues(request, queues_batch, msg, published_at=None):
     """
     Put to queues command
 
     @param request: dict - defined in "on_request"
     @param queues_batch: str - a space-separated sublist of "queues" passed to "_put_to_queues", see "at_queues_batch_worker" and "command protocol"
     @param msg: str
+    @param published_at: str|None - "time.time()" at worker of event, if "latency" is enabled
     """
-    for queue in queues_batch.split(' '):
-        queue = state.queues.get(queue)
-        if queue:
-            queue.put(msg)
-            state.queued += 1
+    if published_at is not None:
+        published_at = float(published_at)
+
+    for queue_name in queues_batch.split(' '):
+        _put(queue_name, msg, published_at, request)
         time.sleep(0)
+
+def _put(queue_name, msg, published_at, request=None):
+    """
+    Put msg to the queue, if it exists at this worker.
+    Else forward msg to next worker of the queue, if the queue is moved there, see "mqks.server.lib.migration".
+
+    @param queue_name: str
+    @param msg: str
+    @param published_at: float|None
+    @param request: dict|None - defined in "on_request", None if msg is forwarded already
+    """
+    queue = state.queues.get(queue_name)
+    if queue:
+        queue.put(latency.on_enqueue(msg, published_at) if config['latency'] else msg)
+        state.queued += 1
+        if config['wal']:
+            wal.put(queue_name, msg)
+
+    elif request is not None:
+        worker = get_next_worker(queue_name)
+        if worker != state.worker:
+            send_to_worker(worker, '_put_forwarded', request, (queue_name, msg, '' if published_at is None else repr(published_at)))
+
+### put forwarded command
+
+@at_worker_sent_to
+def _put_forwarded(request, queue_name, msg, published_at):
+    """
+    Put msg to the queue moved to this worker, is not forwarded again.
+
+    @param request: dict - defined in "on_request"
+    @param queue_name: str
+    @param msg: str
+    @param published_at: str - empty if none
+    """
+    _put(queue_name, msg, float(published_at) if published_at else None)
@@ -0,0 +1,108 @@
+
+### import
+
+from collections import defaultdict
+import time
+
+from mqks.server.config import config
+from mqks.server.actions.publish import _count_top_event, _get_msg, _get_queues, _put
+from mqks.server.lib import state
+from mqks.server.lib.clients import respond
+from mqks.server.lib.compression import check_compressed
+from mqks.server.lib.workers import at_worker_sent_to, forward_publish, get_worker, send_to_worker
+
+### publish many action
+
+def publish_many(request):
+    """
+    Publish many action
+
+    @param request: dict - defined in "on_request" with (
+        data: str - "[--z={codec}] [--key={partition_key}] {event} {length} {data} ..." - all events should belong to this worker, see client "publish_many"
+    )
+    Each message gets "{request_id}.{index}" as its "msg_id", index is zero-based.
+    The whole body is parsed and validated first, so a malformed batch publishes nothing.
+    """
+
+    ### parse
+
+    msgs = []  # msgs == [tuple(event: str, data: str, codec: str|None, key: str|None)]
+    body = request['data']
+    start = 0
+
+    while start < len(body):
+        codec = key = None
+        while body.startswith('--', start):
+            option_end = body.index(' ', start)
+            if body.startswith('--z=', start):
+                codec = body[start + 4:option_end]
+            elif body.startswith('--key=', start):
+                key = body[start + 6:option_end]
+            else:
+                assert False, body[start:option_end]
+            start = option_end + 1
+
+        event_end = body.index(' ', start)
+        length_end = body.index(' ', event_end + 1)
+        event = body[start:event_end]
+        length = int(body[event_end + 1:length_end])
+        start = length_end + 1 + length
+        if length < 0 or start > len(body) or start < len(body) and body[start] != ' ':
+            raise ValueError('Length {} of data does not match at offset {}'.format(length, length_end + 1))
+        data = body[length_end + 1:start]
+        start += 1  # Space before next event.
+        if codec:
+            check_compressed(codec, data)
+        msgs.append((event, data, codec, key))
+
+    ### publish
+
+    args_by_workers = defaultdict(list)  # args_by_workers[worker: int] == [queues_batch: str, msg: str, queues_batch: str, msg: str, ...]
+    for index, (event, data, codec, key) in enumerate(msgs):
+        state.published += 1
+        msg_id = '{}.{}'.format(request['id'], index)
+
+        if get_worker(event) != state.worker:  # Client with old ring, see "mqks.server.lib.migration".
+            forward_publish(request, msg_id, event, data, codec, key)
+            continue
+
+        queues = _get_queues(event, key)
+        if queues:
+            msg = _get_msg(msg_id, event, data, codec)
+
+            queues_by_workers = defaultdict(list)
+            for queue in queues:
+                queues_by_workers[get_worker(queue)].append(queue)
+
+            for worker, queues_batch in queues_by_workers.iteritems():
+                args_by_workers[worker].extend((' '.join(queues_batch), msg))
+
+        if config['top_events']:
+            _count_top_event(event)
+
+    # One command per worker of queues for the whole batch:
+    published_at = repr(time.time()) if config['latency'] else ''
+    for worker, args in args_by_workers.iteritems():
+        send_to_worker(worker, '_put_many_to_queues', request, (published_at, ) + tuple(args))
+
+    if request['confirm']:
+        respond(request)  # Once.
+
+### put many to queues command
+
+@at_worker_sent_to
+def _put_many_to_queues(request, published_at, *args):
+    """
+    Put many to queues command
+
+    @param request: dict - defined in "on_request"
+    @param published_at: str - "time.time()" at worker of events, if "latency" is enabled, else empty string
+    @param args: tuple(queues_batch: str, msg: str, queues_batch: str, msg: str, ...) - see "publish_many"
+    """
+    published_at = float(published_at) if published_at else None
+
+    for index in xrange(0, len(args), 2):
+        queues_batch, msg = args[index], args[index + 1]
+        for queue_name in queues_batch.split(' '):
+            _put(queue_name, msg, published_at, request)
+        time.sleep(0)
@@ -3,12 +3,12 @@
 
 from gbn import gbn
 from gevent import spawn_later
-import re
 
 from mqks.server.config import config
 from mqks.server.lib import state
+from mqks.server.lib.event_masks import ANY, bind, build_index, get_events_by_masks, index_add, index_remove, is_mask, unbind
 from mqks.server.lib.clients import respond
-from mqks.server.lib.workers import at_worker_sent_to, get_worker, send_to_worker
+from mqks.server.lib.workers import at_all_workers, at_worker_sent_to, forward_action, get_next_worker, get_worker, send_to_worker, serves_queue
 
 ### rebind action
 
@@ -27,7 +27,7 @@ def rebind(request, queue=None, update_consumers=False, dont_update_consumer_id=
     @param queue: str
     @param update_consumers: bool - If there is some other need to update consumers, e.g. changing --delete-queue-when-unused.
     @param dont_update_consumer_id: str|None - No need to update consumer that initiated rebind on "consume" without "--add".
-    @param args: {'replace': [], 'remove': [], 'remove-mask': [], 'add': []} - No args means remove all.
+    @param args: {'replace': [], 'remove': [], 'remove-mask': [], 'add': []} - No args means remove all. Event masks are validated by caller.
     """
 
     ### when called from other actions
@@ -41,6 +41,11 @@ def rebind(request, queue=None, update_consumers=False, dont_update_consumer_id=
     else:
         wall = gbn('rebind.parse')
         queue, data = request['data'].split(' ', 1)
+        if not serves_queue(queue) and not request.get('is_forwarded'):  # Client with old ring.
+            gbn(wall=wall)
+            forward_action(request, queue)
+            return
+
         remove_all = not data
         if not remove_all:
             args = {'replace': [], 'remove': [], 'remove-mask': [], 'add': []}
@@ -51,6 +56,10 @@ def rebind(request, queue=None, update_consumers=False, dont_update_consumer_id=
                 elif part:
                     arg.append(part)
 
+            for event in args['replace'] + args['add']:
+                if ANY in event:
+                    is_mask(event)  # Validate before anything is changed.
+
     ### old_events
 
     wall = gbn('rebind.old_events', wall=wall)
@@ -83,19 +92,10 @@ def rebind(request, queue=None, update_consumers=False, dont_update_consumer_id=
 
         if args.get('remove-mask') and new_events:
             wall = gbn('rebind.remove-mask', wall=wall)
-            key = tuple(args['remove-mask'])
-            regexp = state.remove_mask_cache.get(key)
-
-            if not regexp:
-                regexp = state.remove_mask_cache[key] = re.compile('|'.join(
-                    '[^.]*'.join(
-                        re.escape(part) for part in mask.split('*')
-                    ) + '$' for mask in args['remove-mask']
-                ))
-                if len(state.remove_mask_cache) > config['remove_mask_cache_limit']:
-                    state.remove_mask_cache.clear()
-
-            new_events.difference_update([event for event in new_events if '.' in event and regexp.match(event)])
+            # Index of queue has "old_events", and "new_events" is a subset of them here, unless replaced:
+            index = build_index(new_events) if args.get('replace') else state.event_tries_by_queues.get(queue)
+            if index:
+                new_events.difference_update(get_events_by_masks(index, args['remove-mask']))
 
         ### add
 
@@ -136,7 +136,14 @@ def rebind(request, queue=None, update_consumers=False, dont_update_consumer_id=
                     consumer_client = state.clients_by_consumer_ids.get(consumer_id)
                     if consumer_client:
                         consumer_request = dict(id=consumer_id, client=consumer_client, worker=state.worker)  # Consumer clients are connected to worker of queue, processing rebind.
-                        respond(consumer_request, response_data + (' --manual-ack' if manual_ack else ''))
+                        prefetch = state.prefetch_by_consumer_ids.get(consumer_id)
+                        respond(consumer_request, ''.join((
+                            response_data,
+                            ' --manual-ack' if manual_ack else '',
+                            '' if prefetch is None else ' --prefetch={}'.format(prefetch),
+                            ' --compressed' if consumer_id in state.compressed_consumer_ids else '',
+                            ' --partition' if queue in state.partitions else '',
+                        )))
 
     ### send
 
@@ -148,12 +155,14 @@ def rebind(request, queue=None, update_consumers=False, dont_update_consumer_id=
         for events in remove, add:
             is_add_index = int(events is add)  # 0=remove, 1=add
             for event in events:
-                worker = get_worker(event)
-                if worker == state.worker:
-                    continue  # Worker of queue will get full _rebind.
-                if worker not in partial_rebinds:
-                    partial_rebinds[worker] = ([], [])  # Owl with square eyes: partial_remove, partial_add.
-                partial_rebinds[worker][is_add_index].append(event)
+                # Event mask may match events of any worker, so it is sent to all workers,
+                # to keep publish local to worker of event:
+                for worker in (xrange(len(config['workers'])) if ANY in event else (get_worker(event), )):
+                    if worker == state.worker:
+                        continue  # Worker of queue will get full _rebind.
+                    if worker not in partial_rebinds:
+                        partial_rebinds[worker] = ([], [])  # Owl with square eyes: partial_remove, partial_add.
+                    partial_rebinds[worker][is_add_index].append(event)
 
         # Send partial _rebind to unique workers of events:
         for worker, (partial_remove, partial_add) in partial_rebinds.iteritems():
@@ -177,7 +186,7 @@ def rebind(request, queue=None, update_consumers=False, dont_update_consumer_id=
 ### rebind command
 
 @at_worker_sent_to  # Not @at_all_workers. See routing in "rebind".
-def _rebind(request, queue, remove, add):
+def _rebind(request, queue, remove, add, is_forwarded=False):
     """
     Rebind command
 
@@ -185,10 +194,15 @@ def _rebind(request, queue, remove, add):
     @param queue: str
     @param remove: str - Space-separated list of events to remove from subscriptions of this queue 
     @param add: str - Space-separated list of events to add to subscriptions of this queue 
+    @param is_forwarded: bool
     """
 
     wall = gbn('_rebind.init')
     events = state.events_by_queues.get(queue)
+    is_worker_of_queue = serves_queue(queue)
+
+    if state.next_ring and not is_forwarded:
+        _forward_rebind(request, queue, remove, add)
 
     ### remove
 
@@ -200,6 +214,13 @@ def _rebind(request, queue, remove, add):
             state.events_by_queues.pop(queue, None)
 
         for event in remove:
+            if is_worker_of_queue:
+                index_remove(queue, event)
+
+            if ANY in event:
+                unbind(queue, event)
+                continue
+
             queues = state.queues_by_events.get(event)
             if queues:
                 queues.discard(queue)
@@ -217,6 +238,13 @@ def _rebind(request, queue, remove, add):
             state.events_by_queues[queue] = set(add)
 
         for event in add:
+            if is_worker_of_queue:
+                index_add(queue, event)
+
+            if ANY in event:
+                bind(queue, event)
+                continue
+
             queues = state.queues_by_events.get(event)
             if queues:
                 queues.add(queue)
@@ -225,8 +253,66 @@ def _rebind(request, queue, remove, add):
 
     ### confirm
 
+    state.bindings_version += 1
     gbn(wall=wall)
     if request['confirm'] and request['worker'] == state.worker:
         spawn_later(config['rebind_confirm_seconds'], respond, request)
         # "--confirm" is used mainly in tests.
         # Add result aggregation complexity as in "gbn_profile.get()" - if needed only.
+
+@at_worker_sent_to
+def _rebind_forwarded(request, queue, remove, add):
+    """
+    Rebind command forwarded to next worker of events, is not forwarded again.
+
+    @param request: dict - defined in "on_request"
+    @param queue: str
+    @param remove: str - Space-separated list of events
+    @param add: str - Space-separated list of events
+    """
+    _rebind(request, queue, remove, add, is_forwarded=True)
+
+def _forward_rebind(request, queue, remove, add):
+    """
+    Forward events of "_rebind" that move from this worker to their next workers, see "mqks.server.lib.migration".
+    Events stay bound here too, until migration is committed.
+
+    @param request: dict - defined in "on_request"
+    @param queue: str
+    @param remove: str - Space-separated list of events
+    @param add: str - Space-separated list of events
+    """
+    forwarded = {}  # forwarded[worker: int] == (remove: list(str), add: list(str))
+    for is_add_index, events in enumerate((remove, add)):
+        for event in events.split(' ') if events else ():
+            if ANY not in event and get_worker(event) == state.worker:  # Event masks are sent to all workers.
+                worker = get_next_worker(event)
+                if worker != state.worker:
+                    forwarded.setdefault(worker, ([], []))[is_add_index].append(event)
+
+    for worker, (forwarded_remove, forwarded_add) in forwarded.iteritems():
+        send_to_worker(worker, '_rebind_forwarded', dict(request, confirm=False), (queue, ' '.join(forwarded_remove), ' '.join(forwarded_add)))
+
+### partition commands
+
+@at_all_workers
+def _add_partition(request, queue):
+    """
+    Register partition of queue at all workers, see "consume --partition" and "mqks.server.actions.publish._pick_partitions".
+
+    @param request: dict - defined in "on_request"
+    @param queue: str - "{queue}#{index}"
+    """
+    state.partitions.add(queue)
+    state.bindings_version += 1
+
+@at_all_workers
+def _remove_partition(request, queue):
+    """
+    Unregister partition of deleted queue at all workers.
+
+    @param request: dict - defined in "on_request"
+    @param queue: str
+    """
+    state.partitions.discard(queue)
+    state.bindings_version += 1
@@ -4,9 +4,10 @@
 import logging
 
 from mqks.server.config import config, log
-from mqks.server.lib import state
+from mqks.server.lib import latency, state, wal
 from mqks.server.lib.clients import respond
 from mqks.server.lib.log import verbose
+from mqks.server.actions.consume import _resume_consumer
 
 ### reject - action
 
@@ -15,39 +16,42 @@ def reject(request):
     Reject action
 
     @param request: dict - defined in "on_request" with (
-        data: str - "{consumer_id} {msg_id}",
+        data: str - "{consumer_id} {msg_id} [{msg_id} ...]" or "{consumer_id} --all",
         ...
     )
     """
-    consumer_id, msg_id = request['data'].split(' ', 1)
+    consumer_id, msg_ids = request['data'].split(' ', 1)
     queue = state.queues_by_consumer_ids.get(consumer_id)
     if queue:
-        _reject(request, queue, consumer_id, msg_id)
+        _reject(request, queue, consumer_id, msg_ids)
     elif log.level == logging.DEBUG or config['grep']:
         verbose('w{}: found no queue for request={}'.format(state.worker, request))
 
 ### reject command
 
-def _reject(request, queue, consumer_id, msg_id):
+def _reject(request, queue, consumer_id, msg_ids):
     """
     Reject command
 
     @param request: dict - defined in "on_request"
     @param queue: str
     @param consumer_id: str
-    @param msg_id: str
+    @param msg_ids: str - "{msg_id} [{msg_id} ...]" or "--all"
     """
 
-    if msg_id == '--all':
+    if msg_ids == '--all':
         msgs = state.messages_by_consumer_ids.pop(consumer_id, {}).itervalues()
 
     else:
-        msg = state.messages_by_consumer_ids.get(consumer_id, {}).pop(msg_id, None)
-        msgs = () if msg is None else (msg, )
+        consumer_msgs = state.messages_by_consumer_ids.get(consumer_id, {})
+        msgs = [consumer_msgs.pop(msg_id) for msg_id in msg_ids.split(' ') if msg_id in consumer_msgs]
 
-    queue = state.queues.get(queue)
+    queue_name = queue
+    queue = state.queues.get(queue_name)
     if queue:
         for msg in msgs:
+            if config['latency']:
+                latency.on_ack(msg)
             msg_id, props, data = msg.split(' ', 2)
             new_props = []
             found_retry = False
@@ -60,7 +64,12 @@ def _reject(request, queue, consumer_id, msg_id):
             if not found_retry:
                 new_props.append(('retry', '1'))
             msg = ' '.join((msg_id, ','.join('='.join(prop) for prop in new_props), data))
-            queue.put(msg)
+            queue.put(latency.on_enqueue(msg) if config['latency'] else msg)
+            if config['wal']:
+                wal.remove(queue_name, msg_id)
+                wal.put(queue_name, msg)
+
+    _resume_consumer(queue_name, consumer_id)
 
     if request['confirm']:
         respond(request)
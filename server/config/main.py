@@ -22,6 +22,12 @@ config = dict(
         '127.0.0.1:24000:25000',
         '127.0.0.1:24001:25001',
     ],
+    ring_vnodes=0,                                      # 0 = legacy "hash(item) % len(workers)", the same placement as before the ring. Should be the same at all clients.
+                                                        # N = points of each worker on consistent-hash ring of queues and events, e.g. 100.
+                                                        # Switching moves almost all queues and events: it is a migration, see "mqks.sharding".
+    ring_hash='crc32',                                  # Or "xxh32" if "xxhash" package is installed at all clients and workers, see "mqks.sharding.HASHES".
+    ring_pins={},                                       # ring_pins[queue: str] == worker: int - hot queues moved to chosen workers by "migration.pin_queue".
+                                                        # Should be the same at all clients, e.g. updated with "workers".
 
     ### log
 
@@ -38,21 +44,66 @@ config = dict(
     top_events_limit=50,                                # Top-N events to report.
     top_events_id=re.compile(r'[0-9a-f]{24,}|[0-9]+'),  # 24+ hex or any decimal IDs will be masked as "{id}".
 
+    ### latency
+
+    latency=False,                                      # Enable histograms of latency: publish->enqueue, enqueue->dispatch, dispatch->ack. See "stats.py --latency".
+    latency_by_event_masks=False,                       # Also split histograms by event masks, built like in "top_events".
+    latency_event_masks_limit=100,                      # Max event masks with own histograms per stage, to keep memory fixed.
+
+    ### compression
+
+    compress_bytes=0,                                   # Compress data of published messages that is N bytes or bigger, once at worker of event. 0 = disabled.
+                                                        # Compressed data is kept in queues and sent between workers. Consumers get it compressed only with "--compressed".
+    compress_codec='zlib',                              # Or "lz4" if "lz4" package is installed. Client may compress data itself with any codec installed at server.
+    compress_level=1,                                   # Level of "zlib": 1 = fastest, 9 = smallest.
+
     ### gbn_profile
 
     gbn_profile=False,                                  # Eval "gbn_profile.enable(),get(),disable()" from any worker to manage gbn profiler all workers.
     gbn_seconds=60*5,                                   # Report and reset profile each N seconds.
 
+    ### wal
+
+    wal=False,                                          # Enable write-ahead log to recover queued messages on restart of worker. See "mqks.server.lib.wal".
+    wal_dir='/var/lib/mqks/wal',                        # Each worker logs to its own subdir "w{worker}".
+    wal_fsync_seconds=0.1,                              # Group commit: write and fsync buffered records each N seconds. Records of last N seconds may be lost on crash.
+    wal_segment_bytes=64*1024*1024,                     # Rotate segment when it is that big.
+    wal_compact_ratio=2,                                # On rotation, compact log to live messages if all segments are N times bigger than live messages.
+
+    ### bindings_snapshot
+
+    bindings_snapshot=False,                            # Save bindings and options of queues to file and load them on restart of worker - to avoid dropped publishes and rebind storm.
+    bindings_snapshot_dir='/var/lib/mqks/bindings',     # Each worker saves to its own file "w{worker}".
+    bindings_snapshot_seconds=10,                       # Save snapshot each N seconds, if bindings were changed.
+    bindings_snapshot_grace_seconds=60,                 # On restart, wait N seconds at least for consumers to reconnect before deleting queues that are unused.
+
+    ### migration
+
+    migration_step_seconds=60,                          # Max seconds for each step of "migration.set_workers()" at all workers.
+    migration_grace_seconds=60,                         # Moved queue to delete when unused waits N seconds at least for its consumers to follow "--moved".
+
+    ### shm
+
+    shm_commands=False,                                 # Send commands to workers on the same host via ring buffers in shared memory instead of UNIX sockets. Linux on x86-64 only.
+                                                        # Ring buffers are files in "unix_sock_dir", so it should be on tmpfs, e.g. "/dev/shm/mqks". See "mqks.server.lib.shm".
+    shm_commands_bytes=4*1024*1024,                     # Size of ring buffer from one worker to another. Sender waits when it is full.
+    shm_commands_poll_seconds=0.01,                     # Max seconds for receiver to notice commands when wakeup is missed, and for sender to retry when ring buffer is full.
+
     ### other
 
     backlog=256,                                        # How many clients and other workers may wait for accept by TCP server.
     unix_sock_dir='/tmp/mqks',                          # Directory to connect workers on the same host via UNIX sockets.
     warn_command_bytes=100*1024,                        # Warn if command sent between workers is that big - may point to client-side problem.
+    commands_batch_bytes=64*1024,                       # Max bytes of commands coalesced into one "sendall" to other worker. Single bigger command is sent alone.
+    commands_batch_count=1000,                          # Max number of commands coalesced into one "sendall" to other worker.
+    commands_batch_seconds=0,                           # Nagle-style: wait N seconds for more commands when batch is not full. 0 = send what is queued right now.
+    commands_recv_bytes=64*1024,                        # Max bytes of commands received from other worker and parsed at once.
+    responses_batch_bytes=64*1024,                      # Max bytes of responses coalesced into one "sendall" to client. Single bigger response is sent alone.
     block_seconds=1,                                    # Wait at most N seconds before checking some condition again. Less seconds = more reactive = more CPU load.
     rebind_confirm_seconds=0.1,                         # Time for other workers to get rebind. "--confirm" is used mainly in tests.
     id_length=24,                                       # Length of random ID. More bytes = more secure = more slow.
     client_postfix_length=4,                            # Length of random part of client ID. More bytes = more secure = more slow.
-    remove_mask_cache_limit=100500,                     # How many compiled regexps for "--remove-mask" feature are cached before cache is cleared.
+    remove_mask_cache_limit=100500,                     # How many compiled regexps for segments like "id*" of "--remove-mask" are cached. Least recently used are evicted.
     seconds_before_gc=60,                               # Trying to minimize memory leaks by forcing GC from time to time.
 )
 
@@ -0,0 +1,139 @@
+
+### import
+
+from critbot import crit
+from gbn import gbn
+from gevent import spawn
+from gevent.event import Event
+from gevent.queue import Queue
+import os
+import time
+
+from mqks.server.config import config, log
+from mqks.server.lib import state
+from mqks.server.lib.event_masks import ANY, bind, get_segment_regexp, index_add
+from mqks.server.lib.workers import get_worker
+
+### const
+
+# "snapshot protocol" - one '\t'-separated line per item, like "command protocol":
+EVENTS_BY_QUEUE = 'q'               # q\t{queue}\t{event} ... {event}
+QUEUES_BY_EVENT = 'e'               # e\t{event}\t{queue} ... {queue}
+DELETE_QUEUE_WHEN_UNUSED = 'd'      # d\t{queue}\tTrue|{seconds}
+REMOVE_MASK = 'm'                   # m\t{event_mask_segment}
+PARTITION = 'p'                     # p\t{queue}
+
+### get path
+
+def _get_path():
+    """
+    @return str - snapshot file of this worker
+    """
+    return os.path.join(config['bindings_snapshot_dir'], 'w{}'.format(state.worker))
+
+### save
+
+def save():
+    """
+    Save bindings, options of queues, partitions and keys of "remove_mask_cache" to the snapshot file atomically.
+    """
+    wall = gbn('bindings_snapshot.save')
+    version = state.bindings_version
+
+    lines = []
+    for queue, events in state.events_by_queues.iteritems():
+        lines.append('\t'.join((EVENTS_BY_QUEUE, queue, ' '.join(events))))
+    for event, queues in state.queues_by_events.iteritems():
+        lines.append('\t'.join((QUEUES_BY_EVENT, event, ' '.join(queues))))
+    for queue, delete_queue_when_unused in state.queues_to_delete_when_unused.iteritems():
+        lines.append('\t'.join((DELETE_QUEUE_WHEN_UNUSED, queue, str(delete_queue_when_unused))))
+    for segment in state.remove_mask_cache:  # LRU order is kept.
+        lines.append('\t'.join((REMOVE_MASK, segment)))
+    for queue in state.partitions:
+        lines.append('\t'.join((PARTITION, queue)))
+
+    path = _get_path()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(tmp_path, path)  # Atomic: "load" sees either old or new complete snapshot.
+
+    state.bindings_version_saved = version
+    gbn(wall=wall)
+
+### saver
+
+def saver():
+    """
+    Saves snapshot each "bindings_snapshot_seconds", if bindings were changed.
+    """
+    while 1:
+        try:
+            time.sleep(config['bindings_snapshot_seconds'])
+            if state.bindings_version != state.bindings_version_saved:
+                save()
+
+        except Exception:
+            crit()
+
+### load
+
+def load():
+    """
+    Load snapshot of this worker, if any.
+    Should be called on start of worker, before "server_for_clients" is started.
+    Queues of this worker are created, so messages published before their consumers reconnect are kept.
+    Queues to delete when unused wait "bindings_snapshot_grace_seconds" at least for their consumers to reconnect.
+    """
+    wall = gbn('bindings_snapshot.load')
+    if not os.path.exists(config['bindings_snapshot_dir']):
+        os.makedirs(config['bindings_snapshot_dir'])
+
+    path = _get_path()
+    if not os.path.exists(path):
+        gbn(wall=wall)
+        return
+
+    with open(path) as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            kind = parts[0]
+
+            if kind == EVENTS_BY_QUEUE:
+                queue = parts[1]
+                events = state.events_by_queues[queue] = set(parts[2].split(' '))
+                is_worker_of_queue = get_worker(queue) == state.worker
+                if is_worker_of_queue:
+                    state.queues.setdefault(queue, Queue())
+                for event in events:
+                    if is_worker_of_queue:
+                        index_add(queue, event)
+                    if ANY in event:
+                        bind(queue, event)  # Event masks are sent to all workers, so they are always in "events_by_queues" too.
+
+            elif kind == QUEUES_BY_EVENT:
+                state.queues_by_events[parts[1]] = set(parts[2].split(' '))
+
+            elif kind == DELETE_QUEUE_WHEN_UNUSED:
+                queue, delete_queue_when_unused = parts[1:]
+                delete_queue_when_unused = True if delete_queue_when_unused == 'True' else float(delete_queue_when_unused)
+                state.queues_to_delete_when_unused[queue] = delete_queue_when_unused
+                state.queues_used[queue] = Event()  # Not used yet.
+                seconds = max(config['bindings_snapshot_grace_seconds'], 0 if delete_queue_when_unused is True else delete_queue_when_unused)
+                spawn(_wait_used_or_delete_queue, 'bindings_snapshot', queue, seconds=seconds)
+
+            elif kind == REMOVE_MASK:
+                get_segment_regexp(parts[1])
+
+            elif kind == PARTITION:
+                state.partitions.add(parts[1])
+
+    state.bindings_version_saved = state.bindings_version
+
+    log.info('w{}: loaded bindings snapshot: {} queues, {} events, {} queues to delete when unused'.format(
+        state.worker, len(state.events_by_queues), len(state.queues_by_events), len(state.queues_to_delete_when_unused)))
+    gbn(wall=wall)
+
+### anti-loop import
+
+from mqks.server.actions.delete_queue import _wait_used_or_delete_queue
@@ -7,15 +7,32 @@ from gevent import spawn
 from gevent.queue import Queue, Empty
 import logging
 import os
+from struct import Struct
 import time
 from uqid import dtid, uqid
 
 from mqks.server.config import config, log
 from mqks.server.lib import state
+from mqks.escape import escape
 from mqks.server.lib.log import verbose
 from mqks.server.lib.sockets import is_disconnect
 from mqks.server.lib.workers import at_request_worker
 
+### const
+
+# "protocol v2" - opt-in binary framing, see "spec.txt":
+V2_MAGIC = 'MQKS2\n'                    # Client sends it first to switch the connection to v2, server sends it back.
+V2_REQUEST_HEADER = Struct('!BBHII')    # action_code, flags, id_length, args_length, payload_length
+V2_RESPONSE_HEADER = Struct('!BHI')     # response_code, id_length, data_length
+V2_CONFIRM = 1                          # Flag: "--confirm".
+V2_PAYLOAD = 2                          # Flag: "data" of action is "{args} {payload}" if args are not empty, even if payload is empty.
+V2_OK = 0                               # Response code.
+V2_ERROR = 1                            # Response code, data is "error_id".
+ESCAPED_PROP = 'esc=1'                  # Prop of message with data escaped for "protocol v1" client, see "escape_msg".
+
+# Append only: index is "action_code", the same list is in "mqks.client.mqks".
+V2_ACTIONS = ['ping', 'publish', 'publish_many', 'consume', 'rebind', 'ack', 'reject', 'delete_consumer', 'delete_queue', '_eval']
+
 ### load_actions
 
 def load_actions():
@@ -50,16 +67,20 @@ def on_client_connected(sock, addr):
         spawn(responder, client)
 
         f = sock.makefile('r')
-        while 1:
-            request = dict(client=client, worker=state.worker)
+        request = dict(client=client, worker=state.worker, body=f.readline())
 
-            request['body'] = f.readline()
-            if request['body'] == '':
-                break
+        if request['body'] == V2_MAGIC:
+            state.v2_clients.add(client)
+            sock.sendall(V2_MAGIC)
+            _read_v2_requests(client, f)
 
-            assert '\t' not in request['body']  # See "spec.txt".
-            on_request(request)
-            time.sleep(0)
+        else:
+            while request['body'] != '':
+                assert '\t' not in request['body']  # See "spec.txt".
+                on_request(request)
+                time.sleep(0)
+
+                request = dict(client=client, worker=state.worker, body=f.readline())
 
     except Exception as e:
         if not is_disconnect(e):
@@ -72,10 +93,44 @@ def on_client_connected(sock, addr):
             delete_consumers(client)
             state.responses_by_clients.pop(client)
             state.socks_by_clients.pop(client)
+            state.v2_clients.discard(client)
 
         except Exception:
             crit(also=dict(client=client))
 
+### read v2 requests
+
+def _read_v2_requests(client, f):
+    """
+    Reads "protocol v2" frames from client until disconnect.
+    Header has fixed size, so id, args and payload are sliced at known offsets, without scanning for separators.
+
+    @param client: str
+    @param f: file - "sock.makefile()"
+    """
+    header_size = V2_REQUEST_HEADER.size
+    while 1:
+        header = f.read(header_size)
+        if len(header) < header_size:
+            break
+
+        action_code, flags, id_length, args_length, payload_length = V2_REQUEST_HEADER.unpack(header)
+        body_length = id_length + args_length + payload_length
+        body = f.read(body_length)
+        if len(body) < body_length:
+            break
+
+        args_end = id_length + args_length
+        on_request(dict(
+            client=client,
+            worker=state.worker,
+            id=body[:id_length],
+            action=V2_ACTIONS[action_code],
+            data=body[id_length:args_end] + ' ' + body[args_end:] if flags & V2_PAYLOAD and args_length else body[id_length:],
+            confirm=bool(flags & V2_CONFIRM),
+        ))
+        time.sleep(0)
+
 ### on_request
 
 def on_request(request):
@@ -86,7 +141,7 @@ def on_request(request):
         client: str,
         worker: int,
         body: str,
-    )
+    ) - "protocol v1", or already parsed "protocol v2" request with "id, action, data, confirm" below.
 
     "action()" gets "request" without "body" but with (
         id: str,
@@ -101,18 +156,22 @@ def on_request(request):
     )
     """
     wall = gbn('on_request')
-    request['id'] = None
+    request.setdefault('id', None)
     try:
-        body = request['body'].rstrip()
-        request['id'], request['action'], request['data'] = body.split(' ', 2)
-        del request['body']  # Less data to pass between workers. On error "request" with "id, action, data" will be logged.
+        if 'body' in request:
+            body = request['body'].rstrip('\r\n')  # Not spaces: they may end data of known length, see "publish_many".
+            request['id'], request['action'], request['data'] = body.split(' ', 2)
+            del request['body']  # Less data to pass between workers. On error "request" with "id, action, data" will be logged.
 
-        if log.level == logging.DEBUG or config['grep']:
-            verbose('w{}: {}#{} > {} {}'.format(state.worker, request['client'], request['id'], request['action'], request['data']))
+            request['confirm'] = request['data'].startswith('--confirm ')
+            if request['confirm']:
+                request['data'] = request['data'][10:]
 
-        request['confirm'] = request['data'].startswith('--confirm ')
-        if request['confirm']:
-            request['data'] = request['data'][10:]
+        elif ' ' in request['id'] or '\t' in request['id'] or '\n' in request['id']:  # "protocol v2" id is not escaped in "command protocol" and logs.
+            raise ValueError('Invalid request id {!r}'.format(request['id']))
+
+        if log.level == logging.DEBUG or config['grep']:
+            verbose('w{}: {}#{} > {}{} {}'.format(state.worker, request['client'], request['id'], request['action'], ' --confirm' if request['confirm'] else '', request['data']))
 
         action = state.actions[request['action']]
         wall = gbn(request['action'], wall=wall)
@@ -148,11 +207,28 @@ def respond(request, data=''):
     if responses:
         responses.put((request, data))
 
+### escape_msg
+
+def escape_msg(request, msg):
+    """
+    Escape data of message with newlines for "protocol v1" client, e.g. binary data published via "protocol v2".
+    Escaped message gets "esc=1" prop, so client knows to unescape data, see "mqks.escape".
+
+    @param request: dict - defined in "on_request"
+    @param msg: str - "{msg_id} {props} {data}"
+    @return str
+    """
+    if '\n' not in msg or request['client'] in state.v2_clients:
+        return msg
+    msg_id, props, data = msg.split(' ', 2)
+    return ' '.join((msg_id, props + ',' + ESCAPED_PROP, escape(data)))
+
 ### responder
 
 def responder(client):
     """
     Sends queued responses to socket of client.
+    All responses queued by now are coalesced into one "sendall", up to "responses_batch_bytes".
     See also "mqks.server.lib.workers.respond()" that enqueues response to "state.responses_by_clients[client]".
 
     @param client: str
@@ -172,23 +248,52 @@ def responder(client):
                 continue
 
             wall = gbn('responder')
-            try:
-                request, data = response
-                error_id = request.get('error_id')
-                response = '{} {}'.format('error' if error_id else 'ok', error_id or data)
-                if log.level == logging.DEBUG or config['grep']:
-                    verbose('w{}: {}#{} < {}'.format(state.worker, client, request['id'], response))
-                response = '{} {}\n'.format(request['id'], response)
-
-            except Exception:
-                gbn(wall=wall)
-                crit(also=dict(response=response))
-                continue
-
-            try:
-                sock.sendall(response)
-                # Disconnect on socket error.
-            finally:
+            is_v2 = client in state.v2_clients
+            batch = []
+            batch_bytes = 0
+            while 1:
+                try:
+                    request, data = response
+                    error_id = request.get('error_id')
+
+                    if is_v2:
+                        if log.level == logging.DEBUG or config['grep']:
+                            verbose('w{}: {}#{} < {} {}'.format(state.worker, client, request['id'], 'error' if error_id else 'ok', error_id or data))
+                        data = error_id or data
+                        response = V2_RESPONSE_HEADER.pack(V2_ERROR if error_id else V2_OK, len(request['id']), len(data)) + request['id'] + data
+
+                    else:
+                        response = '{} {}'.format('error' if error_id else 'ok', error_id or data)
+                        if '\n' in response:
+                            response = response.encode('string_escape')  # Should not break lines of "protocol v1". Messages are escaped with a marker by "escape_msg", this is for others, e.g. "_eval".
+                        if log.level == logging.DEBUG or config['grep']:
+                            verbose('w{}: {}#{} < {}'.format(state.worker, client, request['id'], response))
+                        response = '{} {}\n'.format(request['id'], response)
+
+                    batch.append(response)
+                    batch_bytes += len(response)
+
+                except Exception:
+                    crit(also=dict(response=response))
+
+                if batch_bytes >= config['responses_batch_bytes']:
+                    break
+
+                try:
+                    response = responses.get_nowait()  # Drain what is queued already, don't wait for more.
+                except Empty:
+                    break
+
+            if batch:
+                try:
+                    sock.sendall(''.join(batch))
+                    # Disconnect on socket error.
+                finally:
+                    gbn(wall=wall)
+
+                state.responses_sent += len(batch)
+                state.responses_flushes += 1
+            else:
                 gbn(wall=wall)
 
             time.sleep(0)
@@ -0,0 +1,88 @@
+
+### import
+
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from mqks.server.config import config
+from mqks.server.lib import state
+
+### const
+
+PROP = 'z'  # Prop "z={codec}" of message means its data is compressed.
+LZ4_MAGIC = '\x04\x22\x4d\x18'  # Magic number of lz4 frame, little-endian.
+
+def _is_zlib(data):
+    """
+    @param data: str
+    @return bool - data starts with zlib header: deflate method and header checksum, see RFC 1950
+    """
+    return len(data) >= 2 and ord(data[0]) & 0x0f == 8 and (ord(data[0]) << 8 | ord(data[1])) % 31 == 0
+
+CODECS = dict(  # CODECS[codec: str] == tuple(compress: callable(data: str) -> str, decompress: callable(data: str) -> str, is_valid: callable(data: str) -> bool)
+    zlib=(lambda data: zlib.compress(data, config['compress_level']), zlib.decompress, _is_zlib),
+)
+if lz4:
+    CODECS['lz4'] = (lz4.frame.compress, lz4.frame.decompress, lambda data: data.startswith(LZ4_MAGIC))
+
+### compress
+
+def compress(data):
+    """
+    Compress data of new message, if it is big enough and compression helps.
+
+    @param data: str
+    @return tuple(codec: str|None, data: str)
+    """
+    if not config['compress_bytes'] or len(data) < config['compress_bytes']:
+        return None, data
+
+    codec = config['compress_codec']
+    compressed = CODECS[codec][0](data)
+    if len(compressed) >= len(data):
+        return None, data
+
+    state.compressed += 1
+    state.compressed_bytes_saved += len(data) - len(compressed)
+    return codec, compressed
+
+### check compressed
+
+def check_compressed(codec, data):
+    """
+    Check data compressed by client at worker of client: codec and header only, without decompression.
+    Data with valid header and corrupt body is dropped on dispatch, see "mqks.server.actions.consume._dispatcher".
+
+    @param codec: str
+    @param data: str
+    @raise ValueError - if codec is unknown or data has no header of this codec
+    """
+    if codec not in CODECS:
+        raise ValueError('Unknown codec "{}"'.format(codec))
+    if not CODECS[codec][2](data):
+        raise ValueError('Data is not compressed with "{}"'.format(codec))
+
+### decompress msg
+
+def decompress_msg(msg):
+    """
+    Decompress message for consumer that did not ask for "--compressed" data.
+
+    @param msg: str - "{msg_id} {props} {data}", props include "z={codec}"
+    @return str - "{msg_id} {props} {data}" without "z" prop and with decompressed data
+    """
+    msg_id, props, data = msg.split(' ', 2)
+    new_props = []
+    for prop in props.split(','):
+        name, value = prop.split('=', 1)
+        if name == PROP:
+            data = CODECS[value][1](data)
+        else:
+            new_props.append(prop)
+
+    state.decompressed += 1
+    return ' '.join((msg_id, ','.join(new_props), data))
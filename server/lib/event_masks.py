@@ -0,0 +1,291 @@
+
+### import
+
+import re
+
+from mqks.server.config import config
+from mqks.server.lib import state
+
+### const
+
+ANY = '*'   # Event mask segment that matches any one segment of event.
+
+# Trie of dot-separated segments:
+#   root[segment: str][segment: str]...[None] == set([value: str])
+# Each trie holds keys with the same number of segments, so matching stops at the right depth.
+
+### is mask
+
+def is_mask(event):
+    """
+    Checks if this event is an event mask like "user.*.connected".
+    Only whole segments may be masked: "user.*" is a mask, "user*" is not allowed.
+
+    @param event: str
+    @return bool
+    @raise AssertionError
+    """
+    if ANY not in event:
+        return False
+    assert all(segment == ANY or ANY not in segment for segment in event.split('.')), event
+    return True
+
+### trie add
+
+def trie_add(root, segments, value):
+    """
+    Add value to the trie node at the path of segments.
+
+    @param root: dict - defined in "const"
+    @param segments: list(str)
+    @param value: str
+    """
+    node = root
+    for segment in segments:
+        child = node.get(segment)
+        if child is None:
+            child = node[segment] = {}
+        node = child
+
+    values = node.get(None)
+    if values is None:
+        node[None] = set((value, ))
+    else:
+        values.add(value)
+
+### trie remove
+
+def trie_remove(root, segments, value):
+    """
+    Remove value from the trie node at the path of segments, prune empty nodes.
+
+    @param root: dict - defined in "const"
+    @param segments: list(str)
+    @param value: str
+    """
+    path = []
+    node = root
+    for segment in segments:
+        child = node.get(segment)
+        if child is None:
+            return
+        path.append((node, segment))
+        node = child
+
+    values = node.get(None)
+    if values is None:
+        return
+
+    values.discard(value)
+    if values:
+        return
+    del node[None]
+
+    for parent, segment in reversed(path):
+        if parent[segment]:
+            break
+        del parent[segment]
+
+### trie match
+
+def trie_match(root, segments):
+    """
+    Find values of all masks in the trie matching the event.
+    Visits at most two children per node: exact segment and "*".
+
+    @param root: dict - defined in "const"
+    @param segments: list(str) - of event, not of mask
+    @return set(str)
+    """
+    nodes = [root]
+    for segment in segments:
+        next_nodes = []
+        for node in nodes:
+            child = node.get(segment)
+            if child is not None:
+                next_nodes.append(child)
+            child = node.get(ANY)
+            if child is not None:
+                next_nodes.append(child)
+        if not next_nodes:
+            return set()
+        nodes = next_nodes
+
+    result = set()
+    for node in nodes:
+        values = node.get(None)
+        if values:
+            result.update(values)
+    return result
+
+### bind, unbind, get queues
+
+def bind(queue, event_mask):
+    """
+    Subscribe the queue to events matching the event mask.
+
+    @param queue: str
+    @param event_mask: str
+    """
+    segments = event_mask.split('.')
+    root = state.queues_by_event_masks.get(len(segments))
+    if root is None:
+        root = state.queues_by_event_masks[len(segments)] = {}
+    trie_add(root, segments, queue)
+
+def unbind(queue, event_mask):
+    """
+    Unsubscribe the queue from events matching the event mask.
+
+    @param queue: str
+    @param event_mask: str
+    """
+    segments = event_mask.split('.')
+    root = state.queues_by_event_masks.get(len(segments))
+    if root is not None:
+        trie_remove(root, segments, queue)
+        if not root:
+            del state.queues_by_event_masks[len(segments)]
+
+def get_queues(event):
+    """
+    Find queues subscribed to event masks matching the event.
+    Time is proportional to the number of segments of event, not to the number of masks.
+
+    @param event: str
+    @return set(str)|None
+    """
+    segments = event.split('.')
+    root = state.queues_by_event_masks.get(len(segments))
+    if root is not None:
+        return trie_match(root, segments) or None
+
+### index of events of queue
+
+def index_add(queue, event):
+    """
+    Add event to the index of dotted events of the queue, used by "--remove-mask".
+    Index is kept at worker of queue only.
+
+    @param queue: str
+    @param event: str
+    """
+    segments = event.split('.')
+    if len(segments) < 2:
+        return  # "--remove-mask" never removes events without dots.
+
+    index = state.event_tries_by_queues.get(queue)
+    if index is None:
+        index = state.event_tries_by_queues[queue] = {}
+
+    root = index.get(len(segments))
+    if root is None:
+        root = index[len(segments)] = {}
+
+    trie_add(root, segments, event)
+
+def index_remove(queue, event):
+    """
+    Remove event from the index of dotted events of the queue.
+
+    @param queue: str
+    @param event: str
+    """
+    segments = event.split('.')
+    index = state.event_tries_by_queues.get(queue)
+    if index is None or len(segments) < 2:
+        return
+
+    root = index.get(len(segments))
+    if root is not None:
+        trie_remove(root, segments, event)
+        if not root:
+            del index[len(segments)]
+            if not index:
+                del state.event_tries_by_queues[queue]
+
+def build_index(events):
+    """
+    Build temporary index of dotted events, e.g. for new list of events that replaces subscriptions of the queue.
+
+    @param events: iterable(str)
+    @return dict - index[segments: int] == trie
+    """
+    index = {}
+    for event in events:
+        segments = event.split('.')
+        if len(segments) >= 2:
+            root = index.get(len(segments))
+            if root is None:
+                root = index[len(segments)] = {}
+            trie_add(root, segments, event)
+    return index
+
+### get events by masks
+
+def get_events_by_masks(index, event_masks):
+    """
+    Find events in the index matching any of event masks.
+    Visits only subtrees matching the masks, not all events of the queue.
+    Unlike subscribed event masks, "*" of "--remove-mask" may be a part of segment, e.g. "user.id*.connected".
+
+    @param index: dict - index[segments: int] == trie
+    @param event_masks: list(str)
+    @return set(str)
+    """
+    result = set()
+    for event_mask in event_masks:
+        segments = event_mask.split('.')
+        root = index.get(len(segments))
+        if root is None:
+            continue
+
+        nodes = [root]
+        for segment in segments:
+            next_nodes = []
+
+            if segment == ANY:
+                for node in nodes:
+                    next_nodes.extend(child for key, child in node.iteritems() if key is not None)
+
+            elif ANY in segment:
+                regexp = get_segment_regexp(segment)
+                for node in nodes:
+                    next_nodes.extend(child for key, child in node.iteritems() if key is not None and regexp.match(key))
+
+            else:
+                for node in nodes:
+                    child = node.get(segment)
+                    if child is not None:
+                        next_nodes.append(child)
+
+            nodes = next_nodes
+            if not nodes:
+                break
+
+        for node in nodes:
+            values = node.get(None)
+            if values:
+                result.update(values)
+
+    return result
+
+### get segment regexp
+
+def get_segment_regexp(segment):
+    """
+    Get compiled regexp for one segment of "--remove-mask" like "id*", from LRU cache or compile it.
+
+    @param segment: str
+    @return SRE_Pattern
+    """
+    cache = state.remove_mask_cache
+    regexp = cache.pop(segment, None)
+
+    if regexp is None:
+        regexp = re.compile('[^.]*'.join(re.escape(part) for part in segment.split(ANY)) + '$')
+        if len(cache) >= config['remove_mask_cache_limit']:
+            cache.popitem(last=False)  # Least recently used.
+
+    cache[segment] = regexp  # Most recently used.
+    return regexp
@@ -6,7 +6,7 @@ from gevent import spawn, wait
 from gevent.event import AsyncResult
 from uqid import dtid
 
-from mqks.server.config import config, WORKERS
+from mqks.server.config import config
 from mqks.server.lib import state
 from mqks.server.lib.workers import at_all_workers, at_request_worker
 
@@ -73,13 +73,14 @@ def get():
     @return str - aggregated gbn profile, empty on timeout.
     """
     wall = gbn('gbn_profile.get')
-    state.gbn_profiles = [AsyncResult() for _ in xrange(WORKERS)]
+    workers = len(config['workers'])
+    state.gbn_profiles = [AsyncResult() for _ in xrange(workers)]
 
     request = dict(id='gbn', worker=state.worker)
     _gbn_get(request)
 
     ready = wait(state.gbn_profiles, timeout=config['block_seconds'])
-    if len(ready) < WORKERS:
+    if len(ready) < workers:
         gbn(wall=wall)
         return ''
 
@@ -92,7 +93,7 @@ def get():
     _calls = {}
     _switches = {}
 
-    for worker in xrange(WORKERS):
+    for worker in xrange(workers):
         lines = state.gbn_profiles[worker].get()
         if not lines:
             continue
@@ -0,0 +1,197 @@
+
+### import
+
+import time
+
+from mqks.server.config import config
+from mqks.server.lib import state
+
+### const
+
+# Stages of message:
+PUBLISH_ENQUEUE = 'publish_enqueue'     # From "publish" at worker of event to "put" to queue at worker of queue.
+ENQUEUE_DISPATCH = 'enqueue_dispatch'   # From "put" to queue to "respond" to consumer.
+DISPATCH_ACK = 'dispatch_ack'           # From "respond" to consumer with manual ack to "ack" or "reject".
+STAGES = (PUBLISH_ENQUEUE, ENQUEUE_DISPATCH, DISPATCH_ACK)
+
+ALL = '*'   # Key of histogram of all events, see "state.latency_histograms".
+
+# HDR-style log-linear histogram of microseconds, fixed memory:
+#   values below 2 * SUB_BUCKETS have exact buckets,
+#   each next power of 2 is split to SUB_BUCKETS linear buckets, so relative error is at most 1 / SUB_BUCKETS.
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+MAX_SHIFT = 32                                  # Values up to 2 ** 37 microseconds == 38 hours.
+BUCKETS = SUB_BUCKETS * (MAX_SHIFT + 2)
+
+### buckets
+
+def get_bucket(microseconds):
+    """
+    @param microseconds: int
+    @return int - index of bucket
+    """
+    if microseconds < 2 * SUB_BUCKETS:
+        return max(microseconds, 0)  # Clock may go back.
+    shift = min(microseconds.bit_length() - SUB_BUCKET_BITS - 1, MAX_SHIFT)
+    return min(SUB_BUCKETS * shift + (microseconds >> shift), BUCKETS - 1)
+
+def get_microseconds(bucket):
+    """
+    @param bucket: int - index of bucket
+    @return int - highest value of bucket
+    """
+    if bucket < 2 * SUB_BUCKETS:
+        return bucket
+    shift = bucket // SUB_BUCKETS - 1
+    return ((bucket - SUB_BUCKETS * shift + 1) << shift) - 1
+
+### record
+
+def record(stage, seconds, event_mask=None):
+    """
+    Count the latency in the histogram of the stage, for all events and for the event mask.
+
+    @param stage: str - one of STAGES
+    @param seconds: float
+    @param event_mask: str|None
+    """
+    histograms = state.latency_histograms.get(stage)
+    if histograms is None:
+        histograms = state.latency_histograms[stage] = {}
+
+    bucket = get_bucket(int(seconds * 1000000))
+    for key in (ALL, event_mask) if event_mask else (ALL, ):
+        histogram = histograms.get(key)
+        if histogram is None:
+            if len(histograms) > config['latency_event_masks_limit']:
+                continue  # Keep memory fixed, "ALL" is always created first.
+            histogram = histograms[key] = [0] * BUCKETS
+        histogram[bucket] += 1
+
+def get_event_mask(msg):
+    """
+    @param msg: str - "{msg_id} event={event},... {data}"
+    @return str|None - event mask like in "top_events", if latency by event masks is enabled
+    """
+    if config['latency_by_event_masks']:
+        _, props, _ = msg.split(' ', 2)
+        for prop in props.split(','):
+            if prop.startswith('event='):
+                return config['top_events_id'].sub('{id}', prop[6:])
+
+### stamped msg
+
+class StampedMsg(str):
+    """
+    Message with time of its last stage and its event mask, carried in the queue and in "messages_by_consumer_ids",
+    so latency keeps no state of its own besides histograms. New strings made of it, e.g. by "split", are plain "str".
+
+    stamped_at: float
+    event_mask: str|None
+    """
+
+### stages of message
+
+def on_enqueue(msg, published_at=None):
+    """
+    Message is put to the queue.
+
+    @param msg: str
+    @param published_at: float|None - time of publish, None on reject
+    @return StampedMsg - to put to the queue instead of "msg"
+    """
+    now = time.time()
+    event_mask = msg.event_mask if isinstance(msg, StampedMsg) else get_event_mask(msg)
+    if published_at is not None:
+        record(PUBLISH_ENQUEUE, now - published_at, event_mask)
+
+    msg = StampedMsg(msg)
+    msg.stamped_at = now
+    msg.event_mask = event_mask
+    return msg
+
+def on_dispatch(msg, manual_ack):
+    """
+    Message was got from the queue and sent to the consumer.
+
+    @param msg: str - "StampedMsg", or plain "str" e.g. if replayed from "wal" or latency was enabled later
+    @param manual_ack: bool - if set, "msg" is stamped again, to be stored in "messages_by_consumer_ids"
+    """
+    if isinstance(msg, StampedMsg):
+        now = time.time()
+        record(ENQUEUE_DISPATCH, now - msg.stamped_at, msg.event_mask)
+        if manual_ack:
+            msg.stamped_at = now
+
+def on_ack(msg):
+    """
+    Message was acked or rejected by the consumer.
+
+    @param msg: str - from "messages_by_consumer_ids", see "on_dispatch"
+    """
+    if isinstance(msg, StampedMsg):
+        record(DISPATCH_ACK, time.time() - msg.stamped_at, msg.event_mask)
+
+### get histograms
+
+def get_histograms():
+    """
+    Get sparse copy of histograms of this worker, e.g. for "_eval" from "stats.py".
+
+    @return dict; result[stage: str][event_mask: str][bucket: int] == count: int
+    """
+    return dict(
+        (stage, dict(
+            (event_mask, dict((bucket, count) for bucket, count in enumerate(histogram) if count))
+            for event_mask, histogram in histograms.iteritems()
+        ))
+        for stage, histograms in state.latency_histograms.iteritems()
+    )
+
+def reset():
+    """
+    Reset histograms of this worker.
+    """
+    state.latency_histograms.clear()
+
+### percentiles
+
+def get_percentiles(histogram, percentiles=(50, 90, 99, 99.9, 100)):
+    """
+    @param histogram: dict; histogram[bucket: int] == count: int - sparse, see "get_histograms"
+    @param percentiles: iterable(float)
+    @return list(float) - seconds for each percentile, highest value of bucket
+    """
+    total = sum(histogram.itervalues())
+    result = []
+    if not total:
+        return result
+
+    buckets = sorted(histogram.iteritems())
+    for percentile in percentiles:
+        target = total * percentile / 100.0
+        seen = 0
+        for bucket, count in buckets:
+            seen += count
+            if seen >= target:
+                break
+        result.append(get_microseconds(bucket) / 1000000.0)
+    return result
+
+def merge(results):
+    """
+    Merge sparse histograms of many workers.
+
+    @param results: list(dict) - see "get_histograms"
+    @return dict - in the same format
+    """
+    merged = {}
+    for result in results:
+        for stage, histograms in result.iteritems():
+            merged_histograms = merged.setdefault(stage, {})
+            for event_mask, histogram in histograms.iteritems():
+                merged_histogram = merged_histograms.setdefault(event_mask, {})
+                for bucket, count in histogram.iteritems():
+                    merged_histogram[bucket] = merged_histogram.get(bucket, 0) + count
+    return merged
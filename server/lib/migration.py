@@ -0,0 +1,415 @@
+"""
+Online change of "workers": adding a worker to the end of the list or removing the last one, while the rest of the cluster keeps serving.
+Only queues, bindings and not-acked messages, whose worker changes on consistent-hash ring, are moved, see "mqks.sharding".
+With default "ring_vnodes=0" almost all of them change their worker, so consider switching to the ring first, see "mqks.sharding".
+
+Online change of "ring_pins": a hot queue is pinned to a chosen worker and moved there the same way,
+e.g. when it saturates its worker while other workers idle.
+
+Usage from any worker that stays, e.g.:
+    mqks._eval("migration.add_worker('10.0.0.4:24003:25003')", timeout=300)
+    mqks._eval("migration.remove_worker()", timeout=300)
+    mqks._eval("migration.pin_queue('hot_queue', 3)", timeout=300)
+    mqks._eval("migration.unpin_queue('hot_queue')", timeout=300)
+
+New worker is started before "add_worker" with the new "workers" in its config, removed worker is stopped after "remove_worker".
+Config of other workers and clients should be updated to the new "workers" and "ring_pins" too, to survive restarts.
+Pins to removed worker are dropped, so its queues return to their workers on the ring.
+
+Steps, each at all workers:
+    connect - workers connect to the new worker, if any, build "next_ring".
+    prepare - each worker moves its queues, whose worker changes, to their new workers:
+        consumers of queue are deleted, not-acked messages return to the queue,
+        messages and bindings of queue are sent with "_migrate_queue",
+        consumers get "--moved" response to consume at the new worker,
+        bindings of events, whose worker changes, are sent to their new workers.
+        Requests of clients with old ring and messages to moved queues are forwarded, see "mqks.server.lib.workers.forward_publish".
+    commit - "ring" is replaced with "next_ring", bindings of items not served here any more are cleaned up.
+"""
+
+### import
+
+from critbot import crit
+from gevent import spawn, wait
+from gevent.event import AsyncResult, Event
+from gevent.queue import Queue
+import time
+
+from mqks.sharding import Ring, format_placement, parse_placement
+from mqks.server.config import config, log
+from mqks.server.lib import state, wal
+from mqks.server.lib.clients import respond
+from mqks.server.lib.event_masks import ANY
+from mqks.server.lib.workers import MOVED, at_request_worker, at_worker_sent_to, get_worker, send_to_worker
+
+### const
+
+STEPS = ('connect', 'prepare', 'commit')
+
+### set workers
+
+def add_worker(address):
+    """
+    Add worker to the end of "workers".
+
+    @param address: str - "host:port_for_workers:port_for_clients"
+    @return str - "ok"
+    """
+    return set_workers(config['workers'] + [address])
+
+def remove_worker():
+    """
+    Remove the last worker from "workers".
+
+    @return str - "ok"
+    """
+    return set_workers(config['workers'][:-1])
+
+def pin_queue(queue, worker):
+    """
+    Pin queue to the worker and move it there with its messages, bindings and consumers.
+
+    @param queue: str
+    @param worker: int
+    @return str - "ok"
+    """
+    assert 0 <= worker < len(config['workers']), 'Unknown worker: {}'.format(worker)
+    pins = dict(config['ring_pins'])
+    pins[queue] = worker
+    return set_workers(config['workers'], pins)
+
+def unpin_queue(queue):
+    """
+    Return queue to its worker on the ring.
+
+    @param queue: str
+    @return str - "ok"
+    """
+    pins = dict(config['ring_pins'])
+    pins.pop(queue, None)
+    return set_workers(config['workers'], pins)
+
+def set_workers(workers, pins=None):
+    """
+    Change "workers" and "ring_pins" online, see the top of this module.
+    May be called again with the same args if it failed in the middle.
+
+    @param workers: list(str) - current "workers" with one more address at the end, or without some last addresses, or the same
+    @param pins: dict(queue: str, worker: int)|None - new "ring_pins", current ones of kept workers by default
+    @return str - "ok"
+    """
+    old_workers = config['workers']
+    assert workers[:len(old_workers)] == old_workers or old_workers[:len(workers)] == workers, 'Only the end of "workers" may change: {} -> {}'.format(old_workers, workers)
+    assert state.worker < len(workers), 'Removed worker w{} can not coordinate migration'.format(state.worker)
+    if pins is None:
+        pins = dict((queue, worker) for queue, worker in config['ring_pins'].iteritems() if worker < len(workers))
+
+    started = time.time()
+    log.info('w{}: migration from {} to {} workers, from {} to {} pins'.format(state.worker, len(old_workers), len(workers), len(config['ring_pins']), len(pins)))
+
+    if len(workers) > len(old_workers):
+        config['workers'] = list(workers)  # New list: "Ring" and clients may keep old one.
+        _wait_connected()
+
+    placement = format_placement(workers, pins)
+    for step in STEPS:
+        _run_step(step, placement, max(len(old_workers), len(workers)))
+
+    log.info('w{}: migration to {} workers, {} pins is done in {:.3f} seconds'.format(state.worker, len(workers), len(pins), time.time() - started))
+    return 'ok'
+
+def _run_step(step, placement, count):
+    """
+    Run migration step at all old and new workers and wait for all results.
+
+    @param step: str - see "STEPS"
+    @param placement: str - new "workers" and "ring_pins", see "mqks.sharding.format_placement"
+    @param count: int - number of old and new workers
+    """
+    state.migration_results = [AsyncResult() for _ in xrange(count)]
+    request = dict(id='migration', client='-', worker=state.worker, confirm=False)
+    for worker in xrange(count):
+        send_to_worker(worker, '_migration_step', request, (step, placement))
+
+    ready = wait(state.migration_results, timeout=config['migration_step_seconds'])
+    if len(ready) < count:
+        raise Exception('Migration step "{}" timed out at workers: {}'.format(step, [
+            worker for worker, result in enumerate(state.migration_results) if not result.ready()
+        ]))
+
+    for worker, result in enumerate(state.migration_results):
+        error = result.get()
+        if error:
+            raise Exception('Migration step "{}" failed at w{}: {}'.format(step, worker, error))
+
+@at_worker_sent_to
+def _migration_step(request, step, placement):
+    """
+    Migration step command, is not blocking commands from other workers.
+
+    @param request: dict - defined in "on_request"
+    @param step: str - see "STEPS"
+    @param placement: str - new "workers" and "ring_pins", see "mqks.sharding.format_placement"
+    """
+    workers, pins = parse_placement(placement)
+    spawn(_do_step, request, step, workers, pins)
+
+def _do_step(request, step, workers, pins):
+    """
+    @param request: dict - defined in "on_request"
+    @param step: str - see "STEPS"
+    @param workers: list(str) - new "workers"
+    @param pins: dict(queue: str, worker: int) - new "ring_pins"
+    """
+    error = ''
+    try:
+        log.info('w{}: migration step "{}" to {} workers, {} pins'.format(state.worker, step, len(workers), len(pins)))
+        _steps[step](request, workers, pins)
+    except Exception as e:
+        crit()
+        error = repr(e)
+
+    _migration_step_done(request, str(state.worker), error)
+
+@at_request_worker
+def _migration_step_done(request, worker, error):
+    """
+    @param request: dict - defined in "on_request"
+    @param worker: str - int
+    @param error: str - empty if none
+    """
+    worker = int(worker)
+    if worker < len(state.migration_results):
+        state.migration_results[worker].set(error)
+
+### connect
+
+def _connect(request, workers, pins):
+    """
+    Connect to new worker, if any, and build "next_ring".
+
+    @param request: dict - defined in "on_request"
+    @param workers: list(str) - new "workers"
+    @param pins: dict(queue: str, worker: int) - new "ring_pins"
+    """
+    if len(workers) > len(config['workers']):
+        config['workers'] = list(workers)
+    _wait_connected()
+
+    state.next_ring = Ring(workers, config['ring_vnodes'], config['ring_hash'], pins)
+    state.moved_queues.clear()
+    state.migrated_queues.clear()
+    state.moved_notified_clients.clear()
+
+def _wait_connected():
+    """
+    Wait until this worker is connected to all other "workers", see "mqks.server.lib.workers.workers_connector".
+    """
+    deadline = time.time() + config['migration_step_seconds']
+    while any(
+        worker not in state.socks_by_workers or worker not in state.commands_to_workers
+        for worker in xrange(len(config['workers'])) if worker != state.worker
+    ):
+        if time.time() > deadline:
+            raise Exception('w{}: not connected to all {} workers'.format(state.worker, len(config['workers'])))
+        time.sleep(config['block_seconds'])
+
+### prepare
+
+def _prepare(request, workers, pins):
+    """
+    Move queues and bindings of events, whose worker changes, to their new workers.
+
+    @param request: dict - defined in "on_request"
+    @param workers: list(str) - new "workers"
+    @param pins: dict(queue: str, worker: int) - new "ring_pins"
+    """
+    ring = state.next_ring
+    assert ring and ring.workers == tuple(workers) and ring.pins == pins, 'Migration step "connect" is not done'
+    placement = format_placement(workers, pins)
+
+    ### queues
+
+    queues = set(state.queues)
+    queues.update(state.consumers_by_queues, state.queues_to_delete_when_unused, state.event_tries_by_queues)
+    for queue in queues:
+        worker = ring.get_worker(queue)
+        if worker != state.worker and queue not in state.moved_queues:
+            _move_queue(request, queue, worker, placement)
+            time.sleep(0)
+
+    ### events
+
+    moved_events = {}  # moved_events[worker: int][queue: str] == [event: str]
+    for event, queues in state.queues_by_events.iteritems():
+        if get_worker(event) == state.worker:
+            worker = ring.get_worker(event)
+            if worker != state.worker:
+                events_by_queues = moved_events.setdefault(worker, {})
+                for queue in queues:
+                    events_by_queues.setdefault(queue, []).append(event)
+
+    for worker, events_by_queues in moved_events.iteritems():
+        for queue, events in events_by_queues.iteritems():
+            send_to_worker(worker, '_rebind_forwarded', request, (queue, '', ' '.join(events)))
+
+    ### event masks
+
+    # Event masks are bound at all workers, so new workers get them from coordinator of migration only:
+    if request['worker'] == state.worker:
+        for queue, events in state.events_by_queues.items():
+            masks = ' '.join(event for event in events if ANY in event)
+            if masks:
+                for worker in xrange(len(state.ring.workers), len(workers)):
+                    send_to_worker(worker, '_rebind_forwarded', request, (queue, '', masks))
+
+def _move_queue(request, queue, worker, placement):
+    """
+    Move queue with its messages and bindings to its new worker.
+
+    @param request: dict - defined in "on_request"
+    @param queue: str
+    @param worker: int - new worker of queue
+    @param placement: str - new "workers" and "ring_pins", see "mqks.sharding.format_placement"
+    """
+
+    ### consumers
+
+    delete_queue_when_unused = state.queues_to_delete_when_unused.pop(queue, None)  # Before deleting consumers, to keep the queue.
+    consumers = [(consumer_id, state.clients_by_consumer_ids.get(consumer_id)) for consumer_id in state.consumers_by_queues.get(queue, ())]
+    for consumer_id, _ in consumers:
+        _delete_consumer(request, consumer_id)  # Not-acked messages return to the queue.
+
+    queue_used = state.queues_used.pop(queue, None)
+    if queue_used:
+        queue_used.set()  # Cancel "_wait_used_or_delete_queue" greenlet.
+
+    _stop_dispatcher(queue)
+    state.event_tries_by_queues.pop(queue, None)
+
+    ### messages
+
+    msgs = state.queues.pop(queue, None)
+    has_queue = msgs is not None
+    msgs = list(msgs.queue) if has_queue else []
+    if has_queue and config['wal']:
+        wal.delete_queue(queue)
+
+    ### send
+
+    send_to_worker(worker, '_migrate_queue', request, (
+        queue,
+        '' if delete_queue_when_unused is None else str(delete_queue_when_unused),
+        ' '.join(state.events_by_queues.get(queue, ())),
+        '1' if has_queue else '',
+    ))
+
+    start = 0
+    while start < len(msgs):
+        end = start + 1
+        size = len(msgs[start])
+        while end < len(msgs) and size + len(msgs[end]) < config['commands_batch_bytes']:
+            size += len(msgs[end])
+            end += 1
+        send_to_worker(worker, '_migrate_msgs', request, (queue, ) + tuple(msgs[start:end]))
+        start = end
+
+    state.moved_queues.add(queue)
+    state.migrated_queues.discard(queue)
+    state.bindings_version += 1
+
+    for consumer_id, client in consumers:
+        if client:
+            respond(dict(id=consumer_id, client=client, worker=state.worker), MOVED + placement)
+
+@at_worker_sent_to
+def _migrate_queue(request, queue, delete_queue_when_unused, events, has_queue):
+    """
+    Get queue moved from its old worker.
+
+    @param request: dict - defined in "on_request"
+    @param queue: str
+    @param delete_queue_when_unused: str - empty, "True" or seconds
+    @param events: str - space-separated
+    @param has_queue: str - "1" if queue has storage of messages, else empty
+    """
+    state.migrated_queues.add(queue)
+    state.moved_queues.discard(queue)
+
+    if events:
+        _rebind(request, queue, '', events, is_forwarded=True)
+
+    if has_queue:
+        state.queues.setdefault(queue, Queue())
+
+    if delete_queue_when_unused:
+        delete_queue_when_unused = True if delete_queue_when_unused == 'True' else float(delete_queue_when_unused)
+        state.queues_to_delete_when_unused[queue] = delete_queue_when_unused
+        if queue not in state.consumers_by_queues:
+            state.queues_used.setdefault(queue, Event())
+            spawn(_wait_used_or_delete_queue, request['client'], queue,
+                seconds=max(config['migration_grace_seconds'], 0 if delete_queue_when_unused is True else delete_queue_when_unused))
+
+    state.bindings_version += 1
+
+@at_worker_sent_to
+def _migrate_msgs(request, queue, *msgs):
+    """
+    Get messages of queue moved from its old worker.
+
+    @param request: dict - defined in "on_request"
+    @param queue: str
+    @param msgs: tuple(str)
+    """
+    queue_name = queue
+    queue = state.queues.setdefault(queue_name, Queue())
+    for msg in msgs:
+        queue.put(msg)
+        if config['wal']:
+            wal.put(queue_name, msg)
+
+### commit
+
+def _commit(request, workers, pins):
+    """
+    Switch to "next_ring", clean up bindings of items not served here any more.
+
+    @param request: dict - defined in "on_request"
+    @param workers: list(str) - new "workers"
+    @param pins: dict(queue: str, worker: int) - new "ring_pins"
+    """
+    ring = state.next_ring
+    assert ring and ring.workers == tuple(workers) and ring.pins == pins, 'Migration step "connect" is not done'
+
+    state.ring = ring
+    state.next_ring = None
+    config['workers'] = list(workers)
+    config['ring_pins'] = dict(pins)
+    state.moved_queues.clear()
+    state.migrated_queues.clear()
+    state.moved_notified_clients.clear()
+
+    for event, queues in state.queues_by_events.items():
+        if ring.get_worker(event) != state.worker:
+            queues.difference_update([queue for queue in queues if ring.get_worker(queue) != state.worker])
+            if not queues:
+                del state.queues_by_events[event]
+
+    for queue, events in state.events_by_queues.items():
+        if ring.get_worker(queue) != state.worker:
+            events.difference_update([event for event in events if ANY not in event and ring.get_worker(event) != state.worker])
+            if not events:
+                del state.events_by_queues[queue]
+
+    state.bindings_version += 1
+
+### steps
+
+_steps = dict(connect=_connect, prepare=_prepare, commit=_commit)
+
+### anti-loop import
+
+from mqks.server.actions.consume import _stop_dispatcher
+from mqks.server.actions.delete_consumer import _delete_consumer
+from mqks.server.actions.delete_queue import _wait_used_or_delete_queue
+from mqks.server.actions.rebind import _rebind
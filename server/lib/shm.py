@@ -0,0 +1,247 @@
+"""
+Shared-memory transport of "command protocol" between workers on the same host.
+
+Workers on the same host are connected via UNIX socket, see "mqks.server.lib.workers.workers_connector".
+When "shm_commands" is enabled, sender of commands creates a ring buffer - mmap-ed file in "unix_sock_dir",
+sends "_shm_start" with its path as the last command via socket, then writes all next commands to the ring buffer.
+Receiver gets "_shm_start" in order after all previous commands, and reads next commands from the ring buffer.
+Socket is kept to detect disconnect: both sides close the ring buffer then, and reconnect redoes this handshake.
+
+Ring buffer is a byte stream with single writer and single reader, so it needs no locks:
+    write_pos, read_pos - offsets of total bytes written and read, each in its own cache line, changed by one side only.
+    reader_waiting, writer_waiting - set by side that sleeps on empty or full buffer, so other side wakes it via named pipe.
+Like kernel socket, reader wakes writer only when half of buffer is free - a wakeup per read would cost more than the copy.
+Wakeup may be missed on store-load reordering, so sleeping side also wakes each "shm_commands_poll_seconds".
+Aligned 8-byte stores are atomic and other stores are not reordered on x86-64 only, see "SUPPORTED".
+"""
+
+### import
+
+import ctypes
+import errno
+from gevent.select import select
+import mmap
+import os
+import platform
+import sys
+
+from mqks.server.config import config
+
+### const
+
+SUPPORTED = sys.platform.startswith('linux') and platform.machine() in ('x86_64', 'amd64')  # Not 32-bit x86: its 8-byte stores of positions may be torn.
+WRITE_POS = 0           # Offsets in header, in different cache lines to avoid false sharing.
+READ_POS = 64
+READER_WAITING = 128
+WRITER_WAITING = 192
+HEADER_BYTES = 256
+DATA_SUFFIX = '.data'   # Named pipe to wake reader when data is written. Instead of "eventfd" that can't be opened by unrelated process.
+SPACE_SUFFIX = '.space' # Named pipe to wake writer when data is read.
+
+### Channel
+
+class Channel(object):
+    """
+    Ring buffer in shared memory.
+    """
+
+    def __init__(self, path, size=None):
+        """
+        Create channel to write or open existing channel to read.
+
+        @param path: str - mmap-ed file
+        @param size: int|None - total bytes of file to create it, or None to open existing file
+        """
+        self.path = path
+        self.is_writer = size is not None
+        self.closed = False
+        self.busy = False       # Some greenlet waits in "sendall" or "recv", so it will release the channel on close.
+        self.released = False
+
+        if self.is_writer:
+            assert size > HEADER_BYTES, size
+            self._remove()
+            for suffix in DATA_SUFFIX, SPACE_SUFFIX:
+                os.mkfifo(path + suffix, 0o600)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+            os.ftruncate(fd, size)
+        else:
+            fd = os.open(path, os.O_RDWR)
+            size = os.fstat(fd).st_size
+
+        try:
+            self.mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        # "O_RDWR" of named pipe never blocks and never fails when other side is not opened yet, on Linux:
+        self.data_fd = os.open(path + DATA_SUFFIX, os.O_RDWR | os.O_NONBLOCK)
+        self.space_fd = os.open(path + SPACE_SUFFIX, os.O_RDWR | os.O_NONBLOCK)
+
+        self.capacity = size - HEADER_BYTES
+        self.write_pos = ctypes.c_uint64.from_buffer(self.mmap, WRITE_POS)
+        self.read_pos = ctypes.c_uint64.from_buffer(self.mmap, READ_POS)
+        self.reader_waiting = ctypes.c_uint32.from_buffer(self.mmap, READER_WAITING)
+        self.writer_waiting = ctypes.c_uint32.from_buffer(self.mmap, WRITER_WAITING)
+
+    ### sendall
+
+    def sendall(self, data):
+        """
+        Write data to the ring buffer, waiting for free space if needed, like "sock.sendall".
+
+        @param data: str
+        @raise IOError - if channel is closed
+        """
+        self.busy = True
+        try:
+            self._sendall(data)
+        finally:
+            self._done()
+
+    def _sendall(self, data):
+        """
+        @param data: str
+        """
+        offset = 0
+        while offset < len(data):
+            if self.closed:
+                raise IOError('shm channel {} is closed'.format(self.path))
+
+            write_pos = self.write_pos.value
+            read_pos = self.read_pos.value
+            size = min(self.capacity - (write_pos - read_pos), len(data) - offset)
+            if not size:
+                self._wait(self.writer_waiting, self.read_pos, read_pos, self.space_fd)  # Ring buffer is full, reader is slower.
+                continue
+
+            start = write_pos % self.capacity
+            first = min(size, self.capacity - start)
+            self.mmap[HEADER_BYTES + start:HEADER_BYTES + start + first] = data[offset:offset + first]
+            if first < size:
+                self.mmap[HEADER_BYTES:HEADER_BYTES + size - first] = data[offset + first:offset + size]
+
+            self.write_pos.value = write_pos + size  # After data.
+            offset += size
+            self._wake(self.reader_waiting, self.data_fd)
+
+    ### recv
+
+    def recv(self, max_bytes):
+        """
+        Read available data from the ring buffer, waiting for it if needed, like "sock.recv".
+
+        @param max_bytes: int
+        @return str - '' if channel is closed
+        """
+        self.busy = True
+        try:
+            return self._recv(max_bytes)
+        finally:
+            self._done()
+
+    def _recv(self, max_bytes):
+        """
+        @param max_bytes: int
+        @return str
+        """
+        while not self.closed:
+            write_pos = self.write_pos.value
+            read_pos = self.read_pos.value
+            size = min(write_pos - read_pos, max_bytes)
+            if not size:
+                self._wait(self.reader_waiting, self.write_pos, write_pos, self.data_fd)
+                continue
+
+            start = read_pos % self.capacity
+            first = min(size, self.capacity - start)
+            data = self.mmap[HEADER_BYTES + start:HEADER_BYTES + start + first]
+            if first < size:
+                data += self.mmap[HEADER_BYTES:HEADER_BYTES + size - first]
+
+            self.read_pos.value = read_pos + size  # After data is copied.
+            if 2 * (self.capacity - (write_pos - read_pos - size)) >= self.capacity:  # Half of buffer is free.
+                self._wake(self.writer_waiting, self.space_fd)
+            return data
+
+        return ''
+
+    ### wait, wake
+
+    def _wait(self, waiting, pos, old_pos, fd):
+        """
+        Sleep until other side changes "pos" and wakes this side, or for "shm_commands_poll_seconds" at most.
+
+        @param waiting: ctypes.c_uint32 - flag of this side
+        @param pos: ctypes.c_uint64 - changed by other side
+        @param old_pos: int
+        @param fd: int - named pipe to wake this side
+        """
+        waiting.value = 1
+        if pos.value == old_pos:  # Recheck after flag is set, to avoid sleeping after wakeup.
+            if select([fd], [], [], config['shm_commands_poll_seconds'])[0]:
+                try:
+                    os.read(fd, 4096)
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+        waiting.value = 0
+
+    def _wake(self, waiting, fd):
+        """
+        Wake other side if it sleeps.
+
+        @param waiting: ctypes.c_uint32 - flag of other side
+        @param fd: int - named pipe to wake other side
+        """
+        if waiting.value:
+            try:
+                os.write(fd, '\0')
+            except OSError as e:
+                if e.errno != errno.EAGAIN:  # EAGAIN = pipe is full of wakeups already.
+                    raise
+
+    ### close
+
+    def close(self):
+        """
+        Close the channel. Writer also removes its files, reader has them mapped already.
+        Pending "sendall" raises and pending "recv" returns '' in "shm_commands_poll_seconds" at most,
+        then the channel is released by that greenlet.
+        """
+        self.closed = True
+        if not self.busy:
+            self._release()
+
+    def _done(self):
+        """
+        Release the channel closed while this greenlet was waiting in it.
+        """
+        self.busy = False
+        if self.closed:
+            self._release()
+
+    def _release(self):
+        """
+        Unmap and close files, when channel is closed and not used by other greenlet.
+        """
+        if self.released:
+            return
+        self.released = True
+        del self.write_pos, self.read_pos, self.reader_waiting, self.writer_waiting  # Buffers exported by "mmap" should be released before "mmap.close".
+        self.mmap.close()
+        os.close(self.data_fd)
+        os.close(self.space_fd)
+        if self.is_writer:
+            self._remove()
+
+    def _remove(self):
+        """
+        Remove files of the channel, e.g. left by crashed worker.
+        """
+        for path in self.path, self.path + DATA_SUFFIX, self.path + SPACE_SUFFIX:
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
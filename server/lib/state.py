@@ -1,6 +1,7 @@
 
 ### import
 
+from collections import OrderedDict
 from gevent.event import Event
 from gevent.queue import Queue
 
@@ -8,6 +9,12 @@ from gevent.queue import Queue
 
 worker = None                                   # int
 is_suiciding = False                            # bool
+ring = None                                     # mqks.sharding.Ring - placement of queues and events, see "mqks.server.lib.workers.get_worker"
+next_ring = None                                # mqks.sharding.Ring|None - ring of new "workers" during migration, see "mqks.server.lib.migration"
+moved_queues = set()                            # set([queue: str]) - sent to their new workers during migration
+migrated_queues = set()                         # set([queue: str]) - got from their old workers during migration
+moved_notified_clients = set()                  # set([client: str]) - clients that got "--moved" since last change of ring
+migration_results = []                          # list; migration_results[worker: int] == result: AsyncResult; result.get() == error: str - at worker coordinating migration step
 
 server_for_workers_unix = None                  # gevent.server.StreamServer - to connect workers on the same host via UNIX domain sockets
 server_for_workers_inet = None                  # gevent.server.StreamServer - to connect workers on other hosts via Internet sockets
@@ -15,20 +22,34 @@ socks_by_workers = {}                           # dict; socks_by_workers[worker:
 commands_to_workers = {}                        # dict; commands_to_workers[worker: int] == commands: gevent.queue.Queue; commands.get() == command: str
 commands_put = 0                                # int
 commands_got = 0                                # int
+commands_flushes = 0                            # int - number of "sendall" of coalesced commands to other workers
+shm_channels_to_workers = {}                    # dict; shm_channels_to_workers[worker: int] == channel: mqks.server.lib.shm.Channel - to worker on the same host, see "mqks.server.lib.shm"
+shm_channels_from_workers = {}                  # dict; shm_channels_from_workers[worker: int] == channel: mqks.server.lib.shm.Channel
 funcs = {}                                      # funcs[func_name: str] == func: callable
 
 server_for_clients = None                       # gevent.server.StreamServer
 socks_by_clients = {}                           # dict; socks_by_clients[client: str] == sock: gevent._socket2.socket
+v2_clients = set()                              # set([client: str]) - clients that switched to "protocol v2", see "mqks.server.lib.clients"
 responses_by_clients = {}                       # dict; responses_by_clients[client: str] == responses: gevent.queue.Queue; responses.get() == tuple(request: dict, data: str)
 actions = {}                                    # dict; actions[action: str] == action: callable
+responses_sent = 0                              # int
+responses_flushes = 0                           # int - number of "sendall" of coalesced responses to clients
 
 queues = {}                                     # dict; queues[queue: str] == queue: gevent.queue.Queue; queue.get() == msg: str
 queues_to_delete_when_unused = {}               # dict; queues_to_delete_when_unused[queue: str] == delete_queue_when_unused: bool|float|int
 queues_used = {}                                # dict; queues_used[queue: str] == event: gevent.event.Event
+dispatchers_by_queues = {}                      # dict; dispatchers_by_queues[queue: str] == dispatcher: gevent.greenlet.Greenlet(mqks.server.actions.consume._dispatcher)
+ready_consumers_by_queues = {}                  # dict; ready_consumers_by_queues[queue: str] == tuple(consumer_ids: collections.deque([consumer_id: str]), consumer_ready: gevent.event.Event)
+ready_queues_by_consumer_ids = {}               # dict; ready_queues_by_consumer_ids[consumer_id: str] == queue: str - consumer is in ready consumers of this queue once, maybe deleted already, see "_dispatcher"
 
 queues_by_events = {}                           # dict; queues_by_events[event: str] = set([queue: str])
 events_by_queues = {}                           # dict; events_by_queues[queue: str] = set([event: str])
-remove_mask_cache = {}                          # dict; remove_mask_cache[key: str] == compiled_regexp: SRE_Pattern
+queues_by_event_masks = {}                      # dict; queues_by_event_masks[segments: int] == trie, see "mqks.server.lib.event_masks"
+event_tries_by_queues = {}                      # dict; event_tries_by_queues[queue: str][segments: int] == trie of dotted events of queue, at worker of queue, see "mqks.server.lib.event_masks"
+remove_mask_cache = OrderedDict()               # OrderedDict; remove_mask_cache[segment: str] == compiled_regexp: SRE_Pattern - LRU, most recently used last
+partitions = set()                              # set([queue: str]) - partitions of queues registered by "consume --partition", see "mqks.server.actions.publish._pick_partitions"
+bindings_version = 0                            # int - incremented on any change of bindings or options of queues, see "mqks.server.lib.bindings_snapshot"
+bindings_version_saved = 0                      # int
 
 consumer_ids_by_clients = {}                    # dict; consumer_ids_by_clients[client: str] == set([consumer_id: str])
 clients_by_consumer_ids = {}                    # dict; clients_by_consumer_ids[consumer_id: str] == client: str
@@ -37,11 +58,23 @@ consumers_by_queues = {}                        # dict; consumers_by_queues[queu
 queues_by_consumer_ids = {}                     # dict; queues_by_consumer_ids[consumer_id: str] == queue: str
 
 messages_by_consumer_ids = {}                   # dict; messages_by_consumer_ids[consumer_id: str][msg_id: str] == msg: str
+prefetch_by_consumer_ids = {}                   # dict; prefetch_by_consumer_ids[consumer_id: str] == prefetch: int - max not-acked messages of consumer
+paused_consumer_ids = set()                     # set([consumer_id: str]) - consumers that have "prefetch" not-acked messages, removed from ready consumers
+compressed_consumer_ids = set()                 # set([consumer_id: str]) - consumers that get compressed data as is, see "mqks.server.lib.compression"
+
+wal_records = []                                # list(str) - records buffered for group commit, see "mqks.server.lib.wal"
+wal_file = None                                 # file - current segment
+wal_seq = 0                                     # int - sequence number of current segment
+wal_bytes = 0                                   # int - total bytes of all segments
 
 top_events = {}                                 # dict; top_events[event_mask: str] == published: int
+latency_histograms = {}                         # dict; latency_histograms[stage: str][event_mask: str] == histogram: list(count: int), see "mqks.server.lib.latency"
 published = 0                                   # int
 queued = 0                                      # int
 consumed = 0                                    # int
+compressed = 0                                  # int - messages compressed by this worker, see "mqks.server.lib.compression"
+compressed_bytes_saved = 0                      # int - original minus compressed bytes of these messages, saved once in each queue, worker link and response to "--compressed" consumer
+decompressed = 0                                # int - compressed messages decompressed for consumers without "--compressed"
 
 gbn_greenlet = None                             # gevent.greenlet.Greenlet(mqks.server.lib.gbn_profile.gbn_report_and_reset) - if enabled.
 gbn_profile = ''                                # str - last profile, if any.
@@ -0,0 +1,267 @@
+
+### import
+
+from collections import OrderedDict
+from critbot import crit
+from gbn import gbn
+from gevent import get_hub
+from gevent.queue import Queue
+import os
+import time
+
+from mqks.escape import escape, unescape
+from mqks.server.config import config, log
+from mqks.server.lib import state
+
+### const
+
+SEGMENT_FORMAT = '{:012d}.wal'
+SEGMENT_SUFFIX = '.wal'
+
+# "wal protocol" - one '\t'-separated record per line, like "command protocol":
+PUT = '+'       # +\t{queue}\t{msg} - msg is put to the tail of queue.
+REMOVE = '-'    # -\t{queue}\t{msg_id} - msg is consumed without manual ack, or acked.
+DELETE = 'x'    # x\t{queue} - queue is deleted.
+RESET = 'reset' # reset - compacted segment follows, forget everything replayed before.
+ESCAPED = '~'   # ~+\t{queue}\t{escaped_msg} - msg with binary data, e.g. from "protocol v2" or compressed, see "mqks.escape".
+
+### put, remove, delete queue
+
+def put(queue, msg):
+    """
+    Log that msg was put to the tail of queue.
+
+    @param queue: str
+    @param msg: str
+    """
+    state.wal_records.append(_get_put_record(queue, msg))
+
+def _get_put_record(queue, msg):
+    """
+    @param queue: str
+    @param msg: str
+    @return str - "put" record, escaped if needed
+    """
+    if '\n' in msg or '\t' in msg:
+        return '\t'.join((ESCAPED + PUT, queue, escape(msg)))
+    return '\t'.join((PUT, queue, msg))
+
+def remove(queue, msg_id):
+    """
+    Log that msg was removed from queue forever: consumed without manual ack, or acked.
+    Rejected msg is logged as "remove" + "put" to the tail of queue.
+
+    @param queue: str
+    @param msg_id: str
+    """
+    state.wal_records.append('\t'.join((REMOVE, queue, msg_id)))
+
+def delete_queue(queue):
+    """
+    Log that queue was deleted with all its messages.
+
+    @param queue: str
+    """
+    state.wal_records.append('\t'.join((DELETE, queue)))
+
+### dir
+
+def _get_dir():
+    """
+    @return str - dir with segments of this worker
+    """
+    return os.path.join(config['wal_dir'], 'w{}'.format(state.worker))
+
+def _get_segments():
+    """
+    @return list(str) - full paths of segments, oldest first
+    """
+    wal_dir = _get_dir()
+    return [os.path.join(wal_dir, name) for name in sorted(os.listdir(wal_dir)) if name.endswith(SEGMENT_SUFFIX)]
+
+### replay
+
+def replay():
+    """
+    Rebuild "state.queues" from segments of this worker.
+    Messages that were waiting for manual ack are returned to their queues.
+    Should be called on start of worker, before any client is served.
+    """
+    wall = gbn('wal.replay')
+    wal_dir = _get_dir()
+    if not os.path.exists(wal_dir):
+        os.makedirs(wal_dir)
+
+    queues = OrderedDict()  # queues[queue: str][msg_id: str] == msg: str
+    records = 0
+
+    for segment in _get_segments():
+        with open(segment) as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    log.error('w{}: wal: ignoring torn record at the end of {}'.format(state.worker, segment))
+                    break
+
+                records += 1
+                parts = line[:-1].split('\t', 2)
+                op = parts[0]
+
+                if op == ESCAPED + PUT:
+                    op = PUT
+                    parts[2] = unescape(parts[2])
+
+                if op == PUT:
+                    _, queue, msg = parts
+                    msg_id, _ = msg.split(' ', 1)
+                    msgs = queues.get(queue)
+                    if msgs is None:
+                        msgs = queues[queue] = OrderedDict()
+                    msgs[msg_id] = msg
+
+                elif op == REMOVE:
+                    _, queue, msg_id = parts
+                    msgs = queues.get(queue)
+                    if msgs:
+                        msgs.pop(msg_id, None)
+
+                elif op == DELETE:
+                    queues.pop(parts[1], None)
+
+                elif op == RESET:
+                    queues.clear()
+
+                else:
+                    assert False, (segment, line)
+
+    msgs_count = 0
+    for queue, msgs in queues.iteritems():
+        state.queues[queue] = queue = Queue()
+        for msg in msgs.itervalues():
+            queue.put(msg)
+        msgs_count += len(msgs)
+
+    log.info('w{}: wal: replayed {} records to {} queues with {} messages'.format(state.worker, records, len(queues), msgs_count))
+    gbn(wall=wall)
+
+### compact
+
+def compact():
+    """
+    Replace all segments with one segment of live messages, then open next segment for new records.
+    """
+    wall = gbn('wal.compact')
+    wal_dir = _get_dir()
+    old_segments = _get_segments()
+
+    ### write what is buffered, then take snapshot - without context switch
+
+    if state.wal_file:
+        _write(state.wal_file)
+        state.wal_file.flush()
+
+    lines = [RESET]
+    for queue_name, queue in state.queues.iteritems():
+        for consumer_id in state.consumers_by_queues.get(queue_name, ()):
+            for msg in state.messages_by_consumer_ids.get(consumer_id, {}).itervalues():  # Waiting for manual ack.
+                lines.append(_get_put_record(queue_name, msg))
+        for msg in queue.queue:
+            lines.append(_get_put_record(queue_name, msg))
+
+    del state.wal_records[:]  # Already included in snapshot.
+
+    ### write snapshot to the next segment, new records to the segment after it
+
+    state.wal_seq += 1
+    snapshot_path = os.path.join(wal_dir, SEGMENT_FORMAT.format(state.wal_seq))
+    tmp_path = snapshot_path + '.tmp'
+
+    old_file = state.wal_file
+    state.wal_seq += 1
+    state.wal_file = open(os.path.join(wal_dir, SEGMENT_FORMAT.format(state.wal_seq)), 'a')
+    state.wal_bytes = 0
+
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+        f.flush()
+        _fsync(f)
+    os.rename(tmp_path, snapshot_path)  # Atomic: replay sees either old segments or old segments + complete snapshot.
+
+    if old_file:
+        _fsync(old_file)
+        old_file.close()
+
+    for segment in old_segments:
+        os.remove(segment)
+
+    state.wal_bytes += os.path.getsize(snapshot_path)
+    log.info('w{}: wal: compacted {} segments to {} records'.format(state.worker, len(old_segments), len(lines) - 1))
+    gbn(wall=wall)
+
+### flusher
+
+def flusher():
+    """
+    Group commit: writes buffered records and fsyncs them each "wal_fsync_seconds".
+    Rotates segments, compacts log when it is much bigger than live messages.
+    """
+    wal_dir = _get_dir()
+    segments = _get_segments()
+    state.wal_seq = int(os.path.basename(segments[-1]).replace(SEGMENT_SUFFIX, '')) if segments else 0
+    compact()  # Replayed segments are not needed any more.
+
+    while 1:
+        try:
+            time.sleep(config['wal_fsync_seconds'])
+            if not state.wal_records:
+                continue
+
+            wall = gbn('wal.flush')
+            state.wal_bytes += _write(state.wal_file)
+            state.wal_file.flush()
+            f = state.wal_file
+            _fsync(f)  # Context switch: new records are buffered for next flush.
+            gbn(wall=wall)
+
+            if state.wal_file is f and f.tell() >= config['wal_segment_bytes']:
+                if state.wal_bytes >= config['wal_compact_ratio'] * _get_live_bytes():
+                    compact()
+                else:
+                    f.close()
+                    state.wal_seq += 1
+                    state.wal_file = open(os.path.join(wal_dir, SEGMENT_FORMAT.format(state.wal_seq)), 'a')
+
+        except Exception:
+            crit()
+
+def _write(f):
+    """
+    Write buffered records to the file without context switch.
+
+    @param f: file
+    @return int - bytes written
+    """
+    if not state.wal_records:
+        return 0
+    data = '\n'.join(state.wal_records) + '\n'
+    del state.wal_records[:]
+    f.write(data)
+    return len(data)
+
+def _fsync(f):
+    """
+    Fsync in thread pool to avoid blocking of all greenlets.
+
+    @param f: file
+    """
+    get_hub().threadpool.apply(os.fsync, (f.fileno(), ))
+
+def _get_live_bytes():
+    """
+    @return int - approximate size of live messages, as they would be written by "compact"
+    """
+    live_bytes = 0
+    for queue_name, queue in state.queues.iteritems():
+        for consumer_id in state.consumers_by_queues.get(queue_name, ()):
+            live_bytes += sum(len(msg) for msg in state.messages_by_consumer_ids.get(consumer_id, {}).itervalues())
+        live_bytes += sum(len(msg) for msg in queue.queue)
+    return live_bytes
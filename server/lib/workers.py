@@ -8,6 +8,7 @@ from gevent import socket, spawn
 from gevent.event import Event
 from gevent.queue import Queue
 from gevent.server import StreamServer
+from itertools import islice
 import logging
 from socket import AF_INET, AF_UNIX
 import os
@@ -15,22 +16,64 @@ import sys
 import time
 from uqid import dtid
 
-from mqks.server.config import config, log, WORKERS
-from mqks.server.lib import state
+from mqks.escape import escape, unescape
+from mqks.sharding import Ring, format_placement
+from mqks.server.config import config, log
+from mqks.server.lib import shm, state
 from mqks.server.lib.log import verbose
 from mqks.server.lib.sockets import get_listener
 
+### const
+
+ESCAPED = '~'       # Prefix of "func_name" in "command protocol" when args are escaped, e.g. binary data from "protocol v2", see "mqks.escape".
+MOVED = '--moved '  # Response to client with old ring: "{request_id} ok --moved {worker},{worker},... {queue}={worker_index} ...", see "mqks.server.lib.migration".
+
+### ring
+
+def init_ring():
+    """
+    Build ring of "workers", e.g. when new worker joins, see "mqks.server.lib.migration".
+    """
+    state.ring = Ring(config['workers'], config['ring_vnodes'], config['ring_hash'], config['ring_pins'])
+
+init_ring()
+
 ### get_worker
 
 def get_worker(item):
     """
     Find out which worker serves this item, e.g. queue name.
-    Items are almost uniformly distributed by workers using hash of item.
+    Items are almost uniformly distributed by workers using consistent-hash ring, see "mqks.sharding".
 
-    @param item: hashable
+    @param item: str
     @return int
     """
-    return hash(item) % WORKERS
+    return state.ring.get_worker(item)
+
+def get_next_worker(item):
+    """
+    Find out which worker will serve this item when migration to new "workers" is committed.
+    Same as "get_worker" when there is no migration.
+
+    @param item: str
+    @return int
+    """
+    return (state.next_ring or state.ring).get_worker(item)
+
+def serves_queue(queue):
+    """
+    Check if this worker serves the queue now.
+    During migration the queue is served by the worker that has its state, see "mqks.server.lib.migration".
+
+    @param queue: str
+    @return bool
+    """
+    if state.next_ring:
+        if queue in state.moved_queues:
+            return False
+        if queue in state.migrated_queues:
+            return True
+    return state.ring.get_worker(queue) == state.worker
 
 ### at_queues_batch_worker
 
@@ -93,7 +136,7 @@ def at_all_workers(func):
     state.funcs[func_name] = func
 
     def routing_func(request, *args):
-        for worker in xrange(WORKERS):
+        for worker in xrange(len(config['workers'])):
             send_to_worker(worker, func_name, request, args)
 
     routing_func.__name__ = func_name
@@ -113,6 +156,65 @@ def at_worker_sent_to(func):
     state.funcs[func.__name__] = func
     return func
 
+### forward
+
+# Client with old ring sends requests to old workers of events and queues, see "mqks.server.lib.migration".
+# Such requests are forwarded to new workers, and client gets "--moved" once to update its ring.
+
+def forward_publish(request, msg_id, event, data, codec, key=None):
+    """
+    Forward message of event to its worker.
+
+    @param request: dict - defined in "on_request"
+    @param msg_id: str
+    @param event: str
+    @param data: str
+    @param codec: str|None
+    @param key: str|None - partition key
+    """
+    send_to_worker(get_worker(event), '_publish_forwarded', dict(request, confirm=False), (msg_id, event, data, codec or '', key or ''))
+    notify_moved(request)
+
+def forward_action(request, queue):
+    """
+    Forward action about the queue to worker of queue.
+    Confirm means the action is forwarded, like "publish" is confirmed when messages are sent to workers of queues.
+
+    @param request: dict - defined in "on_request"
+    @param queue: str
+    """
+    send_to_worker(get_next_worker(queue), '_action_forwarded', dict(request, confirm=False), (request['action'], request['data']))
+    notify_moved(request)
+    if request['confirm']:
+        respond(request)
+
+@at_worker_sent_to
+def _action_forwarded(request, action, data):
+    """
+    Execute action forwarded from worker with old ring, without forwarding it again.
+
+    @param request: dict - defined in "on_request"
+    @param action: str
+    @param data: str
+    """
+    request.update(action=action, data=data, is_forwarded=True)
+    state.actions[action](request)
+
+def notify_moved(request, once=True):
+    """
+    Respond "--moved" with new "workers" and "ring_pins" to client of the request.
+
+    @param request: dict - defined in "on_request"
+    @param once: bool - once per client per change of ring
+    """
+    if once:
+        if request['client'] in state.moved_notified_clients:
+            return
+        state.moved_notified_clients.add(request['client'])
+
+    ring = state.next_ring or state.ring
+    respond(request, MOVED + format_placement(ring.workers, ring.pins))
+
 ### workers_connector
 
 def workers_connector():
@@ -121,7 +223,7 @@ def workers_connector():
     """
     while 1:
         try:
-            for worker in xrange(state.worker + 1, WORKERS): # Avoids racing when two workers connect each other at the same time.
+            for worker in xrange(state.worker + 1, len(config['workers'])): # Avoids racing when two workers connect each other at the same time.
                 if worker in state.socks_by_workers:
                     continue
 
@@ -142,7 +244,7 @@ def workers_connector():
                 sock.sendall(config['workers'][state.worker] + '\n')
                 spawn(on_worker_connected, sock, worker=worker)
 
-            if len(state.socks_by_workers) == WORKERS - 1 and not state.server_for_clients:
+            if len(state.socks_by_workers) >= len(config['workers']) - 1 and not state.server_for_clients:
                 state.server_for_clients = StreamServer(get_listener(config['port_for_clients']), on_client_connected)
                 state.server_for_clients.start()
 
@@ -163,14 +265,14 @@ def on_worker_connected(sock, addr=None, worker=None):
     """
     data = None
     try:
-        f = sock.makefile('r')
+        lines = _recv_lines(sock.recv)
 
         if worker is None:
             if not addr:
                 addr = sock.getsockname()
             log.debug('w{}: w{} from {} connected'.format(state.worker, worker, addr))
 
-            data = f.readline().rstrip()
+            data = next(lines, '').rstrip()
             try:
                 worker = config['workers'].index(data)
             except ValueError:
@@ -185,20 +287,108 @@ def on_worker_connected(sock, addr=None, worker=None):
                 state.commands_to_workers[worker] = Queue()
                 spawn(commands_sender, worker)
 
-            while 1:
-                data = f.readline()
-                if data == '':
-                    break
-
-                data = data.rstrip('\r\n')  # Don't strip '' and '\t' from '\t'-separated command.
-                on_command(data)
-                time.sleep(0)
+            for data in lines:
+                on_command(data)  # Don't strip '' and '\t' from '\t'-separated command.
 
     except Exception as e:
         on_worker_disconnected(worker)  # With Exception details.
     else:
         on_worker_disconnected(worker)  # No Exception.
 
+### _recv_lines
+
+def _recv_lines(recv):
+    """
+    Receives chunks of commands from other worker and splits each chunk to lines at once,
+    instead of "readline()" per command.
+
+    @param recv: callable(max_bytes: int) -> str - "sock.recv" or "mqks.server.lib.shm.Channel.recv"
+    @return generator(line: str) - without trailing newline, stops on disconnect.
+    """
+    tail = ''
+    while 1:
+        chunk = recv(config['commands_recv_bytes'])
+        if not chunk:
+            break
+
+        lines = chunk.split('\n')
+        if tail:
+            lines[0] = tail + lines[0]
+        tail = lines.pop()  # Incomplete line or '' after trailing newline.
+
+        for line in lines:
+            yield line
+
+        time.sleep(0)  # Once per chunk, not per command.
+
+### shm
+
+# Workers on the same host may send commands via shared memory instead of UNIX socket, see "mqks.server.lib.shm".
+
+def _get_shm_writer(worker, sock):
+    """
+    Get channel to send commands to other worker on the same host, creating it on first use after connect.
+
+    @param worker: int
+    @param sock: gevent._socket2.socket - connected to this worker
+    @return mqks.server.lib.shm.Channel|None - None if commands are sent via socket
+    """
+    channel = state.shm_channels_to_workers.get(worker)
+    if channel is None and config['shm_commands'] and shm.SUPPORTED and sock.family == AF_UNIX:
+        path = os.path.join(config['unix_sock_dir'], 'shm.w{}.w{}'.format(state.worker, worker))
+        channel = shm.Channel(path, config['shm_commands_bytes'])
+        try:
+            sock.sendall('\t'.join(('_shm_start', '-', '-', '-1', '0', str(state.worker), path)) + '\n')  # The last command sent via socket.
+        except Exception:
+            channel.close()
+            raise
+        state.shm_channels_to_workers[worker] = channel
+        log.debug('w{}: sending commands to w{} via {}'.format(state.worker, worker, path))
+    return channel
+
+@at_worker_sent_to
+def _shm_start(request, worker, path):
+    """
+    Start receiving commands from other worker via shared memory, after all commands received via socket.
+
+    @param request: dict - defined in "on_request"
+    @param worker: str - int
+    @param path: str
+    """
+    worker = int(worker)
+    channel = shm.Channel(path)
+    state.shm_channels_from_workers[worker] = channel
+    spawn(_shm_receiver, worker, channel)
+
+def _shm_receiver(worker, channel):
+    """
+    Receives commands from other worker via shared memory until disconnect.
+
+    @param worker: int
+    @param channel: mqks.server.lib.shm.Channel
+    """
+    log.debug('w{}: receiving commands from w{} via {}'.format(state.worker, worker, channel.path))
+    try:
+        for data in _recv_lines(channel.recv):
+            on_command(data)
+    except Exception:
+        crit(also='w{}: w{}'.format(state.worker, worker))
+    finally:
+        channel.close()
+        if state.shm_channels_from_workers.get(worker) is channel:
+            del state.shm_channels_from_workers[worker]
+
+def _close_shm_channels(worker):
+    """
+    Close shared memory channels to and from other worker on disconnect.
+
+    @param worker: int
+    """
+    for channels in state.shm_channels_to_workers, state.shm_channels_from_workers:
+        channel = channels.pop(worker, None)
+        if channel:
+            channel.close()
+
 ### on_worker_disconnected
 
 def on_worker_disconnected(worker):
@@ -207,8 +397,14 @@ def on_worker_disconnected(worker):
 
     @param worker: int|None
     """
+    if worker is not None:
+        _close_shm_channels(worker)
+
     if worker is None:
         log.info('w{}: bye w{}'.format(state.worker, worker))
+    elif worker >= len(config['workers']):
+        state.socks_by_workers.pop(worker, None)
+        log.info('w{}: bye w{} removed from workers'.format(state.worker, worker))
     else:
         state.socks_by_workers.pop(worker, None)  # "workers_connector" or "server_for_workers" will reconnect, "commands_sender" will wait for new socket.
         crit(also='w{}: lost w{}, reconnecting, error ='.format(state.worker, worker))
@@ -234,6 +430,10 @@ def send_to_worker(worker, func_name, request, args=()):
     else:
         wall = gbn('send_to_worker.other')
 
+        if any('\t' in arg or '\n' in arg for arg in args):
+            func_name = ESCAPED + func_name
+            args = tuple(escape(arg) for arg in args)
+
         # "command protocol" encodes 40x faster than default "pickle.dumps" and produces 9x smaller result:
         command = '\t'.join((func_name, request['id'], request.get('client', '-'), str(request.get('worker', -1)), str(int(request.get('confirm', False)))) + args)
 
@@ -256,7 +456,10 @@ def commands_sender(worker):
     commands = state.commands_to_workers[worker]
     while 1:
         try:
-            command = commands.peek()
+            commands.peek()
+
+            if config['commands_batch_seconds'] and commands.qsize() < config['commands_batch_count']:
+                time.sleep(config['commands_batch_seconds'])  # Nagle-style: let more commands to be queued.
 
             sock = state.socks_by_workers.get(worker)
             if sock is None:
@@ -264,14 +467,18 @@ def commands_sender(worker):
                 continue
 
             wall = gbn('commands_sender')
+            batch = _get_batch(commands.queue, config['commands_batch_count'], config['commands_batch_bytes'])
             try:
-                sock.sendall(command + '\n')
+                (_get_shm_writer(worker, sock) or sock).sendall('\n'.join(batch) + '\n')
             except Exception:
                 gbn(wall=wall)
-                on_worker_disconnected(worker)
+                if state.socks_by_workers.get(worker) is sock:  # Not reconnected yet, e.g. shm channel was closed on disconnect.
+                    on_worker_disconnected(worker)
                 continue
 
-            commands.get()  # Safe to delete command from "commands" queue.
+            for _ in xrange(len(batch)):
+                commands.get_nowait()  # Safe to delete commands from "commands" queue. This greenlet is the only getter.
+            state.commands_flushes += 1
             gbn(wall=wall)
 
             time.sleep(0)
@@ -279,6 +486,27 @@ def commands_sender(worker):
         except Exception:
             crit(also='w{}: w{}'.format(state.worker, worker))
 
+### _get_batch
+
+def _get_batch(items, max_count, max_bytes):
+    """
+    Peeks a batch of items from the head of the queue without deleting them.
+    At least one item is returned, even if it is bigger than "max_bytes".
+
+    @param items: collections.deque(str) - E.g. "gevent.queue.Queue().queue"
+    @param max_count: int
+    @param max_bytes: int
+    @return list(str)
+    """
+    batch = []
+    size = 0
+    for item in islice(items, max_count):
+        size += len(item) + 1
+        if size > max_bytes and batch:
+            break
+        batch.append(item)
+    return batch
+
 ### on_command
 
 def on_command(command):
@@ -296,6 +524,9 @@ def on_command(command):
         parts = command.split('\t')
         func_name, request_id, client, worker, confirm = parts[:5]
         args = parts[5:]
+        if func_name.startswith(ESCAPED):
+            func_name = func_name[1:]
+            args = [unescape(arg) for arg in args]
         request = dict(id=request_id, client=client, worker=int(worker), confirm=bool(int(confirm)))
 
         gbn(wall=wall)
@@ -351,4 +582,4 @@ def on_error(command, request=None):
 
 ### anti-loop import
 
-from mqks.server.lib.clients import on_client_connected, remote_respond
+from mqks.server.lib.clients import on_client_connected, remote_respond, respond
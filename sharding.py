@@ -0,0 +1,223 @@
+"""
+Placement of queues and events on workers - shared by server and clients of "mqks".
+"""
+
+### import
+
+from bisect import bisect
+import sys
+from zlib import crc32 as _zlib_crc32
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+### const
+
+DEFAULT_VNODES = 100    # Points of each worker on the ring, when it is enabled. More points = more uniform placement = slower ring build.
+DEFAULT_HASH = 'crc32'  # Name of hash in "HASHES", defined below.
+CACHE_LIMIT = 100500    # Max items with cached workers per ring: hashing and "bisect" are 15x slower than "hash(item) % len(workers)" was.
+PARTITION = '#'         # Separator of queue and index of its partition: "q1#0", "q1#1", ... - see "get_partitions".
+
+### Ring
+
+class Ring(object):
+    """
+    Consistent-hash ring: each worker owns "vnodes" points, item belongs to the worker of the first point after hash of item.
+    Points are hashes of worker addresses, not indexes, so appending a worker to "workers" moves only about 1/N of items - all to the new worker,
+    and removing the last worker moves only its items.
+    Exact algorithm is specified in "spec.txt", so clients in any language and any Python find the same workers.
+
+    "vnodes=0" is compatibility mode and default "ring_vnodes": legacy placement "hash(item) % len(workers)" with "hash()" of 64-bit Python 2 without "-R",
+    where adding a worker moves almost all items. It allows to upgrade clients and workers one by one.
+
+    Switching from "vnodes=0" to the ring moves almost all queues and events too, so it is an explicit migration:
+        "./stats.py --ring-moves --vnodes=100" shows how many queues would move.
+        Stop publishers and let consumers drain the queues: messages restored from "wal" and bindings from "bindings_snapshot"
+        are kept per worker, so they would come back at the wrong worker.
+        Stop all workers, remove their "wal_dir" and "bindings_snapshot_dir" files,
+        set the same "ring_vnodes" at all workers and clients, start workers, then clients.
+
+    "pins" override the hash for a few hot items, see "mqks.server.lib.migration.pin_queue".
+    """
+
+    __slots__ = ('workers', 'vnodes', 'hash_name', 'pins', 'version', '_hash', '_points', '_owners', '_cache')
+
+    def __init__(self, workers, vnodes=DEFAULT_VNODES, hash_name=DEFAULT_HASH, pins=None):
+        """
+        @param workers: list(str) - "host:port_for_workers:port_for_clients", see "mqks.server.config['workers']"
+        @param vnodes: int
+        @param hash_name: str - see "HASHES"
+        @param pins: dict(item: str, worker: int)|None
+        """
+        assert hash_name in HASHES, 'Hash "{}" is unknown or its package is not installed, see "mqks.sharding.HASHES"'.format(hash_name)
+        self.workers = tuple(workers)
+        self.vnodes = vnodes
+        self.hash_name = hash_name
+        self.pins = dict(pins or {})
+        assert all(0 <= worker < len(self.workers) for worker in self.pins.values()), 'Item is pinned to unknown worker: {}'.format(self.pins)
+        self.version = '{:08x}'.format(crc32(' '.join(  # Short id to compare rings in logs and stats.
+            (str(vnodes), hash_name) + self.workers + tuple('{}={}'.format(item, worker) for item, worker in sorted(self.pins.items()))
+        )))
+        self._hash = HASHES[hash_name]
+
+        points = sorted(
+            (self._hash('{}#{}'.format(address, vnode)), worker)
+            for worker, address in enumerate(self.workers)
+            for vnode in range(vnodes)
+        )
+        self._points = [point for point, _ in points]
+        self._owners = [worker for _, worker in points]
+        self._owners.append(self._owners[0] if points else None)  # Ring wraps: hash after the last point belongs to the first point.
+        self._cache = dict(self.pins)  # _cache[item: str] == worker: int - pins are always here, so they cost nothing.
+
+    def get_worker(self, item):
+        """
+        Find out which worker serves this item, e.g. queue name.
+
+        @param item: str
+        @return int
+        """
+        worker = self._cache.get(item)
+        if worker is not None:
+            return worker
+
+        if not self.vnodes:
+            worker = py2_hash(item) % len(self.workers)
+        else:
+            if self._hash is crc32:
+                try:
+                    point = _zlib_crc32(item) & 0xffffffff  # Inlined "crc32()".
+                except (TypeError, UnicodeError):  # Python 3 "str", non-ascii "unicode".
+                    point = crc32(item)
+            else:
+                point = self._hash(item)
+            worker = self._owners[bisect(self._points, point)]
+
+        if len(self._cache) >= CACHE_LIMIT:
+            self._cache = dict(self.pins)  # Cheaper than LRU, events with IDs would grow it forever.
+        self._cache[item] = worker
+        return worker
+
+    def __repr__(self):
+        return 'Ring(version={}, workers={}, vnodes={}, hash={}, pins={})'.format(self.version, len(self.workers), self.vnodes, self.hash_name, len(self.pins))
+
+### placement
+
+def format_placement(workers, pins):
+    """
+    Format "workers" and "pins" of ring for "--moved" response and commands, see "spec.txt".
+
+    @param workers: list(str)
+    @param pins: dict(item: str, worker: int)
+    @return str - "{worker},{worker},... {item}={worker_index} ..."
+    """
+    return ' '.join([','.join(workers)] + ['{}={}'.format(item, worker) for item, worker in sorted(pins.items())])
+
+def parse_placement(text):
+    """
+    Parse result of "format_placement".
+
+    @param text: str
+    @return tuple(workers: list(str), pins: dict(item: str, worker: int))
+    """
+    parts = text.split(' ')
+    return parts[0].split(','), dict((item, int(worker)) for item, worker in (part.rsplit('=', 1) for part in parts[1:]))
+
+### get moves
+
+def get_moves(old_ring, new_ring, items):
+    """
+    Find items that change their worker when ring changes.
+
+    @param old_ring: Ring
+    @param new_ring: Ring
+    @param items: iterable(str)
+    @return dict(item: str, tuple(old_worker: int, new_worker: int))
+    """
+    moves = {}
+    for item in items:
+        old_worker = old_ring.get_worker(item)
+        new_worker = new_ring.get_worker(item)
+        if new_worker != old_worker:
+            moves[item] = (old_worker, new_worker)
+    return moves
+
+### partitions
+
+def get_partitions(queue, partitions):
+    """
+    Names of partitions of the queue: each partition is a queue on its own worker,
+    and each message of events bound to them goes to one partition only, see "mqks.server.actions.publish._pick_partitions".
+
+    @param queue: str
+    @param partitions: int
+    @return list(str) - "{queue}#{index}"
+    """
+    return ['{}{}{}'.format(queue, PARTITION, index) for index in range(partitions)]
+
+def parse_partition(queue):
+    """
+    Parse name of partition.
+
+    @param queue: str
+    @return tuple(queue: str, index: int)|None - None if it is not a partition
+    """
+    base, separator, index = queue.rpartition(PARTITION)
+    if separator and base and index.isdigit():
+        return base, int(index)
+    return None
+
+### hash
+
+def crc32(item):
+    """
+    Hash of item that is the same in any process, Python version and platform: CRC-32 of UTF-8 bytes, as in zlib, gzip, PNG.
+    Its changes spread to all bits, unlike "hash()" of Python 2, where "q1" and "q2" get close values.
+
+    @param item: str|unicode|bytes
+    @return int - unsigned 32-bit
+    """
+    return _zlib_crc32(item if isinstance(item, bytes) else item.encode('utf-8')) & 0xffffffff
+
+def xxh32(item):
+    """
+    XXH32 of UTF-8 bytes with seed 0 - faster for long items, needs "xxhash" package at all clients and workers.
+
+    @param item: str|unicode|bytes
+    @return int - unsigned 32-bit
+    """
+    return xxhash.xxh32(item if isinstance(item, bytes) else item.encode('utf-8')).intdigest()
+
+HASHES = dict(  # HASHES[hash_name: str] == hash: callable(item: str) -> int - unsigned 32-bit
+    crc32=crc32,
+)
+if xxhash:
+    HASHES['xxh32'] = xxh32
+
+def _py2_hash(item):
+    """
+    "hash()" of Python 2 "str" on 64-bit platform without "-R", for compatibility mode at any Python and platform.
+    Python 3 and Python 2 with "-R" randomize "hash()" of "str" per process, 32-bit Python 2 truncates it.
+
+    @param item: str|bytes
+    @return int
+    """
+    data = bytearray(item if isinstance(item, bytes) else item.encode('utf-8'))
+    if not data:
+        return 0
+
+    mask = (1 << 64) - 1
+    value = (data[0] << 7) & mask
+    for byte in data:
+        value = ((1000003 * value) ^ byte) & mask
+    value ^= len(data)
+
+    if value >= 1 << 63:
+        value -= 1 << 64
+    if value == -1:
+        value = -2
+    return value
+
+py2_hash = hash if sys.version_info[0] == 2 and sys.maxsize > 2**32 and not sys.flags.hash_randomization else _py2_hash  # Builtin is faster, when it is the same.
@@ -6,6 +6,13 @@ Stats of "mqks" - Message Queue Kept Simple.
 Lib/script that detects number of workers,
 queries all stats from each worker,
 returns/prints aggregated result.
+
+With "--latency": prints percentiles of latency histograms merged from all workers, if "latency" is enabled in server config.
+
+With "--ring-moves": prints how many existing queues would move to other workers, if ring is changed by options, e.g.:
+    ./stats.py --ring-moves --workers=127.0.0.1:24000:25000,127.0.0.1:24001:25001,127.0.0.1:24002:25002
+    ./stats.py --ring-moves --vnodes=100  # From compatibility mode to ring, see "mqks.sharding".
+    ./stats.py --ring-moves --hash=xxh32
 """
 
 ### import
@@ -36,6 +43,15 @@ spells = [
     # How many messages were consumed from queues:
     ('messages_consumed', 'state.consumed'),
 
+    # How many messages were compressed by server, see "compress_bytes":
+    ('messages_compressed', 'state.compressed'),
+
+    # How many bytes of these messages were saved by compression, once per message:
+    ('compressed_bytes_saved', 'state.compressed_bytes_saved'),
+
+    # How many compressed messages were decompressed for consumers without "--compressed":
+    ('messages_decompressed', 'state.decompressed'),
+
     # How many queues are served by this worker:
     ('queues', 'len(state.queues)'),
 
@@ -48,6 +64,9 @@ spells = [
     # How many commands were put to other workers:
     ('commands_put', 'state.commands_put'),
 
+    # How many times batches of commands were sent to other workers, commands_put / commands_flushes == average batch size:
+    ('commands_flushes', 'state.commands_flushes'),
+
     # How many commands were got from other workers:
     ('commands_got', 'state.commands_got'),
 
@@ -75,6 +94,12 @@ spells = [
     # How many responses are waiting to be sent to client:
     ('responses_waiting', 'sum(q.qsize() for q in state.responses_by_clients.itervalues())'),
 
+    # How many responses were sent to clients:
+    ('responses_sent', 'state.responses_sent'),
+
+    # How many times batches of responses were sent to clients, responses_sent / responses_flushes == average batch size:
+    ('responses_flushes', 'state.responses_flushes'),
+
     # How many events are queues subscribed to:
     ('events_subscribed', 'len(state.queues_by_events)'),
 
@@ -117,7 +142,7 @@ def stats(spell_names=None, timeout=None):
         list(worker_result: int),
     ))
     """
-    workers = int(mqks._eval("WORKERS", timeout=timeout))
+    workers = int(mqks._eval("len(config['workers'])", timeout=timeout))
     target_spells = [(spell_name, spell) for spell_name, spell in spells if spell_name in spell_names] if spell_names else spells
 
     # It is cheaper to route combined spell to each worker.
@@ -134,6 +159,108 @@ def stats(spell_names=None, timeout=None):
         for spell_index, (spell_name, _) in enumerate(target_spells)
     ]
 
+### latency
+
+def latency(timeout=None):
+    """
+    Get latency histograms merged from all workers.
+
+    @param timeout: float|None - Max seconds to wait for result of each of N + 1 "_eval".
+    @return dict; result[stage: str][event_mask: str][bucket: int] == count: int - see "mqks.server.lib.latency"
+    """
+    from mqks.server.lib.latency import merge
+
+    workers = int(mqks._eval("len(config['workers'])", timeout=timeout))
+    greenlets = [spawn(mqks._eval, 'latency.get_histograms()', worker=worker, timeout=timeout) for worker in xrange(workers)]
+    joinall(greenlets)
+    return merge([literal_eval(greenlet.value) for greenlet in greenlets])
+
+def print_latency(result):
+    """
+    Print percentiles of latency in milliseconds.
+
+    @param result: dict - see "latency"
+    """
+    from mqks.server.lib.latency import ALL, STAGES, get_percentiles
+
+    template = '{:<18} {:<40} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}'
+    print(template.format('stage', 'event_mask', 'count', 'p50_ms', 'p90_ms', 'p99_ms', 'p99.9_ms', 'max_ms'))
+
+    for stage in STAGES:
+        histograms = result.get(stage, {})
+        for event_mask in sorted(histograms, key=lambda event_mask: (event_mask != ALL, event_mask)):  # ALL first.
+            histogram = histograms[event_mask]
+            percentiles = ['{:.3f}'.format(seconds * 1000) for seconds in get_percentiles(histogram)]
+            print(template.format(stage, event_mask, sum(histogram.itervalues()), *percentiles))
+
+### ring moves
+
+def ring_moves(workers=None, vnodes=None, hash_name=None, pins=None, timeout=None):
+    """
+    Find how many existing queues would move to other workers, if ring is changed.
+
+    @param workers: list(str)|None - New "workers", current by default.
+    @param vnodes: int|None - New "ring_vnodes", current by default.
+    @param hash_name: str|None - New "ring_hash", current by default.
+    @param pins: dict(queue: str, worker: int)|None - New "ring_pins", current by default.
+    @param timeout: float|None - Max seconds to wait for result of each of N + 1 "_eval".
+    @return dict(
+        old_ring: str,
+        new_ring: str,
+        queues: int,
+        moved: int,
+        moves: dict((old_worker: int, new_worker: int), moved: int),
+    )
+    """
+    from mqks.sharding import Ring, get_moves
+
+    old_workers, old_vnodes, old_hash_name, old_pins = literal_eval(mqks._eval(
+        "config['workers'], config['ring_vnodes'], config['ring_hash'], config['ring_pins']", timeout=timeout))
+    old_ring = Ring(old_workers, old_vnodes, old_hash_name, old_pins)
+    new_workers = old_workers if workers is None else workers
+    new_ring = Ring(
+        new_workers,
+        old_vnodes if vnodes is None else vnodes,
+        old_hash_name if hash_name is None else hash_name,
+        dict((queue, worker) for queue, worker in old_pins.iteritems() if worker < len(new_workers)) if pins is None else pins,
+    )
+
+    greenlets = [
+        spawn(mqks._eval, 'list(set(state.queues) | set(state.events_by_queues) | set(state.consumers_by_queues))', worker=worker, timeout=timeout)
+        for worker in xrange(len(old_workers))
+    ]
+    joinall(greenlets)
+    queues = set()
+    for greenlet in greenlets:
+        queues.update(literal_eval(greenlet.value))
+
+    moves = defaultdict(int)
+    for old_worker, new_worker in get_moves(old_ring, new_ring, queues).itervalues():
+        moves[old_worker, new_worker] += 1
+
+    return dict(
+        old_ring=repr(old_ring),
+        new_ring=repr(new_ring),
+        queues=len(queues),
+        moved=sum(moves.itervalues()),
+        moves=dict(moves),
+    )
+
+def print_ring_moves(result):
+    """
+    Print moves of queues.
+
+    @param result: dict - see "ring_moves"
+    """
+    print('old: {}'.format(result['old_ring']))
+    print('new: {}'.format(result['new_ring']))
+    print('queues: {}, moved: {} ({:.1f}%)'.format(result['queues'], result['moved'], 100.0 * result['moved'] / result['queues'] if result['queues'] else 0))
+
+    template = '{:>10} {:>10} {:>10}'
+    print(template.format('old_worker', 'new_worker', 'moved'))
+    for (old_worker, new_worker), moved in sorted(result['moves'].iteritems()):
+        print(template.format(old_worker, new_worker, moved))
+
 ### main
 
 def main():
@@ -149,6 +276,27 @@ def main():
     mqks.config['workers'] = server_config['workers']
     mqks.connect()
 
+    if '--ring-moves' in sys.argv:
+        options = dict(arg[2:].split('=', 1) for arg in sys.argv[1:] if arg.startswith('--') and '=' in arg)
+        result = ring_moves(
+            workers=options['workers'].split(',') if 'workers' in options else None,
+            vnodes=int(options['vnodes']) if 'vnodes' in options else None,
+            hash_name=options.get('hash'),
+        )
+        if '--json' in sys.argv:
+            print(result)
+        else:
+            print_ring_moves(result)
+        return
+
+    if '--latency' in sys.argv:
+        result = latency()
+        if '--json' in sys.argv:
+            print(result)
+        else:
+            print_latency(result)
+        return
+
     result = stats()
 
     if '--json' in sys.argv:
@@ -4,22 +4,23 @@
 import gevent
 import unittest
 
+from mqks.sharding import Ring
 from mqks.server.config import config
 from mqks.tests.simple_client import SimpleClient
 
 ### get_worker
 
-WORKERS = len(config['workers'])
+RING = Ring(config['workers'], config['ring_vnodes'], config['ring_hash'], config['ring_pins'])
 
 def get_worker(item):
     """
     Find out which worker serves this item, e.g. queue name.
-    Items are almost uniformly distributed by workers using hash of item.
+    Items are almost uniformly distributed by workers using consistent-hash ring, see "mqks.sharding".
 
-    @param item: hashable
+    @param item: str
     @return int
     """
-    return hash(item) % WORKERS
+    return RING.get_worker(item)
 
 ### MqksTestCase
 
@@ -56,6 +57,9 @@ def prepare_main_client():
 
     crit_defaults.plugins = [critbot.plugins.syslog.plugin(logger_name=mqks.config['logger_name'], logger_level=server_config['logger_level'])]
     mqks.config['workers'] = server_config['workers']
+    mqks.config['ring_vnodes'] = server_config['ring_vnodes']
+    mqks.config['ring_hash'] = server_config['ring_hash']
+    mqks.config['ring_pins'] = server_config['ring_pins']
     mqks.connect()
 
 ### Mock
@@ -20,15 +20,15 @@ class TestABCD(MqksTestCase):
         # Two consumers of the same queue - Alice and Bob:
 
         alice = Mock()
-        mqks.consume('greetings', ['hi', 'hello'], alice, confirm=True)
+        alice_id = mqks.consume('greetings', ['hi', 'hello'], alice, confirm=True)
 
         bob = Mock()
-        mqks.consume('greetings', ['hi', 'hello'], bob, confirm=True)
+        bob_id = mqks.consume('greetings', ['hi', 'hello'], bob, confirm=True)
 
         # Consumer of another queue - Charlie:
 
         charlie = Mock()
-        mqks.consume('greetings-and-byes', ['hi', 'hello', 'bye', 'good-bye'], charlie, confirm=True)
+        charlie_id = mqks.consume('greetings-and-byes', ['hi', 'hello', 'bye', 'good-bye'], charlie, confirm=True)
 
         # One publish from Dave:
 
@@ -36,7 +36,7 @@ class TestABCD(MqksTestCase):
 
         # One and only one of Alice and Bob should get the message from Dave:
 
-        if not alice.called or bob.called:
+        if not (alice.called or bob.called) or not charlie.called:  # Charlie is served by another worker.
             gevent.sleep(0.1)
 
         self.assertTrue(alice.called == 1 or bob.called == 1)
@@ -65,3 +65,10 @@ class TestABCD(MqksTestCase):
         self.assertEqual(msg['id'], dave_msg_id)
         self.assertEqual(msg['event'], 'hello')
         self.assertEqual(msg['data'], 'world')
+
+        # Cleanup, not to affect other tests:
+
+        for consumer_id in alice_id, bob_id, charlie_id:
+            mqks.delete_consumer(consumer_id, confirm=True)
+        mqks.delete_queue('greetings', confirm=True)
+        mqks.delete_queue('greetings-and-byes', confirm=True)
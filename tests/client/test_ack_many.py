@@ -0,0 +1,68 @@
+"""
+Test MQKS client: ack many, reject many, batched acks
+"""
+
+### import
+
+import gevent
+
+from mqks.client import mqks
+from mqks.tests.cases import MqksTestCase
+
+### test
+
+class TestAckMany(MqksTestCase):
+
+    ### helpers
+
+    def get_msgs(self, msgs, count):
+        for _ in xrange(10):
+            if len(msgs) < count:
+                gevent.sleep(0.1)
+        self.assertEqual(len(msgs), count)
+
+    def get_not_acked(self, consumer_id):
+        return int(mqks._eval("len(state.messages_by_consumer_ids.get('{}', ()))".format(consumer_id), worker=mqks.get_worker('q1')))
+
+    ### test ack many, reject many
+
+    def test_ack_reject_many(self):
+        msgs = []
+        consumer_id = mqks.consume('q1', ['e1'], msgs.append, manual_ack=True, confirm=True)
+        mqks.publish_many([('e1', str(x)) for x in xrange(4)], confirm=True)
+        self.get_msgs(msgs, 4)
+
+        mqks.ack_many(consumer_id, [msgs[0]['id'], msgs[1]['id']], confirm=True)
+        mqks.reject_many(consumer_id, [msgs[3]['id'], msgs[2]['id']], confirm=True)
+        self.get_msgs(msgs, 6)
+        self.assertEqual([(msg['data'], msg['retry']) for msg in msgs[4:]], [('3', '1'), ('2', '1')])
+
+        mqks.delete_consumer(consumer_id, confirm=True)
+        mqks.delete_queue('q1', confirm=True)
+
+    ### test batched acks
+
+    def test_batched_acks(self):
+        old_config = dict((name, mqks.config[name]) for name in ('ack_batch_count', 'ack_batch_seconds'))
+        mqks.config.update(ack_batch_count=3, ack_batch_seconds=0.2)
+        try:
+            msgs = []
+            consumer_id = mqks.consume('q1', ['e1'], msgs.append, manual_ack=True, confirm=True)
+            mqks.publish_many([('e1', str(x)) for x in xrange(5)], confirm=True)
+            self.get_msgs(msgs, 5)
+
+            for msg in msgs:
+                msg['ack']()
+
+            # First 3 acks are sent as one request, last 2 are buffered:
+            self.assertEqual(self.get_not_acked(consumer_id), 2)
+
+            # Buffered acks are sent after "ack_batch_seconds":
+            gevent.sleep(0.3)
+            self.assertEqual(self.get_not_acked(consumer_id), 0)
+
+            mqks.delete_consumer(consumer_id, confirm=True)
+            mqks.delete_queue('q1', confirm=True)
+
+        finally:
+            mqks.config.update(old_config)
@@ -0,0 +1,67 @@
+"""
+Test MQKS asyncio client, in a Python 3 subprocess.
+"""
+
+### import
+
+import os
+import subprocess
+
+import mqks
+from mqks.server.config import config
+from mqks.tests.cases import MqksTestCase
+
+### script
+
+SCRIPT = """
+import asyncio, sys
+from mqks.client.aio import Client
+
+async def main():
+    workers = sys.argv[1].split(',')
+    consumer_client, publisher_client = Client(workers=workers), Client(workers=workers, consumer_queue_size=2)
+
+    consumer = await consumer_client.consume('q1', ['e1', 'e2'], manual_ack=True, confirm=True)
+    await asyncio.gather(*(publisher_client.publish('e{}'.format(index % 2 + 1), 'd{}'.format(index), confirm=True) for index in range(50)))
+    await publisher_client.publish_many([('e1', 'd50'), ('e2', b'd51')], confirm=True)
+
+    msgs = []
+    async for msg in consumer:
+        msgs.append(msg['data'])
+        assert msg['event'] in ('e1', 'e2'), msg
+        await msg.ack()
+        if len(msgs) == 52:
+            break
+    assert sorted(msgs) == sorted('d{}'.format(index) for index in range(52)), msgs
+
+    assert await publisher_client._eval('1+1', worker=len(workers) - 1, timeout=5) == '2'
+    try:
+        await publisher_client._eval('1/0', timeout=5)
+    except Exception as e:
+        assert 'error' in str(e), e
+    else:
+        assert False
+
+    await consumer.delete(confirm=True)
+    assert [msg async for msg in consumer] == []
+    await consumer_client.delete_queue('q1', confirm=True)
+    await consumer_client.close()
+    await publisher_client.close()
+    print('ok')
+
+asyncio.run(main())
+"""
+
+### test
+
+class TestAio(MqksTestCase):
+
+    def test_aio(self):
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(mqks.__file__))))
+        try:
+            subprocess.check_output(['python3', '-c', 'import asyncio, uqid'], env=env, stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            self.skipTest('no python3 with "uqid"')
+
+        output = subprocess.check_output(['python3', '-c', SCRIPT, ','.join(config['workers'])], env=env, stderr=subprocess.STDOUT)
+        self.assertEqual(output.strip().splitlines()[-1], 'ok', output)
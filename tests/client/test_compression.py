@@ -0,0 +1,93 @@
+"""
+Test MQKS client: compression
+"""
+
+### import
+
+import gevent
+
+from mqks.client import mqks
+from mqks.tests.cases import MqksTestCase
+
+### test
+
+class TestCompression(MqksTestCase):
+
+    ### set up, tear down
+
+    def setUp(self):
+        mqks.disconnect()
+        mqks.config['protocol'] = 2
+        mqks.connect()
+        self.data = '{"items": [' + ', '.join(['{"id": 1, "text": "line\\nline"}'] * 100) + ']}'
+
+    def tearDown(self):
+        mqks.disconnect()
+        mqks.config.update(protocol=1, compress_bytes=0)
+        mqks.connect()
+
+    def consume_both(self):
+        """
+        @return tuple(compressed_msgs: list(dict), plain_msgs: list(dict), consumer_ids: list(str))
+        """
+        compressed_msgs, plain_msgs = [], []
+        consumer_ids = [
+            mqks.consume('q1', ['e1'], compressed_msgs.append, compressed=True, manual_ack=True, confirm=True),
+            mqks.consume('q2', ['e1'], plain_msgs.append, confirm=True),
+        ]
+        return compressed_msgs, plain_msgs, consumer_ids
+
+    def wait(self, *msgs_lists):
+        for _ in xrange(10):
+            if not all(msgs_lists):
+                gevent.sleep(0.1)
+
+    def clean(self, consumer_ids):
+        for consumer_id in consumer_ids:
+            mqks.delete_consumer(consumer_id, confirm=True)
+        for queue in 'q1', 'q2':
+            mqks.delete_queue(queue, confirm=True)
+
+    ### test client compression
+
+    def test_client_compression(self):
+        mqks.config['compress_bytes'] = 100
+        compressed_msgs, plain_msgs, consumer_ids = self.consume_both()
+
+        mqks.publish('e1', self.data)
+        mqks.publish_many([('e1', self.data), ('e1', 'small')])
+        self.wait(compressed_msgs[2:], plain_msgs[2:])
+        self.assertEqual(mqks.state['compressed'], 2)
+
+        for msgs in compressed_msgs, plain_msgs:
+            self.assertEqual([msg['data'] for msg in msgs], [self.data, self.data, 'small'])
+            self.assertFalse(any('z' in msg for msg in msgs))
+
+        # Rejected message stays compressed in the queue:
+        compressed_msgs[0]['reject']()
+        self.wait(compressed_msgs[3:])
+        self.assertEqual((compressed_msgs[3]['retry'], compressed_msgs[3]['data']), ('1', self.data))
+
+        self.clean(consumer_ids)
+
+    ### test server compression
+
+    def test_server_compression(self):
+        workers = range(len(mqks.config['workers']))
+        set_compress_bytes = lambda compress_bytes: [mqks._eval('config.update(compress_bytes={})'.format(compress_bytes), worker=worker) for worker in workers]
+        set_compress_bytes(100)
+        try:
+            compressed_msgs, plain_msgs, consumer_ids = self.consume_both()
+            compressed_before = sum(int(mqks._eval('state.compressed', worker=worker)) for worker in workers)
+
+            mqks.publish('e1', self.data)
+            self.wait(compressed_msgs, plain_msgs)
+            self.assertEqual(compressed_msgs[0]['data'], self.data)
+            self.assertEqual(plain_msgs[0]['data'], self.data)
+
+            compressed_after = sum(int(mqks._eval('state.compressed', worker=worker)) for worker in workers)
+            self.assertEqual(compressed_after, compressed_before + 1)  # Once for all queues.
+
+            self.clean(consumer_ids)
+        finally:
+            set_compress_bytes(0)
@@ -0,0 +1,52 @@
+"""
+Test MQKS client: bounded concurrency of on_msg
+"""
+
+### import
+
+import gevent
+
+from mqks.client import mqks
+from mqks.tests.cases import MqksTestCase
+
+### test
+
+class TestConcurrency(MqksTestCase):
+
+    def consume_and_publish(self, concurrency, count):
+        """
+        @param concurrency: int
+        @param count: int
+        @return tuple(datas: list(str), max_active: int)
+        """
+        datas = []
+        active = [0, 0]  # Now, max.
+
+        def on_msg(msg):
+            active[0] += 1
+            active[1] = max(active)
+            gevent.sleep(0.01)
+            datas.append(msg['data'])
+            active[0] -= 1
+
+        consumer_id = mqks.consume('q1', ['e1'], on_msg, concurrency=concurrency, confirm=True)
+        for index in xrange(count):
+            mqks.publish('e1', str(index))
+
+        for _ in xrange(30):
+            if len(datas) < count:
+                gevent.sleep(0.1)
+
+        mqks.delete_consumer(consumer_id, confirm=True)
+        mqks.delete_queue('q1', confirm=True)
+        return datas, active[1]
+
+    def test_in_order(self):
+        datas, max_active = self.consume_and_publish(1, 20)
+        self.assertEqual(datas, [str(index) for index in xrange(20)])
+        self.assertEqual(max_active, 1)
+
+    def test_pool(self):
+        datas, max_active = self.consume_and_publish(3, 30)
+        self.assertEqual(sorted(datas, key=int), [str(index) for index in xrange(30)])
+        self.assertEqual(max_active, 3)
@@ -0,0 +1,57 @@
+"""
+Test MQKS client: pipelined confirms
+"""
+
+### import
+
+import gevent
+
+from mqks.client import mqks
+from mqks.tests.cases import MqksTestCase
+
+### test
+
+class TestConfirms(MqksTestCase):
+
+    def test_publish_async(self):
+        msgs = []
+        consumer_id = mqks.consume('q1', ['e1', 'e2'], msgs.append, confirm=True)
+
+        confirms = [mqks.publish_async('e{}'.format(index % 2 + 1), str(index)) for index in xrange(1000)]
+        self.assertEqual(mqks.wait_confirms(confirms, timeout=10), {})
+        self.assertEqual([confirm.get() for confirm in confirms], [confirm.request_id for confirm in confirms])
+        self.assertEqual(mqks.state['confirms'], {})
+
+        mqks.publish('e1', 'last', confirm=True)  # Confirm means messages are put to queues, not consumed yet:
+        for _ in xrange(50):
+            if len(msgs) < 1001:
+                gevent.sleep(0.1)
+        self.assertEqual(sorted(msg['data'] for msg in msgs[:1000]), sorted(str(index) for index in xrange(1000)))
+        self.assertEqual(set(msg['id'] for msg in msgs[:1000]), set(confirm.request_id for confirm in confirms))
+
+        mqks.delete_consumer(consumer_id, confirm=True)
+        mqks.delete_queue('q1', confirm=True)
+
+    def test_errors(self):
+        consumer_id = mqks.consume('q1', ['e1'], lambda msg: None, confirm=True)  # Codec is checked when there are queues.
+        worker = mqks.get_worker('e1')
+        bad = mqks._send(worker, mqks._request_id(), 'publish', '--z=bad e1', confirm=True, payload='d1', wait=False)
+        good = mqks.publish_async('e1', 'd2')
+
+        errors = mqks.wait_confirms([bad, good], timeout=10)
+        self.assertEqual(errors.keys(), [bad.request_id])
+        self.assertEqual(len(errors[bad.request_id]), 24)  # "error_id" to find in server crits.
+        self.assertTrue(good.successful())
+
+        with self.assertRaises(mqks.ConfirmError) as context:
+            mqks._send(worker, mqks._request_id(), 'publish', '--z=bad e1', confirm=True, payload='d3')
+        self.assertEqual(len(context.exception.error_id), 24)
+
+        mqks.delete_consumer(consumer_id, confirm=True)
+        mqks.delete_queue('q1', confirm=True)
+
+    def test_timeout(self):
+        never = mqks.Confirm(mqks._request_id())
+        mqks.state['confirms'][never.request_id] = never
+        self.assertEqual(mqks.wait_confirms([never, mqks.publish_async('e1', 'd1')], timeout=0.1), {never.request_id: None})
+        self.assertNotIn(never.request_id, mqks.state['confirms'])
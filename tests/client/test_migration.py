@@ -0,0 +1,158 @@
+"""
+Test MQKS client: online migration to added and removed worker, see "mqks.server.lib.migration".
+"""
+
+### import
+
+import gevent
+import os
+import subprocess
+
+from mqks.client import mqks
+from mqks.sharding import Ring
+from mqks.server.config import config
+from mqks.tests.cases import MqksTestCase
+
+### const
+
+ADDRESS = '127.0.0.1:24003:25003'
+SERVER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))), 'server', 'mqksd')
+
+### test
+
+class TestMigration(MqksTestCase):
+
+    def wait(self, condition, seconds=10):
+        for _ in xrange(int(seconds * 10)):
+            if condition():
+                return
+            gevent.sleep(0.1)
+        self.fail('timeout')
+
+    def eval_at_worker_of(self, queue, code):
+        return mqks._eval(code, worker=mqks.get_worker(queue), timeout=5)
+
+    def test_add_and_remove_worker(self):
+        old_ring = Ring(config['workers'], config['ring_vnodes'], config['ring_hash'])
+        new_ring = Ring(config['workers'] + [ADDRESS], config['ring_vnodes'], config['ring_hash'])
+        consumed_queue, stored_queue = [queue for queue in ('q{}'.format(index) for index in xrange(100)) if new_ring.get_worker(queue) == len(config['workers'])][:2]
+        kept_queue = [queue for queue in ('q{}'.format(index) for index in xrange(100)) if new_ring.get_worker(queue) == old_ring.get_worker(queue)][0]
+
+        server = subprocess.Popen([SERVER_PATH, '24003', '25003'])
+        try:
+
+            # Consumer with not-acked message, queue with stored messages, queue that stays:
+
+            msgs = []
+            def on_msg(msg):
+                msgs.append(msg)
+                if len(msgs) > 1:
+                    msg.ack()  # The first is not acked.
+
+            consumer_id = mqks.consume(consumed_queue, ['e1'], on_msg, manual_ack=True, confirm=True)
+            mqks.delete_consumer(mqks.consume(stored_queue, ['e2'], lambda msg: None, confirm=True), confirm=True)
+            mqks.delete_consumer(mqks.consume(kept_queue, ['e2'], lambda msg: None, confirm=True), confirm=True)
+            old_worker_of_kept_queue = mqks.get_worker(kept_queue)
+
+            mqks.publish('e1', 'd1', confirm=True)
+            for index in xrange(3):
+                mqks.publish('e2', 'd{}'.format(index), confirm=True)
+            self.wait(lambda: len(msgs) == 1)
+
+            # Add worker:
+
+            self.assertEqual(mqks._eval("migration.add_worker('{}')".format(ADDRESS), timeout=30), 'ok')
+
+            # Consumer follows "--moved" to new worker, gets not-acked message again:
+
+            self.wait(lambda: len(mqks.config['workers']) == 4 and len(msgs) == 2)
+            self.assertEqual(msgs[1]['data'], 'd1')
+            self.assertEqual(msgs[1]['retry'], '1')
+            self.assertEqual(mqks.get_worker(consumed_queue), 3)
+            self.assertNotIn(consumer_id, mqks.state['workers'])
+            consumer_id, = [consumer_id for consumer_id, worker in mqks.state['workers'].iteritems() if worker == 3]
+
+            mqks.publish('e1', 'd2', confirm=True)
+            self.wait(lambda: len(msgs) == 3)
+            self.assertEqual(msgs[2]['data'], 'd2')
+
+            # Only moved items are moved:
+
+            self.assertEqual(self.eval_at_worker_of(stored_queue, "len(state.queues['{}'].queue)".format(stored_queue)), '3')
+            self.assertEqual(mqks.get_worker(kept_queue), old_worker_of_kept_queue)
+            self.assertEqual(self.eval_at_worker_of(kept_queue, "len(state.queues['{}'].queue)".format(kept_queue)), '3')
+            self.assertEqual(mqks._eval('len(state.ring.workers), state.next_ring, len(state.moved_queues)', worker=1, timeout=5), '(4, None, 0)')
+
+            # Remove worker:
+
+            self.assertEqual(mqks._eval('migration.remove_worker()', timeout=30), 'ok')
+            self.wait(lambda: len(mqks.config['workers']) == 3 and consumer_id not in mqks.state['workers'])
+
+            mqks.publish('e1', 'd3', confirm=True)
+            self.wait(lambda: len(msgs) == 4)
+            self.assertEqual(msgs[3]['data'], 'd3')
+            self.assertEqual(self.eval_at_worker_of(stored_queue, "len(state.queues['{}'].queue)".format(stored_queue)), '3')
+
+        finally:
+            server.terminate()
+            server.wait()
+
+        # Cleanup:
+
+        consumer_id, = [consumer_id for consumer_id in mqks.state['workers'] if mqks.state['on_msg'].get(consumer_id) == on_msg]
+        mqks.delete_consumer(consumer_id, confirm=True)
+        for queue in consumed_queue, stored_queue, kept_queue:
+            mqks.delete_queue(queue, confirm=True)
+
+    def test_pin_queue(self):
+        queue, other_queue = 'q1', 'q2'
+        old_worker = mqks.get_worker(queue)
+        worker = (old_worker + 1) % len(config['workers'])
+        other_worker = mqks.get_worker(other_queue)
+
+        msgs = []
+        def on_msg(msg):
+            msgs.append(msg)
+            if len(msgs) > 1:
+                msg.ack()  # The first is not acked.
+
+        consumer_id = mqks.consume(queue, ['e1'], on_msg, manual_ack=True, confirm=True)
+        mqks.publish('e1', 'd1', confirm=True)
+        self.wait(lambda: len(msgs) == 1)
+
+        try:
+
+            # Pin queue to another worker:
+
+            self.assertEqual(mqks._eval("migration.pin_queue('{}', {})".format(queue, worker), timeout=30), 'ok')
+
+            # Consumer follows "--moved" to pinned worker, gets not-acked message again:
+
+            self.wait(lambda: mqks.config['ring_pins'] == {queue: worker} and len(msgs) == 2)
+            self.assertEqual(msgs[1]['data'], 'd1')
+            self.assertEqual(mqks.get_worker(queue), worker)
+            self.assertEqual(mqks.get_worker(other_queue), other_worker)
+            self.assertNotIn(consumer_id, mqks.state['workers'])
+            self.assertEqual(self.eval_at_worker_of(queue, "'{}' in state.queues, state.ring.pins".format(queue)), "(True, {{'{}': {}}})".format(queue, worker))
+            self.assertEqual(mqks._eval("'{}' in state.queues".format(queue), worker=old_worker, timeout=5), 'False')
+
+            mqks.publish('e1', 'd2', confirm=True)
+            self.wait(lambda: len(msgs) == 3)
+            self.assertEqual(msgs[2]['data'], 'd2')
+
+        finally:
+
+            # Unpin:
+
+            self.assertEqual(mqks._eval("migration.unpin_queue('{}')".format(queue), timeout=30), 'ok')
+
+        self.wait(lambda: mqks.config['ring_pins'] == {} and len(mqks.state['workers']) == 1 and mqks.state['workers'].values() == [old_worker])
+        mqks.publish('e1', 'd3', confirm=True)
+        self.wait(lambda: len(msgs) == 4)
+        self.assertEqual(msgs[3]['data'], 'd3')
+
+        # Cleanup:
+
+        consumer_id, = mqks.state['workers']
+        mqks.delete_consumer(consumer_id, confirm=True)
+        mqks.delete_queue(queue, confirm=True)
@@ -0,0 +1,46 @@
+"""
+Test MQKS client: Msg
+"""
+
+### import
+
+import unittest
+
+from mqks.client import mqks
+
+### test
+
+class TestMsg(unittest.TestCase):
+
+    def setUp(self):
+        self.old_ack_many = mqks.ack_many
+        self.acks = []
+        mqks.ack_many = lambda consumer_id, msg_ids, confirm=False: self.acks.append((consumer_id, msg_ids, confirm))
+
+    def tearDown(self):
+        mqks.ack_many = self.old_ack_many
+
+    def test_props(self):
+        msg = mqks._get_msg('c1', 'm1', 'event=e1,retry=2', 'd1')
+        self.assertEqual((msg['id'], msg['data']), ('m1', 'd1'))
+        self.assertEqual(msg['event'], 'e1')
+        self.assertEqual(msg.get('retry'), '2')
+        self.assertEqual(msg.get('missing'), None)
+        self.assertRaises(KeyError, lambda: msg['missing'])
+
+    def test_dict_compatible(self):
+        msg = mqks._get_msg('c1', 'm1', 'event=e1', 'd1')
+        self.assertTrue(isinstance(msg, dict))
+        self.assertFalse('retry' in msg)
+        self.assertTrue('event' in msg)
+        self.assertEqual(sorted(msg), ['data', 'event', 'id'])
+        self.assertEqual(msg.copy(), dict(id='m1', data='d1', event='e1'))
+
+        msg['data'] = 'd2'
+        self.assertEqual((msg['data'], msg['event']), ('d2', 'e1'))
+
+    def test_ack(self):
+        msg = mqks._get_msg('c1', 'm1', 'event=e1', 'd1')
+        msg['ack']()
+        msg.ack(confirm=True)
+        self.assertEqual(self.acks, [('c1', ['m1'], False), ('c1', ['m1'], True)])
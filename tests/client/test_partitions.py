@@ -0,0 +1,97 @@
+"""
+Test MQKS client: partitioned queues
+"""
+
+### import
+
+from collections import defaultdict
+import gevent
+
+from mqks.client import mqks
+from mqks.sharding import get_partitions
+from mqks.tests.cases import MqksTestCase
+
+### test
+
+class TestPartitions(MqksTestCase):
+
+    def wait(self, condition, seconds=10):
+        for _ in xrange(int(seconds * 10)):
+            if condition():
+                return
+            gevent.sleep(0.1)
+        self.fail('timeout')
+
+    def test_partitions(self):
+        partitions = get_partitions('q1', 4)
+        self.assertEqual(partitions, ['q1#0', 'q1#1', 'q1#2', 'q1#3'])
+        self.assertGreater(len(set(mqks.get_worker(partition) for partition in partitions)), 1)
+
+        msgs = []
+        on_msg = lambda msg: (msgs.append(msg), msg.ack())
+        consumer_id = mqks.consume('q1', ['e1', 'e2'], on_msg, manual_ack=True, confirm=True, partitions=4)
+        partition_consumer_ids = mqks.state['partition_consumers'][consumer_id]
+        self.assertEqual(len(partition_consumer_ids), 4)
+        self.assertEqual([mqks.state['workers'][partition_consumer_id] for partition_consumer_id in partition_consumer_ids], [mqks.get_worker(partition) for partition in partitions])
+        for worker in xrange(len(mqks.config['workers'])):
+            self.assertEqual(mqks._eval('sorted(state.partitions)', worker=worker, timeout=5), repr(partitions))
+
+        other_msgs = []
+        other_consumer_id = mqks.consume('q2', ['e1'], other_msgs.append, confirm=True)
+
+        # Round-robin, each message goes to one partition only, other queues get all:
+
+        for index in xrange(20):
+            mqks.publish('e1', str(index), confirm=True)
+        self.wait(lambda: len(msgs) == 20 and len(other_msgs) == 20)
+        self.assertEqual(sorted(int(msg['data']) for msg in msgs), range(20))
+
+        counts = defaultdict(int)
+        for msg in msgs:
+            counts[msg._consumer_id] += 1
+        self.assertEqual(sorted(counts.values()), [5, 5, 5, 5])
+
+        # Partition key keeps order of its messages in one partition:
+
+        del msgs[:]
+        mqks.publish_many([('e1', 'a{}'.format(index), 'key-a') for index in xrange(10)] + [('e2', 'b{}'.format(index), 'key-b') for index in xrange(10)], confirm=True)
+        for index in xrange(10):
+            mqks.publish('e1', 'c{}'.format(index), confirm=True, partition_key='key-c')
+        self.wait(lambda: len(msgs) == 30)
+
+        for key in 'abc':
+            key_msgs = [msg for msg in msgs if msg['data'].startswith(key)]
+            self.assertEqual([msg['data'] for msg in key_msgs], ['{}{}'.format(key, index) for index in xrange(10)])
+            self.assertEqual(len(set(msg._consumer_id for msg in key_msgs)), 1)
+
+        # Rebind and delete all partitions:
+
+        mqks.rebind('q1', remove=['e1'], confirm=True, partitions=4)
+        self.assertEqual(mqks._eval("sorted(state.events_by_queues.get('q1#3', ()))", worker=mqks.get_worker('q1#3'), timeout=5), "['e2']")
+
+        mqks.delete_consumer(consumer_id, confirm=True)
+        self.assertEqual(mqks.state['partition_consumers'], {})
+        self.assertEqual(mqks.state['partitioned_consumers'], {})
+        for partition_consumer_id in partition_consumer_ids:
+            self.assertNotIn(partition_consumer_id, mqks.state['workers'])
+
+        mqks.delete_queue('q1', confirm=True, partitions=4)
+        for partition in partitions:
+            self.assertEqual(mqks._eval("'{}' in state.queues".format(partition), worker=mqks.get_worker(partition), timeout=5), 'False')
+        for worker in xrange(len(mqks.config['workers'])):
+            self.assertEqual(mqks._eval('sorted(state.partitions)', worker=worker, timeout=5), '[]')
+
+        mqks.delete_consumer(other_consumer_id, confirm=True)
+        mqks.delete_queue('q2', confirm=True)
+
+    def test_usual_queues_like_partitions(self):
+        msgs = defaultdict(list)
+        consumer_ids = [mqks.consume(queue, ['e1'], msgs[queue].append, confirm=True) for queue in ['q1#0', 'q1#1']]
+
+        for index in xrange(10):
+            mqks.publish('e1', str(index), confirm=True)
+        self.wait(lambda: len(msgs['q1#0']) == 10 and len(msgs['q1#1']) == 10)
+
+        for consumer_id in consumer_ids:
+            mqks.delete_consumer(consumer_id, confirm=True)
+        mqks.delete_queue('q1', confirm=True, partitions=2)
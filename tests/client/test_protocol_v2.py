@@ -0,0 +1,114 @@
+"""
+Test MQKS client: protocol v2
+"""
+
+### import
+
+import gevent
+from gevent import socket
+
+from mqks.client import mqks
+from mqks.server.config import config
+from mqks.tests.cases import MqksTestCase
+
+### test
+
+class TestProtocolV2(MqksTestCase):
+
+    ### set up, tear down
+
+    def setUp(self):
+        mqks.disconnect()
+        mqks.config['protocol'] = 2
+        mqks.connect()
+
+    def tearDown(self):
+        mqks.disconnect()
+        mqks.config['protocol'] = 1
+        mqks.connect()
+
+    ### test binary
+
+    def test_binary(self):
+        msgs = []
+        events = ['e{}'.format(x) for x in xrange(6)]  # Some events and the queue are at different workers.
+        consumer_id = mqks.consume('q1', events, msgs.append, manual_ack=True, confirm=True)
+
+        data = ''.join(chr(x) for x in xrange(256)) + ' \n\t\r\n '
+        msg_ids = [mqks.publish(event, data, confirm=True) for event in events]
+        msg_ids += mqks.publish_many([(event, data) for event in events], confirm=True)
+
+        for _ in xrange(10):
+            if len(msgs) < len(msg_ids):
+                gevent.sleep(0.1)
+        self.assertEqual(sorted(msg['id'] for msg in msgs), sorted(msg_ids))
+        self.assertTrue(all(msg['data'] == data for msg in msgs))
+
+        # Rejected message goes through worker commands and "wal" intact:
+        msgs[0]['reject']()
+        for _ in xrange(10):
+            if len(msgs) == len(msg_ids):
+                gevent.sleep(0.1)
+        self.assertEqual(msgs[-1]['retry'], '1')
+        self.assertEqual(msgs[-1]['data'], data)
+
+        mqks.ack_all(consumer_id)
+        mqks.delete_consumer(consumer_id, confirm=True)
+        mqks.delete_queue('q1', confirm=True)
+
+### TestV1Consumer
+
+class TestV1Consumer(MqksTestCase):
+
+    def publish_v2(self, event, data, request_id='p1'):
+        """
+        Publish via "protocol v2" from other client, while "mqks" client uses "protocol v1".
+
+        @return response_code: int
+        """
+        host, _, port = config['workers'][mqks.get_worker(event)].split(':')
+        sock = socket.create_connection((host, int(port)))
+        try:
+            sock.sendall(mqks.V2_MAGIC)
+            self.assertEqual(mqks._recv_exactly(sock, len(mqks.V2_MAGIC)), mqks.V2_MAGIC)
+            sock.sendall(mqks.V2_REQUEST_HEADER.pack(mqks.V2_ACTION_CODES['publish'], mqks.V2_CONFIRM | mqks.V2_PAYLOAD, len(request_id), len(event), len(data)) + request_id + event + data)
+            response_code, _, _ = mqks.V2_RESPONSE_HEADER.unpack(mqks._recv_exactly(sock, mqks.V2_RESPONSE_HEADER.size))
+            return response_code
+        finally:
+            sock.close()
+
+    def test_v1_consumer(self):
+        self.assertEqual(mqks.config['protocol'], 1)
+        msgs = []
+        consumer_id = mqks.consume('q1', ['e1'], msgs.append, confirm=True)
+
+        datas = ['a\nb', 'a\\nb\\\tc\n', 'a\\nb']  # Last one has no newline, so it is not escaped.
+        for data in datas:
+            self.assertEqual(self.publish_v2('e1', data), 0)
+
+        for _ in xrange(50):
+            if len(msgs) < len(datas):
+                gevent.sleep(0.1)
+        self.assertEqual([msg['data'] for msg in msgs], datas)
+        self.assertEqual([msg['event'] for msg in msgs], ['e1'] * len(datas))  # Props are parsed.
+        self.assertEqual(['esc' in msg for msg in msgs], [False] * len(datas))
+
+        mqks.delete_consumer(consumer_id, confirm=True)
+        mqks.delete_queue('q1', confirm=True)
+
+    def test_invalid_request_id(self):
+        msgs = []
+        consumer_id = mqks.consume('q1', ['e1'], msgs.append, confirm=True)
+
+        for request_id in 'p\t1', 'p\n1', 'p 1':  # Separators of "command protocol" and "protocol v1".
+            self.assertEqual(self.publish_v2('e1', 'd1', request_id), mqks.V2_ERROR)
+        self.assertEqual(self.publish_v2('e1', 'd2'), 0)
+
+        for _ in xrange(50):
+            if not msgs:
+                gevent.sleep(0.1)
+        gevent.sleep(0.1)
+        self.assertEqual([msg['data'] for msg in msgs], ['d2'])
+
+        mqks.delete_consumer(consumer_id, confirm=True)
+        mqks.delete_queue('q1', confirm=True)
@@ -0,0 +1,35 @@
+"""
+Test MQKS client: publish many
+"""
+
+### import
+
+import gevent
+
+from mqks.client import mqks
+from mqks.tests.cases import MqksTestCase
+
+### test
+
+class TestPublishMany(MqksTestCase):
+
+    def test_publish_many(self):
+        msgs = []
+        consumer_id = mqks.consume('q1', ['e1', 'e2', 'e3'], msgs.append, confirm=True)
+
+        events_and_data = [('e{}'.format(x % 3 + 1), 'd{}'.format(x)) for x in xrange(30)]
+        msg_ids = mqks.publish_many(events_and_data, confirm=True)
+        self.assertEqual(len(set(msg_ids)), 30)
+
+        for _ in xrange(10):
+            if len(msgs) < 30:
+                gevent.sleep(0.1)
+        self.assertEqual(len(msgs), 30)
+
+        # Messages of the same event are received in order of publish:
+        for event in 'e1', 'e2', 'e3':
+            expected = [(msg_id, data) for msg_id, (e, data) in zip(msg_ids, events_and_data) if e == event]
+            self.assertEqual([(msg['id'], msg['data']) for msg in msgs if msg['event'] == event], expected)
+
+        mqks.delete_consumer(consumer_id, confirm=True)
+        mqks.delete_queue('q1', confirm=True)
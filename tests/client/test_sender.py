@@ -0,0 +1,35 @@
+"""
+Test MQKS client: coalescing sender
+"""
+
+### import
+
+import gevent
+
+from mqks.client import mqks
+from mqks.tests.cases import MqksTestCase
+
+### test
+
+class TestSender(MqksTestCase):
+
+    def test_coalescing(self):
+        msgs = []
+        consumer_id = mqks.consume('q1', ['e1'], msgs.append, confirm=True)
+        sent, flushes = mqks.state['requests_sent'], mqks.state['requests_flushes']
+
+        for index in xrange(999):
+            mqks.publish('e1', str(index))  # Queued without context switch.
+        mqks.publish('e1', '999', confirm=True)
+
+        sent, flushes = mqks.state['requests_sent'] - sent, mqks.state['requests_flushes'] - flushes
+        self.assertTrue(sent >= 1000, sent)
+        self.assertTrue(flushes * 10 < sent, (sent, flushes))  # Average batch size.
+
+        for _ in xrange(20):
+            if len(msgs) < 1000:
+                gevent.sleep(0.1)
+        self.assertEqual([msg['data'] for msg in msgs], [str(index) for index in xrange(1000)])
+
+        mqks.delete_consumer(consumer_id, confirm=True)
+        mqks.delete_queue('q1', confirm=True)
@@ -0,0 +1,69 @@
+"""
+Test MQKS threaded client, in a subprocess without gevent.
+"""
+
+### import
+
+import os
+import subprocess
+import sys
+
+from mqks.server.config import config
+from mqks.tests.cases import MqksTestCase
+
+### script
+
+SCRIPT = """
+import sys, threading, time
+from mqks.client.threaded import Client, ConfirmError
+
+assert 'gevent' not in sys.modules
+workers = sys.argv[1].split(',')
+consumer_client, publisher_client = Client(workers=workers), Client(workers=workers, on_msg_threads=1)
+
+msgs = []
+all_msgs = threading.Event()
+def on_msg(msg):
+    msgs.append(msg['data'])
+    msg['ack']()
+    if len(msgs) == 100:
+        all_msgs.set()
+
+consumer_id = consumer_client.consume('q1', ['e1', 'e2'], on_msg, manual_ack=True, confirm=True)
+
+def publish(thread_index):
+    for index in xrange(25):
+        publisher_client.publish('e{}'.format(index % 2 + 1), '{}.{}'.format(thread_index, index), confirm=True)
+
+threads = [threading.Thread(target=publish, args=(thread_index, )) for thread_index in xrange(4)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+
+assert all_msgs.wait(5), len(msgs)
+assert sorted(msgs) == sorted('{}.{}'.format(thread_index, index) for thread_index in xrange(4) for index in xrange(25))
+assert publisher_client._eval('1+1', worker=len(workers) - 1, timeout=5) == '2'
+
+try:
+    publisher_client.rebind('q2', ['user*'], confirm=True)  # Invalid event mask.
+except ConfirmError as e:
+    assert len(e.error_id) == 24, e.error_id  # "error_id" to find in server crits.
+else:
+    assert False, 'no ConfirmError'
+
+consumer_client.delete_consumer(consumer_id, confirm=True)
+consumer_client.delete_queue('q1', confirm=True)
+consumer_client.disconnect()
+publisher_client.disconnect()
+print('ok')
+"""
+
+### test
+
+class TestThreaded(MqksTestCase):
+
+    def test_threaded(self):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+        output = subprocess.check_output([sys.executable, '-c', SCRIPT, ','.join(config['workers'])], env=env, stderr=subprocess.STDOUT)
+        self.assertEqual(output.strip().splitlines()[-1], 'ok', output)
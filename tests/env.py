@@ -3,7 +3,9 @@
 
 from nose.plugins import Plugin
 import os
+import socket
 import subprocess
+import time
 
 from mqks.server.config import config
 
@@ -56,3 +58,19 @@ class EnvPlugin(Plugin):
             subprocess.Popen([self.__mqks_server_path, port_for_workers, port_for_clients])
             for _, port_for_workers, port_for_clients in (worker.split(':') for worker in config['workers'])
         ]
+        self.__wait_mqks_server()
+
+    ### private wait mqks server
+
+    def __wait_mqks_server(self):
+        # Each worker listens for clients when all workers are connected.
+        # Else the first test would race with reconnects of client.
+        for host, _, port_for_clients in (worker.split(':') for worker in config['workers']):
+            while 1:
+                sock = socket.socket()
+                try:
+                    if sock.connect_ex((host, int(port_for_clients))) == 0:
+                        break
+                finally:
+                    sock.close()
+                time.sleep(0.1)
@@ -164,3 +164,71 @@ class TestAck(MqksTestCase):
         # close
         q1_client1.close()
         q2_client3.close()
+
+    ### test prefetch
+
+    def test_prefetch(self):
+        q1_client = self.get_simple_client('q1')
+        consumer_id = q1_client.send('consume --confirm q1 e1 --manual-ack --prefetch=2')
+        self.assertEqual(q1_client.get_response(consumer_id), 'ok ')
+
+        e1_client = self.get_simple_client('e1')
+        publish_ids = [e1_client.send('publish e1 {}'.format(i)) for i in xrange(4)]
+
+        # Only "prefetch" messages are in flight:
+        self.assertEqual(q1_client.get_response(consumer_id).split(' ', 3)[1], publish_ids[0])
+        self.assertEqual(q1_client.get_response(consumer_id).split(' ', 3)[1], publish_ids[1])
+        self.assertTrue(q1_client.get_response(consumer_id, timeout=0.1) is None)
+
+        # Ack resumes delivery:
+        q1_client.send('ack {} {}'.format(consumer_id, publish_ids[0]))
+        self.assertEqual(q1_client.get_response(consumer_id).split(' ', 3)[1], publish_ids[2])
+        self.assertTrue(q1_client.get_response(consumer_id, timeout=0.1) is None)
+
+        # Reject resumes delivery too, rejected msg goes to the tail:
+        q1_client.send('reject {} {}'.format(consumer_id, publish_ids[1]))
+        self.assertEqual(q1_client.get_response(consumer_id).split(' ', 3)[1], publish_ids[3])
+        self.assertTrue(q1_client.get_response(consumer_id, timeout=0.1) is None)
+
+        q1_client.send('ack {} --all'.format(consumer_id))
+        msg = q1_client.get_response(consumer_id).split(' ', 3)
+        self.assertEqual(msg[1:3], [publish_ids[1], 'event=e1,retry=1'])
+
+        # delete
+
+        request_id = q1_client.send('delete_consumer --confirm {}'.format(consumer_id))
+        self.assertEqual(q1_client.get_response(request_id), 'ok ')
+
+        request_id = q1_client.send('delete_queue --confirm q1')
+        self.assertEqual(q1_client.get_response(request_id), 'ok ')
+
+    ### test ack and reject many
+
+    def test_ack_reject_many(self):
+        q1_client = self.get_simple_client('q1')
+        consumer_id = q1_client.send('consume --confirm q1 e1 --manual-ack')
+        self.assertEqual(q1_client.get_response(consumer_id), 'ok ')
+
+        e1_client = self.get_simple_client('e1')
+        publish_ids = [e1_client.send('publish e1 {}'.format(i)) for i in xrange(5)]
+        for publish_id in publish_ids:
+            self.assertEqual(q1_client.get_response(consumer_id).split(' ', 3)[1], publish_id)
+
+        # Ack some, reject others in reversed order, unknown msg_id is ignored:
+        request_id = q1_client.send('ack --confirm {} {} {} unknown'.format(consumer_id, publish_ids[0], publish_ids[2]))
+        self.assertEqual(q1_client.get_response(request_id), 'ok ')
+        request_id = q1_client.send('reject --confirm {} {} {}'.format(consumer_id, publish_ids[4], publish_ids[1]))
+        self.assertEqual(q1_client.get_response(request_id), 'ok ')
+
+        for publish_id in publish_ids[4], publish_ids[1]:
+            msg = q1_client.get_response(consumer_id).split(' ', 3)
+            self.assertEqual(msg[1:3], [publish_id, 'event=e1,retry=1'])
+        self.assertTrue(q1_client.get_response(consumer_id, timeout=0.1) is None)
+
+        # delete
+
+        request_id = q1_client.send('delete_consumer --confirm {}'.format(consumer_id))
+        self.assertEqual(q1_client.get_response(request_id), 'ok ')
+
+        request_id = q1_client.send('delete_queue --confirm q1')
+        self.assertEqual(q1_client.get_response(request_id), 'ok ')
@@ -4,7 +4,7 @@ Test MQKS Server Consume
 
 ### import
 
-from mqks.tests.cases import MqksTestCase
+from mqks.tests.cases import get_worker, MqksTestCase
 
 ### TestConsume
 
@@ -107,6 +107,123 @@ class TestConsume(MqksTestCase):
         request_id = q2_client.send('delete_queue --confirm q2')
         self.assertEqual(q2_client.get_response(request_id), 'ok ')
 
+    ### test round robin
+
+    def test_round_robin(self):
+        q1_client1 = self.get_simple_client('q1')
+        q1_client2 = self.get_simple_client('q1')
+        consumer_id1 = q1_client1.send('consume --confirm q1 e1')
+        self.assertEqual(q1_client1.get_response(consumer_id1), 'ok ')
+        consumer_id2 = q1_client2.send('consume --confirm q1 e1')
+        self.assertEqual(q1_client2.get_response(consumer_id2), 'ok ')
+
+        e1_client = self.get_simple_client('e1')
+        for i in xrange(4):
+            e1_client.send('publish e1 {}'.format(i))
+
+        # Each ready consumer gets every second message, in order of publish:
+        self.assertEqual(q1_client1.get_response(consumer_id1).split(' ', 3)[3], '0')
+        self.assertEqual(q1_client2.get_response(consumer_id2).split(' ', 3)[3], '1')
+        self.assertEqual(q1_client1.get_response(consumer_id1).split(' ', 3)[3], '2')
+        self.assertEqual(q1_client2.get_response(consumer_id2).split(' ', 3)[3], '3')
+
+        # Deleted consumer gets nothing, the rest is kept in order for the other one:
+        request_id = q1_client1.send('delete_consumer --confirm {}'.format(consumer_id1))
+        self.assertEqual(q1_client1.get_response(request_id), 'ok ')
+        for i in xrange(4, 6):
+            e1_client.send('publish e1 {}'.format(i))
+        self.assertEqual(q1_client2.get_response(consumer_id2).split(' ', 3)[3], '4')
+        self.assertEqual(q1_client2.get_response(consumer_id2).split(' ', 3)[3], '5')
+        self.assertTrue(q1_client1.get_response(consumer_id1, timeout=0.1) is None)
+
+        # delete
+        request_id = q1_client2.send('delete_consumer --confirm {}'.format(consumer_id2))
+        self.assertEqual(q1_client2.get_response(request_id), 'ok ')
+        request_id = q1_client1.send('delete_queue --confirm q1')
+        self.assertEqual(q1_client1.get_response(request_id), 'ok ')
+
+    ### test unknown consumer
+
+    def test_unknown_consumer(self):
+        q1_client = self.get_simple_client('q1')
+        consumer_id = q1_client.send('consume --confirm q1 e1')
+        self.assertEqual(q1_client.get_response(consumer_id), 'ok ')
+
+        # Consumer id that is registered already is rejected:
+        self.assertEqual(q1_client.send('consume --confirm q1 e1', request_id=consumer_id), consumer_id)
+        self.assertEqual(q1_client.get_response(consumer_id).split(' ')[0], 'error')
+
+        # Unknown consumer at the head of ready consumers is dropped, the queue keeps dispatching:
+        eval_id = q1_client.send("_eval --worker={} state.ready_consumers_by_queues['q1'][0].appendleft('unknown')".format(get_worker('q1')))
+        self.assertEqual(q1_client.get_response(eval_id), 'ok None')
+
+        e1_client = self.get_simple_client('e1')
+        publish_id = e1_client.send('publish e1 1')
+        msg = q1_client.get_response(consumer_id, timeout=5).split(' ', 3)
+        self.assertEqual(msg[:2], ['ok', publish_id])
+        eval_id = q1_client.send("_eval --worker={} list(state.ready_consumers_by_queues['q1'][0])".format(get_worker('q1')))
+        self.assertEqual(q1_client.get_response(eval_id), "ok ['{}']".format(consumer_id))
+
+        # delete
+        request_id = q1_client.send('delete_consumer --confirm {}'.format(consumer_id))
+        self.assertEqual(q1_client.get_response(request_id), 'ok ')
+        request_id = q1_client.send('delete_queue --confirm q1')
+        self.assertEqual(q1_client.get_response(request_id), 'ok ')
+
+    ### test deleted consumer
+
+    def test_deleted_consumer(self):
+        q1_client1 = self.get_simple_client('q1')
+        q1_client2 = self.get_simple_client('q1')
+        consumer_id1 = q1_client1.send('consume --confirm q1 e1')
+        self.assertEqual(q1_client1.get_response(consumer_id1), 'ok ')
+        consumer_id2 = q1_client2.send('consume --confirm q1 e1')
+        self.assertEqual(q1_client2.get_response(consumer_id2), 'ok ')
+
+        # Deleted consumer stays in ready consumers until it reaches the head, consumed again - keeps its place once:
+        request_id = q1_client1.send('delete_consumer --confirm {}'.format(consumer_id1))
+        self.assertEqual(q1_client1.get_response(request_id), 'ok ')
+        q1_client1.send('consume --confirm q1 e1', request_id=consumer_id1)
+        self.assertEqual(q1_client1.get_response(consumer_id1), 'ok ')
+
+        e1_client = self.get_simple_client('e1')
+        for i in xrange(4):
+            e1_client.send('publish e1 {}'.format(i))
+        self.assertEqual(q1_client1.get_response(consumer_id1, timeout=5).split(' ', 3)[3], '0')
+        self.assertEqual(q1_client2.get_response(consumer_id2, timeout=5).split(' ', 3)[3], '1')
+        self.assertEqual(q1_client1.get_response(consumer_id1, timeout=5).split(' ', 3)[3], '2')
+        self.assertEqual(q1_client2.get_response(consumer_id2, timeout=5).split(' ', 3)[3], '3')
+
+        # Deleted consumer is dropped at the head:
+        request_id = q1_client1.send('delete_consumer --confirm {}'.format(consumer_id1))
+        self.assertEqual(q1_client1.get_response(request_id), 'ok ')
+        for i in xrange(4, 6):
+            e1_client.send('publish e1 {}'.format(i))
+        self.assertEqual(q1_client2.get_response(consumer_id2, timeout=5).split(' ', 3)[3], '4')
+        self.assertEqual(q1_client2.get_response(consumer_id2, timeout=5).split(' ', 3)[3], '5')
+        self.assertTrue(q1_client1.get_response(consumer_id1, timeout=0.1) is None)
+        eval_id = q1_client1.send("_eval --worker={} (list(state.ready_consumers_by_queues['q1'][0]), state.ready_queues_by_consumer_ids.get('{}'))".format(get_worker('q1'), consumer_id1))
+        self.assertEqual(q1_client1.get_response(eval_id), "ok (['{}'], None)".format(consumer_id2))
+
+        # delete
+        request_id = q1_client2.send('delete_consumer --confirm {}'.format(consumer_id2))
+        self.assertEqual(q1_client2.get_response(request_id), 'ok ')
+        request_id = q1_client1.send('delete_queue --confirm q1')
+        self.assertEqual(q1_client1.get_response(request_id), 'ok ')
+        eval_id = q1_client1.send("_eval --worker={} state.ready_queues_by_consumer_ids".format(get_worker('q1')))
+        self.assertEqual(q1_client1.get_response(eval_id), 'ok {}')
+
+    ### test invalid event mask
+
+    def test_invalid_event_mask(self):
+        q1_client = self.get_simple_client('q1')
+        consumer_id = q1_client.send('consume --confirm q1 e1 user*')
+        self.assertEqual(q1_client.get_response(consumer_id).split(' ')[0], 'error')
+
+        # Consumer is not registered:
+        eval_id = q1_client.send("_eval --worker={} '{}' in state.clients_by_consumer_ids or 'q1' in state.consumers_by_queues or 'q1' in state.events_by_queues".format(get_worker('q1'), consumer_id))
+        self.assertEqual(q1_client.get_response(eval_id), 'ok False')
+
     ### test two same consumers
 
     def test_two_same_consumers(self):
@@ -161,3 +278,32 @@ class TestConsume(MqksTestCase):
 
         request_id = q1_client1.send('delete_queue --confirm q1')
         self.assertEqual(q1_client1.get_response(request_id), 'ok ')
+
+    ### test corrupt compressed msg
+
+    def test_corrupt_compressed_msg(self):
+        q1_client = self.get_simple_client('q1')
+        consumer_id = q1_client.send('consume --confirm q1 e1')
+        self.assertEqual(q1_client.get_response(consumer_id), 'ok ')
+
+        # Rejected on publish:
+        e1_client = self.get_simple_client('e1')
+        publish_id = e1_client.send('publish --confirm --z=zlib e1 garbage')
+        self.assertEqual(e1_client.get_response(publish_id).split(' ')[0], 'error')
+
+        # Valid header with corrupt body is dropped on dispatch, consumer keeps receiving:
+        publish_id = e1_client.send('publish --confirm --z=zlib e1 x\x9cgarbage')
+        self.assertEqual(e1_client.get_response(publish_id), 'ok ')
+
+        publish_id = e1_client.send('publish e1 2')
+        msg = q1_client.get_response(consumer_id, timeout=5).split(' ', 3)
+        self.assertEqual(msg[:2], ['ok', publish_id])
+        self.assertEqual(msg[3], '2')
+
+        # delete
+
+        request_id = q1_client.send('delete_consumer --confirm {}'.format(consumer_id))
+        self.assertEqual(q1_client.get_response(request_id), 'ok ')
+
+        request_id = q1_client.send('delete_queue --confirm q1')
+        self.assertEqual(q1_client.get_response(request_id), 'ok ')
@@ -4,6 +4,11 @@ Test MQKS Server Ping
 
 ### import
 
+from gevent import socket
+
+from mqks.server.config import config
+from mqks.server.lib import workers  # Anti-loop import order, see "server/mqksd".
+from mqks.server.lib.clients import V2_ACTIONS, V2_MAGIC, V2_OK, V2_PAYLOAD, V2_REQUEST_HEADER, V2_RESPONSE_HEADER
 from mqks.tests.cases import MqksTestCase
 
 ### TestPing
@@ -19,3 +24,23 @@ class TestPing(MqksTestCase):
         msg = msg.split(' ', 3)
         self.assertEqual(msg[0], 'ok', msg[0])
         self.assertEqual(msg[1], 'd1', msg[1])
+
+    ### test ping v2
+
+    def test_ping_v2(self):
+        host, _, port = config['workers'][0].split(':')
+        sock = socket.create_connection((host, int(port)))
+        try:
+            f = sock.makefile('r')
+            sock.sendall(V2_MAGIC)
+            self.assertEqual(f.read(len(V2_MAGIC)), V2_MAGIC)
+
+            data = 'd1\n\t\x00 d2'
+            sock.sendall(V2_REQUEST_HEADER.pack(V2_ACTIONS.index('ping'), V2_PAYLOAD, 3, 0, len(data)) + 'pg1' + data)
+
+            response_code, id_length, data_length = V2_RESPONSE_HEADER.unpack(f.read(V2_RESPONSE_HEADER.size))
+            self.assertEqual(response_code, V2_OK)
+            self.assertEqual(f.read(id_length), 'pg1')
+            self.assertEqual(f.read(data_length), data)
+        finally:
+            sock.close()
@@ -40,3 +40,84 @@ class TestPublish(MqksTestCase):
 
         request_id = q1_client.send('delete_queue --confirm q1')
         self.assertEqual(q1_client.get_response(request_id), 'ok ')
+
+    ### test publish many
+
+    def test_publish_many(self):
+        q1_client = self.get_simple_client('q1')
+        consumer_id = q1_client.send('consume --confirm q1 e1')
+        self.assertEqual(q1_client.get_response(consumer_id), 'ok ')
+
+        # publish messages in one request
+        e1_client = self.get_simple_client('e1')
+        request_id = e1_client.send('publish_many --confirm e1 2 d0 e1 14 d1 with spaces e1 2 d2')
+        self.assertEqual(e1_client.get_response(request_id), 'ok ')
+
+        for x, data in enumerate(['d0', 'd1 with spaces', 'd2']):
+            msg = q1_client.get_response(consumer_id).split(' ', 3)
+            self.assertEqual(msg, ['ok', '{}.{}'.format(request_id, x), 'event=e1', data])
+
+        msg = q1_client.get_response(consumer_id, timeout=0.1)
+        self.assertTrue(msg is None)
+
+        # malformed batch publishes nothing, length of data should match
+        for body in 'e1 2 d0 e1 x d1', 'e1 2 d0 e1 5 d1', 'e1 1 d0', 'e1 -1 d0', 'e1 2 d0 --bad e1 2 d1':
+            request_id = e1_client.send('publish_many --confirm {}'.format(body))
+            self.assertEqual(e1_client.get_response(request_id).split(' ')[0], 'error', body)
+        msg = q1_client.get_response(consumer_id, timeout=0.1)
+        self.assertTrue(msg is None, msg)
+
+        # trailing space of data is kept
+        request_id = e1_client.send('publish_many --confirm e1 3 d3 ')
+        self.assertEqual(e1_client.get_response(request_id), 'ok ')
+        msg = q1_client.get_response(consumer_id).split(' ', 3)
+        self.assertEqual(msg, ['ok', '{}.0'.format(request_id), 'event=e1', 'd3 '])
+
+        # delete
+
+        request_id = q1_client.send('delete_consumer --confirm {}'.format(consumer_id))
+        self.assertEqual(q1_client.get_response(request_id), 'ok ')
+
+        request_id = q1_client.send('delete_queue --confirm q1')
+        self.assertEqual(q1_client.get_response(request_id), 'ok ')
+
+    ### test publish to event mask
+
+    def test_publish_to_event_mask(self):
+        q1_client = self.get_simple_client('q1')
+        # consume event mask and event matching it
+        consumer_id = q1_client.send('consume --confirm q1 e5.*.a1 e5.id2.a1')
+        self.assertEqual(q1_client.get_response(consumer_id), 'ok ')
+
+        # publish matching events
+        for event in 'e5.id1.a1', 'e5.id2.a1':
+            publish_id = self.get_simple_client(event).send('publish {} 1'.format(event))
+            msg = q1_client.get_response(consumer_id).split(' ', 3)
+            self.assertEqual(msg[1], publish_id, msg[1])
+            self.assertEqual(msg[2], 'event={}'.format(event), msg[2])
+
+        # publish not matching events
+        for event in 'e5.id1.a2', 'e5.a1', 'e5.id1.a1.b1', 'e6.id1.a1':
+            self.get_simple_client(event).send('publish {} 1'.format(event))
+        msg = q1_client.get_response(consumer_id, timeout=0.1)
+        self.assertTrue(msg is None, msg)
+
+        # unbind event mask
+        rebind_id = q1_client.send('rebind --confirm q1 --remove e5.*.a1')
+        self.assertEqual(q1_client.get_response(consumer_id), 'ok --update q1 e5.id2.a1')
+        self.assertEqual(q1_client.get_response(rebind_id), 'ok ')
+        self.get_simple_client('e5.id1.a1').send('publish e5.id1.a1 1')
+        msg = q1_client.get_response(consumer_id, timeout=0.1)
+        self.assertTrue(msg is None, msg)
+
+        # partial masks are not supported
+        rebind_id = q1_client.send('rebind --confirm q1 --add e5.id*.a1')
+        self.assertEqual(q1_client.get_response(rebind_id).split(' ')[0], 'error')
+
+        # delete
+
+        request_id = q1_client.send('delete_consumer --confirm {}'.format(consumer_id))
+        self.assertEqual(q1_client.get_response(request_id), 'ok ')
+
+        request_id = q1_client.send('delete_queue --confirm q1')
+        self.assertEqual(q1_client.get_response(request_id), 'ok ')
@@ -4,7 +4,7 @@ Test MQKS Server Rebind
 
 ### import
 
-from mqks.tests.cases import MqksTestCase
+from mqks.tests.cases import get_worker, MqksTestCase
 
 ### TestRebind
 
@@ -407,3 +407,20 @@ class TestRebind(MqksTestCase):
         self.assertEqual(q1_client.get_response(request_id), 'ok ')
         request_id = q2_client.send('delete_queue --confirm q2')
         self.assertEqual(q2_client.get_response(request_id), 'ok ')
+
+    ### test invalid event mask
+
+    def test_invalid_event_mask(self):
+        q1_client = self.get_simple_client('q1')
+        rebind_id = q1_client.send('rebind --confirm q1 e1')
+        self.assertEqual(q1_client.get_response(rebind_id), 'ok ')
+
+        rebind_id = q1_client.send('rebind --confirm q1 --remove e1 --add e2 user*')
+        self.assertEqual(q1_client.get_response(rebind_id).split(' ')[0], 'error')
+
+        # Bindings are not changed:
+        eval_id = q1_client.send("_eval --worker={} sorted(state.events_by_queues['q1'])".format(get_worker('q1')))
+        self.assertEqual(q1_client.get_response(eval_id), "ok ['e1']")
+
+        request_id = q1_client.send('delete_queue --confirm q1')
+        self.assertEqual(q1_client.get_response(request_id), 'ok ')
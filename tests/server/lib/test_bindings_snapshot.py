@@ -0,0 +1,94 @@
+"""
+Test MQKS Server bindings snapshot
+"""
+
+### import
+
+from collections import OrderedDict
+import shutil
+import tempfile
+import unittest
+
+from mqks.server.config import config
+from mqks.server.lib import workers  # Anti-loop import order, see "server/mqksd".
+from mqks.server.lib import bindings_snapshot, state
+from mqks.server.actions.publish import _put
+
+### TestBindingsSnapshot
+
+class TestBindingsSnapshot(unittest.TestCase):
+
+    ### set up, tear down
+
+    def setUp(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.old = dict(
+            bindings_snapshot_dir=config['bindings_snapshot_dir'],
+            worker=state.worker,
+            queues=state.queues,
+            queued=state.queued,
+            events_by_queues=state.events_by_queues,
+            event_tries_by_queues=state.event_tries_by_queues,
+            queues_by_events=state.queues_by_events,
+            queues_to_delete_when_unused=state.queues_to_delete_when_unused,
+            queues_used=state.queues_used,
+            remove_mask_cache=state.remove_mask_cache,
+        )
+        config['bindings_snapshot_dir'] = self.snapshot_dir
+        state.worker = 0
+        self.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.snapshot_dir)
+        config['bindings_snapshot_dir'] = self.old.pop('bindings_snapshot_dir')
+        for name, value in self.old.iteritems():
+            setattr(state, name, value)
+
+    def clear(self):
+        state.queues = {}
+        state.events_by_queues = {}
+        state.event_tries_by_queues = {}
+        state.queues_by_events = {}
+        state.queues_to_delete_when_unused = {}
+        state.queues_used = {}
+        state.remove_mask_cache = OrderedDict()
+
+    ### test save load
+
+    def test_save_load(self):
+        state.events_by_queues['q1'] = set(['e1', 'e2.id1.a1'])
+        state.queues_by_events['e1'] = set(['q1', 'q2'])
+        state.queues_to_delete_when_unused['q1'] = 5.0
+        state.queues_to_delete_when_unused['q2'] = True
+        state.remove_mask_cache['id*'] = None
+        state.remove_mask_cache['*x'] = None
+
+        bindings_snapshot.save()
+        self.clear()
+        bindings_snapshot.load()
+
+        self.assertEqual(state.events_by_queues, {'q1': set(['e1', 'e2.id1.a1'])})
+        self.assertEqual(state.queues_by_events, {'e1': set(['q1', 'q2'])})
+        self.assertEqual(state.queues_to_delete_when_unused, {'q1': 5.0, 'q2': True})
+        self.assertEqual(sorted(state.queues_used), ['q1', 'q2'])
+        self.assertFalse(state.queues_used['q1'].is_set())
+        self.assertEqual(state.remove_mask_cache.keys(), ['id*', '*x'])
+        self.assertTrue(state.remove_mask_cache['id*'].match('id1'))
+        self.assertEqual(state.event_tries_by_queues.keys(), ['q1'] if workers.get_worker('q1') == state.worker else [])
+
+        for queue_used in state.queues_used.itervalues():
+            queue_used.set()  # Cancel "_wait_used_or_delete_queue".
+
+    ### test publish after load
+
+    def test_publish_after_load(self):
+        state.worker = workers.get_worker('q1')
+        state.events_by_queues['q1'] = set(['e1'])
+        state.events_by_queues['q2'] = set(['e1'])
+        bindings_snapshot.save()
+        self.clear()
+        bindings_snapshot.load()
+
+        self.assertEqual(sorted(state.queues), sorted(queue for queue in ('q1', 'q2') if workers.get_worker(queue) == state.worker))
+        _put('q1', 'm1 event=e1 d1', None, request=dict(id='m1', client='c1', worker=state.worker, confirm=False))
+        self.assertEqual(list(state.queues['q1'].queue), ['m1 event=e1 d1'])
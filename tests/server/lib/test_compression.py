@@ -0,0 +1,58 @@
+"""
+Test MQKS Server compression
+"""
+
+### import
+
+import unittest
+
+from mqks.server.config import config
+from mqks.server.lib import compression, state
+
+### TestCompression
+
+class TestCompression(unittest.TestCase):
+
+    ### set up, tear down
+
+    def setUp(self):
+        self.old_config = dict((name, config[name]) for name in ('compress_bytes', 'compress_codec'))
+        self.old_state = dict((name, getattr(state, name)) for name in ('compressed', 'compressed_bytes_saved', 'decompressed'))
+        config.update(compress_bytes=100, compress_codec='zlib')
+
+    def tearDown(self):
+        config.update(self.old_config)
+        for name, value in self.old_state.iteritems():
+            setattr(state, name, value)
+
+    ### test compress
+
+    def test_compress(self):
+        data = '{"user": {"id": 123, "name": "Alice"}, "items": [' + ', '.join(['{"qty": 1}'] * 50) + ']}'
+        compressed = state.compressed
+
+        self.assertEqual(compression.compress(data[:99]), (None, data[:99]))  # Too small.
+        self.assertEqual(compression.compress('\xff' * 10 + ''.join(chr(x) for x in xrange(256))), (None, '\xff' * 10 + ''.join(chr(x) for x in xrange(256))))  # Does not help.
+        self.assertEqual(state.compressed, compressed)
+
+        codec, compressed_data = compression.compress(data)
+        self.assertEqual(codec, 'zlib')
+        self.assertTrue(len(compressed_data) < len(data))
+        self.assertEqual(state.compressed, compressed + 1)
+
+        msg = 'm1 event=e1,z=zlib,retry=1 ' + compressed_data
+        self.assertEqual(compression.decompress_msg(msg), 'm1 event=e1,retry=1 ' + data)
+
+    ### test check compressed
+
+    def test_check_compressed(self):
+        compression.check_compressed('zlib', compression.compress('x' * 100)[1])
+        compression.check_compressed('zlib', compression.CODECS['zlib'][0]('') + 'corrupt body is checked on dispatch')
+        for codec, data in ('zlib', 'garbage'), ('zlib', 'x'), ('zlib', ''), ('unknown', 'x' * 100):
+            with self.assertRaises(ValueError):
+                compression.check_compressed(codec, data)
+
+        if 'lz4' in compression.CODECS:
+            compression.check_compressed('lz4', compression.CODECS['lz4'][0]('x' * 100))
+            with self.assertRaises(ValueError):
+                compression.check_compressed('lz4', 'garbage')
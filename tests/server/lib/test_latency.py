@@ -0,0 +1,91 @@
+"""
+Test MQKS Server latency histograms
+"""
+
+### import
+
+import unittest
+
+from mqks.server.config import config
+from mqks.server.lib import latency, state
+
+### TestLatency
+
+class TestLatency(unittest.TestCase):
+
+    ### set up, tear down
+
+    def setUp(self):
+        self.old = dict(
+            latency_histograms=state.latency_histograms,
+        )
+        self.old_config = dict((name, config[name]) for name in ('latency_by_event_masks', 'latency_event_masks_limit'))
+        state.latency_histograms = {}
+
+    def tearDown(self):
+        config.update(self.old_config)
+        for name, value in self.old.iteritems():
+            setattr(state, name, value)
+
+    ### test buckets
+
+    def test_buckets(self):
+        previous = -1
+        for microseconds in range(100) + [1000, 12345, 10 ** 6, 10 ** 9, 2 ** 37 - 1]:
+            bucket = latency.get_bucket(microseconds)
+            self.assertTrue(bucket >= previous, microseconds)
+            previous = bucket
+
+            highest = latency.get_microseconds(bucket)
+            self.assertTrue(microseconds <= highest <= microseconds * (1 + 1.0 / latency.SUB_BUCKETS), (microseconds, highest))
+
+        self.assertEqual(latency.get_bucket(-5), 0)
+        self.assertEqual(latency.get_bucket(2 ** 40), latency.BUCKETS - 1)
+
+    ### test stages
+
+    def test_stages(self):
+        config['latency_by_event_masks'] = True
+        msg = 'm1 event=user.123.connected data'
+
+        stamped = latency.on_enqueue(msg, published_at=0)  # Long ago.
+        self.assertEqual(stamped, msg)
+        enqueued_at = stamped.stamped_at
+        latency.on_dispatch(stamped, manual_ack=True)
+        self.assertTrue(stamped.stamped_at >= enqueued_at)
+        latency.on_ack(stamped)
+        self.assertEqual(type(stamped.split(' ', 1)[0]), str)  # Stamps are not copied.
+
+        latency.on_dispatch(msg, manual_ack=True)  # Not stamped, e.g. replayed from "wal".
+        latency.on_ack(msg)
+
+        histograms = latency.get_histograms()
+        self.assertEqual(sorted(histograms), sorted(latency.STAGES))
+        for stage in latency.STAGES:
+            self.assertEqual(sorted(histograms[stage]), [latency.ALL, 'user.{id}.connected'])
+            self.assertEqual(sum(histograms[stage][latency.ALL].itervalues()), 1)
+
+        p50, p100 = latency.get_percentiles(histograms[latency.PUBLISH_ENQUEUE][latency.ALL], (50, 100))
+        self.assertEqual(p50, p100)
+        self.assertTrue(p50 > 3600)
+
+    ### test limit
+
+    def test_limit(self):
+        config['latency_event_masks_limit'] = 1
+        for event_mask in 'e1', 'e2', 'e3':
+            latency.record(latency.ENQUEUE_DISPATCH, 0.001, event_mask)
+        self.assertEqual(sorted(state.latency_histograms[latency.ENQUEUE_DISPATCH]), [latency.ALL, 'e1'])
+
+    ### test merge
+
+    def test_merge(self):
+        merged = latency.merge([
+            {latency.DISPATCH_ACK: {latency.ALL: {1: 2, 5: 1}}},
+            {latency.DISPATCH_ACK: {latency.ALL: {5: 3}}, latency.ENQUEUE_DISPATCH: {latency.ALL: {0: 1}}},
+        ])
+        self.assertEqual(merged, {
+            latency.DISPATCH_ACK: {latency.ALL: {1: 2, 5: 4}},
+            latency.ENQUEUE_DISPATCH: {latency.ALL: {0: 1}},
+        })
+        self.assertEqual(latency.get_percentiles(merged[latency.DISPATCH_ACK][latency.ALL], (25, 50, 100)), [0.000001, 0.000005, 0.000005])
@@ -0,0 +1,83 @@
+"""
+Test MQKS Server shared-memory transport of commands
+"""
+
+### import
+
+import gevent
+import os
+import shutil
+import tempfile
+import unittest
+
+from mqks.server.lib import shm
+
+### TestShm
+
+@unittest.skipUnless(shm.SUPPORTED, 'shm is not supported on this platform')
+class TestShm(unittest.TestCase):
+
+    ### set up, tear down
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'shm.w0.w1')
+        self.writer = shm.Channel(self.path, shm.HEADER_BYTES + 100)
+        self.reader = shm.Channel(self.path)
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+        shutil.rmtree(self.dir)
+
+    ### test ring buffer
+
+    def test_ring_buffer(self):
+        self.writer.sendall('c1\n')
+        self.assertEqual(self.reader.recv(100), 'c1\n')
+
+        for index in xrange(10):  # Wraparound.
+            data = str(index) * 70
+            self.writer.sendall(data)
+            self.assertEqual(self.reader.recv(50) + self.reader.recv(50), data)
+
+        self.assertEqual(self.reader.write_pos.value, 703)
+        self.assertEqual(self.reader.read_pos.value, 703)
+
+    def test_stream(self):
+        data = os.urandom(10000)  # Bigger than ring buffer: sender waits for free space.
+        sender = gevent.spawn(self.writer.sendall, data)
+
+        chunks = []
+        size = 0
+        while size < len(data):
+            chunk = self.reader.recv(64)
+            chunks.append(chunk)
+            size += len(chunk)
+
+        sender.get(timeout=5)
+        self.assertEqual(''.join(chunks), data)
+
+    def test_wakeup(self):
+        receiver = gevent.spawn(self.reader.recv, 100)
+        gevent.sleep(0.001)
+        self.assertEqual(self.reader.reader_waiting.value, 1)
+
+        self.writer.sendall('c1\n')
+        self.assertEqual(receiver.get(timeout=5), 'c1\n')
+        self.assertEqual(self.writer.reader_waiting.value, 0)
+
+    ### test close
+
+    def test_close(self):
+        receiver = gevent.spawn(self.reader.recv, 100)
+        gevent.sleep(0.001)
+        self.reader.close()
+        self.assertEqual(receiver.get(timeout=5), '')
+        self.assertTrue(self.reader.released)
+
+        self.writer.close()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + shm.DATA_SUFFIX))
+        with self.assertRaises(IOError):
+            self.writer.sendall('c1\n')
@@ -0,0 +1,110 @@
+"""
+Test MQKS Server write-ahead log
+"""
+
+### import
+
+from gevent.queue import Queue
+import os
+import shutil
+import tempfile
+import unittest
+
+from mqks.server.config import config
+from mqks.server.lib import state, wal
+
+### TestWal
+
+class TestWal(unittest.TestCase):
+
+    ### set up, tear down
+
+    def setUp(self):
+        self.wal_dir = tempfile.mkdtemp()
+        self.old = dict(
+            wal_dir=config['wal_dir'],
+            worker=state.worker,
+            queues=state.queues,
+            consumers_by_queues=state.consumers_by_queues,
+            messages_by_consumer_ids=state.messages_by_consumer_ids,
+        )
+        config['wal_dir'] = self.wal_dir
+        state.worker = 0
+        state.queues = {}
+        state.consumers_by_queues = {}
+        state.messages_by_consumer_ids = {}
+        state.wal_seq = 0
+        state.wal_file = None
+        del state.wal_records[:]
+
+    def tearDown(self):
+        if state.wal_file:
+            state.wal_file.close()
+            state.wal_file = None
+        shutil.rmtree(self.wal_dir)
+        config['wal_dir'] = self.old.pop('wal_dir')
+        for name, value in self.old.iteritems():
+            setattr(state, name, value)
+
+    ### restart
+
+    def restart(self):
+        state.wal_file.close()
+        state.wal_file = None
+        state.queues = {}
+        wal.replay()
+        return dict((name, list(queue.queue)) for name, queue in state.queues.iteritems())
+
+    ### test replay
+
+    def test_replay(self):
+        wal.replay()
+        wal.compact()
+
+        wal.put('q1', 'm1 event=e1 d1')
+        wal.put('q1', 'm2 event=e1 d2')
+        wal.put('q2', 'm3 event=e2 d3')
+        wal.remove('q1', 'm1')  # Consumed.
+        wal.delete_queue('q2')
+        wal.remove('q1', 'm2')  # Rejected.
+        wal.put('q1', 'm2 event=e1,retry=1 d2')
+        wal.put('q1', 'm4 event=e1 d4')
+        wal._write(state.wal_file)
+
+        self.assertEqual(self.restart(), {'q1': ['m2 event=e1,retry=1 d2', 'm4 event=e1 d4']})
+
+    ### test binary
+
+    def test_binary(self):
+        wal.replay()
+        wal.compact()
+
+        msg = 'm1 event=e1 d1\n\t\\n\x00\xff'
+        wal.put('q1', msg)
+        wal._write(state.wal_file)
+        self.assertEqual(self.restart(), {'q1': [msg]})
+
+        wal.compact()
+        self.assertEqual(self.restart(), {'q1': [msg]})
+
+    ### test compact
+
+    def test_compact(self):
+        wal.replay()
+        wal.compact()
+
+        for i in xrange(100):
+            wal.put('q1', 'm{} event=e1 d'.format(i))
+            wal.remove('q1', 'm{}'.format(i))
+        wal._write(state.wal_file)
+
+        state.queues['q1'] = Queue()
+        state.queues['q1'].put('m100 event=e1 d100')
+        state.consumers_by_queues['q1'] = {'c1': True}
+        state.messages_by_consumer_ids['c1'] = {'m99': 'm99 event=e1 d99'}  # Waiting for manual ack.
+
+        wal.compact()
+        segments = sorted(os.listdir(os.path.join(self.wal_dir, 'w0')))
+        self.assertEqual(segments, ['000000000003.wal', '000000000004.wal'])  # Snapshot and current.
+
+        self.assertEqual(self.restart(), {'q1': ['m99 event=e1 d99', 'm100 event=e1 d100']})
@@ -56,13 +56,14 @@ class SimpleClient(object):
 
     ### send
 
-    def send(self, command):
+    def send(self, command, request_id=None):
         """
         Send command
         @param command: str
+        @param request_id: str or None - new one by default
         @return: str - request_id
         """
-        request_id = dtid(REQUEST_ID_LENGTH)
+        request_id = request_id or dtid(REQUEST_ID_LENGTH)
         self.__sock.send('{} {}\n'.format(request_id, command))
 
         return request_id
@@ -0,0 +1,24 @@
+"""
+Test escape of binary data, see "mqks.escape"
+"""
+
+### import
+
+import os
+import unittest
+
+from mqks.escape import escape, unescape
+
+### TestEscape
+
+class TestEscape(unittest.TestCase):
+
+    ### test escape
+
+    def test_escape(self):
+        for data in '', 'd1', '\\', '\\t', '\t', '\\\t', '\t\\', '\\\\n\n\\n', os.urandom(10000):
+            escaped = escape(data)
+            self.assertFalse('\t' in escaped or '\n' in escaped, repr(data))
+            self.assertEqual(unescape(escaped), data, repr(data))
+
+        self.assertTrue(len(escape(os.urandom(10000))) < 10300)  # Compressed data is not inflated.
@@ -0,0 +1,83 @@
+"""
+Test placement of queues and events on workers, see "mqks.sharding".
+"""
+
+### import
+
+import sys
+import unittest
+
+from mqks.sharding import HASHES, Ring, _py2_hash, crc32, format_placement, get_moves, parse_placement
+
+### const
+
+WORKERS = ['127.0.0.1:24000:25000', '127.0.0.1:24001:25001', '127.0.0.1:24002:25002']
+ITEMS = ['q{}'.format(index) for index in xrange(10000)]
+
+### TestSharding
+
+class TestSharding(unittest.TestCase):
+
+    def test_crc32(self):
+        self.assertEqual(crc32('q1'), 0x26235a72)  # Example from "spec.txt".
+        self.assertEqual(crc32(u'q1'), crc32(b'q1'))
+        self.assertEqual(crc32(u'\u0444'), crc32(u'\u0444'.encode('utf-8')))
+
+    def test_known_workers(self):
+        # Should never change, or clients with other versions of "mqks" would send to wrong workers:
+        ring = Ring(WORKERS)
+        self.assertEqual(ring.version, '83ee3fe9')
+        self.assertEqual([ring.get_worker('q{}'.format(index)) for index in xrange(12)], [2, 2, 2, 2, 1, 1, 2, 2, 1, 0, 1, 2])
+        self.assertEqual(ring.get_worker(u'q1'), ring.get_worker('q1'))
+
+    def test_compatibility_mode(self):
+        ring = Ring(WORKERS, vnodes=0)
+        self.assertEqual([ring.get_worker('q{}'.format(index)) for index in xrange(12)], [2, 1, 1, 0, 0, 2, 2, 1, 1, 0, 0, 2])
+        self.assertEqual(_py2_hash(''), 0)
+
+        if sys.maxsize > 2**32 and not sys.flags.hash_randomization:
+            for item in ITEMS[:1000] + ['', 'a', '\xff' * 100]:
+                self.assertEqual(_py2_hash(item), hash(item))
+
+    def test_add_worker(self):
+        old_ring = Ring(WORKERS)
+        new_ring = Ring(WORKERS + ['127.0.0.1:24003:25003'])
+        moves = get_moves(old_ring, new_ring, ITEMS)
+
+        self.assertEqual(set(new_worker for _, new_worker in moves.itervalues()), set([3]))
+        self.assertTrue(0.15 < 1.0 * len(moves) / len(ITEMS) < 0.35, len(moves))  # About 1/4.
+
+        self.assertEqual(get_moves(new_ring, old_ring, ITEMS), dict((item, (3, old_worker)) for item, (old_worker, _) in moves.iteritems()))
+
+    def test_uniform(self):
+        ring = Ring(WORKERS)
+        counts = [0] * len(WORKERS)
+        for item in ITEMS:
+            counts[ring.get_worker(item)] += 1
+        for count in counts:
+            self.assertTrue(0.25 < 1.0 * count / len(ITEMS) < 0.42, counts)
+
+    def test_hashes(self):
+        for hash_name in HASHES:
+            ring = Ring(WORKERS, hash_name=hash_name)
+            self.assertEqual(ring.get_worker('q1'), ring.get_worker(u'q1'))
+            self.assertEqual(set(ring.get_worker(item) for item in ITEMS[:100]), set([0, 1, 2]))
+
+        with self.assertRaises(AssertionError):
+            Ring(WORKERS, hash_name='unknown')
+
+    def test_pins(self):
+        ring = Ring(WORKERS)
+        pinned_ring = Ring(WORKERS, pins={'q1': 0})
+        self.assertNotEqual(ring.get_worker('q1'), 0)
+        self.assertEqual(get_moves(ring, pinned_ring, ITEMS), {'q1': (ring.get_worker('q1'), 0)})
+        self.assertNotEqual(pinned_ring.version, ring.version)
+
+        with self.assertRaises(AssertionError):
+            Ring(WORKERS, pins={'q1': 3})
+
+    def test_placement(self):
+        placement = format_placement(WORKERS, {'q=1': 2, 'q2': 0})
+        self.assertEqual(placement, ','.join(WORKERS) + ' q2=0 q=1=2')
+        self.assertEqual(parse_placement(placement), (WORKERS, {'q=1': 2, 'q2': 0}))
+        self.assertEqual(parse_placement(','.join(WORKERS)), (WORKERS, {}))